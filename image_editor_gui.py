@@ -1,65 +1,145 @@
 import sys
 
 import numpy as np
-from PIL.ImageQt import ImageQt
 from PyQt5 import QtWidgets
-from PyQt5.QtCore import Qt, pyqtSlot
+from PyQt5.QtCore import QSettings, QSize, pyqtSlot
 from PyQt5.QtWidgets import (
-    QWidget,
     QMainWindow,
-    QDialog,
     QFileDialog,
-    QGraphicsScene,
     QErrorMessage,
+    QMessageBox,
+    QShortcut,
+    QInputDialog,
+    QLabel,
+    QProgressBar,
+    QPushButton,
 )
-from PyQt5.QtGui import QPixmap, QImage
+from PyQt5.QtGui import QIcon, QKeySequence
 from matplotlib import pyplot as plt
 from functools import wraps, partial
 
 from PIL import Image
 
 from main import Ui_MainWindow
-from models.image_operation import ImageOperation
 from models.effect_filter import EffectFilter
+from models.image_io import ImageIO
+from models.decode_cache import DecodeCache
+from models.orientation import Orientation
+from models.image_memory import ImageMemory, ManagedImage
+from models.recipe import Recipe
+from models.region_edit import Region, RegionEdit
+from tile_view import TiledImageView, array_to_pixmap
+from sweep_dialog import SweepDialog
+from layer_dialog import LayerDialog
+from operation_thread import OperationThread
+from models.parameter_sweep import ParameterSweep
+from models.lookup_table import LookupTable
+from models.operation_registry import OperationRegistry
+from models.execution_planner import ExecutionPlanner
+from models.layer_stack import LayerStack
 import pathlib
 
 
 def is_image_loaded(func):
     @wraps(func)
     def wrapper(self, *args, **kwargs):
-        if type(self.current_image) == list:
+        if self.current_image is None:
             return self.display_error_message("Please choose an image first!")
         return func(self, *args, **kwargs)
 
     return wrapper
 
 
-class ImageEditor(QMainWindow, Ui_MainWindow):
+def is_8bit_image(func):
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if isinstance(self.current_image, np.ndarray):
+            return self.display_error_message(
+                "This operation only supports 8-bit images!"
+            )
+        return func(self, *args, **kwargs)
+
+    return wrapper
 
-    # Define properties
-    original_image = [0]
-    current_image = [0]
-    temp_img = [0]
-    previous_image = [0]
 
-    _image_blur = [0]
-    _image_sharpen = [0]
-    _image_color = [0]
-    _image_contrast = [0]
-    _image_bright = [0]
+class ImageEditor(QMainWindow, Ui_MainWindow):
+
+    # Image buffers are kept in self.image_memory, which counts their bytes
+    # and spills the cold ones to disk over the memory limit
+    original_image = ManagedImage()
+    current_image = ManagedImage(pinned=True)
+    temp_img = ManagedImage(pinned=True)
+    previous_image = ManagedImage()
 
-    image_height = 0
-    image_width = 0
+    PREVIEW_SIZE = 96
 
     def __init__(self):
         super().__init__()
         self.setupUi(self)
 
+        self.memory_label = QLabel(self)
+        self.statusbar.addPermanentWidget(self.memory_label)
+        # Progress of the operation running in self.operation_thread
+        self.operation_thread = None
+        self.progress_bar = QProgressBar(self)
+        self.progress_bar.setRange(0, 1000)
+        self.progress_bar.setMaximumWidth(240)
+        self.statusbar.addPermanentWidget(self.progress_bar)
+        self.cancel_button = QPushButton("Cancel", self)
+        self.cancel_button.clicked.connect(self.cancel_operation)
+        self.statusbar.addPermanentWidget(self.cancel_button)
+        self.progress_bar.hide()
+        self.cancel_button.hide()
+        self.settings = QSettings("PyImgEdit", "PyImgEdit")
+        max_mb = int(self.settings.value("memory/max_mb", 0))
+        self.image_memory = ImageMemory(
+            max_bytes=max_mb * 2**20 or None, on_change=self.show_memory_status
+        )
+        memory_menu = self.menubar.addMenu("Memory")
+        memory_menu.addAction("Set memory limit...", self.set_memory_limit)
+        preview_menu = self.menubar.addMenu("Preview")
+        for name, (_, _, label) in ParameterSweep.SWEEPS.items():
+            preview_menu.addAction(f"{label}...", partial(self.sweep_operation, name))
+        # Operations and how they run, from their metadata
+        self.operations = OperationRegistry()
+        self.planner = ExecutionPlanner(self.operations)
+        enhance_menu = self.menubar.addMenu("Enhance")
+        for spec in self.operations.group("enhance"):
+            enhance_menu.addAction(spec.label, partial(self.apply_operation, spec.name))
+        layer_menu = self.menubar.addMenu("Layer")
+        layer_menu.addAction("Blend filter...", self.blend_filter)
+        layer_menu.addAction("Add image layer...", self.add_image_layer)
+        self.show_memory_status()
+
+        self.image_info = {}
+        # Flips and rotations are only shown, pixels move when an op needs them
+        self.pending_orientation = Orientation()
+        self.previous_orientation = Orientation()
+        self.pixels_edited = False
+        # Filter previews are built for one (image, orientation) state
+        self.preview_key = None
+        self.reset_adjustments()
+        # Region edited by the operations, None for the whole image
+        self.selection = None
+
         self.set_slider_enabled(False)
 
+        # Zoom / pan viewer, only visible tiles are rendered
+        self.tile_view = TiledImageView(self.graphicsView)
+        QShortcut(QKeySequence("Ctrl+0"), self, self.tile_view.fit)
+        QShortcut(QKeySequence("Ctrl+1"), self, self.tile_view.zoom_actual_size)
+        QShortcut(QKeySequence("Esc"), self, self.clear_selection)
+        self.tile_view.selection_drawn.connect(self.set_selection)
+
+        try:
+            self.decode_cache = DecodeCache()
+        except OSError:
+            self.decode_cache = None
+
         # Connect signals to slots
         # Page 1
         self.open_button.clicked.connect(self.open_image)
+        self.save_button.clicked.connect(self.save_image)
         self.histogram_equal_button.clicked.connect(self.histogram_equalization)
         self.view_histogram_button.clicked.connect(self.view_histogram)
         self.invert_image_button.clicked.connect(self.invert_image)
@@ -89,16 +169,13 @@ class ImageEditor(QMainWindow, Ui_MainWindow):
         )
 
         # Page 3 - Filter
-        self.pink_dream_filter_button.clicked.connect(self.apply_pink_dream)
-        self.cyperpunk_filter_button.clicked.connect(self.apply_cyperpunk)
-        self.snowy_filter_button.clicked.connect(self.apply_snowy)
-        self.pastel_filter_button.clicked.connect(self.apply_pastel)
-        self.firestorm_filter_button.clicked.connect(self.apply_firestorm)
-        self.ice_filter_button.clicked.connect(self.apply_ice)
-        self.darkness_filter_button.clicked.connect(self.apply_darkness)
-        self.gray_nostalgia_filter_button.clicked.connect(self.apply_gray_nos)
-        self.sweet_dream_filter_button.clicked.connect(self.apply_sweet_dream)
-        self.cartoon_filter_button.clicked.connect(self.apply_cartoon)
+        self.filter_buttons = {}
+        for spec in self.operations.group("filter"):
+            button = QPushButton(spec.label, self.groupBox)
+            button.clicked.connect(partial(self.apply_operation, spec.name))
+            self.verticalLayout_6.addWidget(button)
+            self.filter_buttons[spec.name] = button
+        self.stackedWidget.currentChanged.connect(self.update_filter_previews)
 
         self.next_page_button.clicked.connect(self.to_next_page)
         self.prev_page_button.clicked.connect(self.to_prev_page)
@@ -106,11 +183,55 @@ class ImageEditor(QMainWindow, Ui_MainWindow):
         self.original_image_button.clicked.connect(self.undo_to_original)
 
     def show_image_info_status_bar(self):
-        info = ImageOperation.get_information(self.original_image)
+        info = self.image_info
         file_path = pathlib.Path(info["name"])
-        msg = f"{file_path.name} MODE: {info['mode']} SIZE: {info['size'] } FORMAT: {info['format']}"
+        msg = f"{file_path.name} MODE: {info['mode']} SIZE: {info['size'] } FORMAT: {info['format']} DEPTH: {info['depth']}-bit"
         self.statusbar.showMessage(msg)
 
+    def show_memory_status(self):
+        stats = self.image_memory.stats()
+        msg = f"Memory: {stats['resident_bytes'] / 2**20:.1f} MB"
+        if stats["max_bytes"]:
+            msg += f" / {stats['max_bytes'] / 2**20:.0f} MB"
+        if stats["spilled_bytes"]:
+            msg += f" ({stats['spilled_bytes'] / 2**20:.1f} MB on disk)"
+        self.memory_label.setText(msg)
+
+    @pyqtSlot()
+    def set_memory_limit(self):
+        current = (self.image_memory.max_bytes or 0) // 2**20
+        max_mb, ok = QInputDialog.getInt(
+            self,
+            "Memory limit",
+            "Image memory limit in MB (0 for no limit).\n"
+            "Over the limit, the original and undo images are moved to disk.",
+            current,
+            0,
+            1 << 20,
+        )
+        if not ok:
+            return
+        self.settings.setValue("memory/max_mb", max_mb)
+        self.image_memory.set_max_bytes(max_mb * 2**20 or None)
+
+    def reset_adjustments(self):
+        """
+        Forget which sliders were moved since the last image change
+        """
+        self.blur_adjusted = False
+        self.bright_adjusted = False
+        self.color_adjusted = False
+        self.contrast_adjusted = False
+        self.sharpen_adjusted = False
+
+    def closeEvent(self, event):
+        if self.operation_thread is not None:
+            self.operation_thread.cancel()
+            self.operation_thread.wait()
+        self.planner.close()
+        self.image_memory.close()
+        super().closeEvent(event)
+
     def set_slider_enabled(self, enabled: bool):
         self.blur_slider.setEnabled(enabled)
         self.sharpen_slider.setEnabled(enabled)
@@ -119,21 +240,43 @@ class ImageEditor(QMainWindow, Ui_MainWindow):
         self.contrast_slider.setEnabled(enabled)
 
     def reset_slider_value(self):
+        sliders = (
+            self.blur_slider,
+            self.sharpen_slider,
+            self.color_slider,
+            self.bright_slider,
+            self.contrast_slider,
+        )
+        # Resetting must not run the slider slots, they would overwrite
+        # previous_image before undo reads it
+        for slider in sliders:
+            slider.blockSignals(True)
         self.blur_slider.setValue(0)
         self.sharpen_slider.setValue(10)
         self.color_slider.setValue(10)
         self.bright_slider.setValue(10)
         self.contrast_slider.setValue(10)
+        for slider in sliders:
+            slider.blockSignals(False)
+        self.reset_adjustments()
 
     def open_image(self):
         open_image_dialog = QFileDialog()
-        open_image_dialog.setMimeTypeFilters({"image/jpeg", "image/png"})
+        open_image_dialog.setMimeTypeFilters({"image/jpeg", "image/png", "image/tiff"})
         image_path = QFileDialog.getOpenFileName(open_image_dialog, "Select image", "/")
 
         if image_path[0]:
-            self.current_image = Image.open(image_path[0])
+            self.image_info = ImageIO.get_information(image_path[0])
+            if self.decode_cache is not None:
+                self.current_image = self.decode_cache.open_image(image_path[0])
+            else:
+                self.current_image = ImageIO.open_image(image_path[0])
 
             self.original_image = self.previous_image = self.current_image
+            self.pending_orientation = self.previous_orientation = Orientation()
+            self.pixels_edited = False
+            self.reset_adjustments()
+            self.clear_selection()
             self.display_image()
             self.show_image_info_status_bar()
             self.set_slider_enabled(True)
@@ -141,38 +284,238 @@ class ImageEditor(QMainWindow, Ui_MainWindow):
         else:
             pass
 
-    def display_image(self):
+    @pyqtSlot()
+    @is_image_loaded
+    def save_image(self):
+        image_path, _ = QFileDialog.getSaveFileName(
+            self, "Save image", "/", "Images (*.png *.tif *.tiff *.jpg *.jpeg)"
+        )
+        if not image_path:
+            return
+
+        try:
+            if self.can_save_orientation_tag(image_path) and self.ask_question(
+                "Only the orientation changed. Write an EXIF orientation tag "
+                "instead of re-encoding the JPEG?"
+            ):
+                ImageIO.write_jpeg_orientation(
+                    self.image_info["name"],
+                    image_path,
+                    self.pending_orientation.to_exif(),
+                )
+                return
+            image = self.pending_orientation.apply(self.current_image)
+            ImageIO.save_image(image, image_path)
+        except (OSError, ValueError) as error:
+            self.display_error_message(str(error))
+
+    def can_save_orientation_tag(self, image_path: str) -> bool:
+        return (
+            not self.pixels_edited
+            and self.image_info.get("format") == "JPEG"
+            and pathlib.Path(image_path).suffix.lower() in (".jpg", ".jpeg")
+        )
+
+    def ask_question(self, msg) -> bool:
+        answer = QMessageBox.question(self, "Question", msg)
+        return answer == QMessageBox.Yes
+
+    def display_image(self, box: tuple = None):
         """
-        Set display size to the size of the image display (Graphic view)
+        Show current image in the tiled viewer (Graphic view)
+        :param box: (left, top, right, bottom) changed by the last edit, None for all
         """
-        image_scene = QGraphicsScene()
-        self.temp_img = ImageQt(self.current_image)
-        # self.temp_img = QImage(self.temp_img)
-        pixmap = QPixmap.fromImage(self.temp_img)
-        w, h = self.scale_image(pixmap.width(), pixmap.height())
-        pixmap = pixmap.copy().scaled(
-            int(w), int(h), Qt.KeepAspectRatio, Qt.SmoothTransformation
-        )
+        self.temp_img = ImageIO.to_display(self.current_image)
+        self.tile_view.set_image(self.temp_img, box)
+        self.display_orientation()
+
+    def display_orientation(self):
+        """
+        Show the pending orientation with a QTransform on the view,
+        the image pixels are not touched
+        """
+        self.tile_view.set_orientation(self.pending_orientation.matrix())
+        self.update_filter_previews()
+
+    def update_filter_previews(self, *args):
+        """
+        Show a small preview of every filter on its button. Previews are
+        only built while the filter page is visible, all filters share
+        their common stages (see FilterGraph)
+        """
+        page = self.stackedWidget.currentWidget()
+        if page is None or not page.isAncestorOf(self.groupBox):
+            return
+        if self.current_image is None or isinstance(self.current_image, np.ndarray):
+            return
+        key = (self.current_image, self.pending_orientation)
+        if self.preview_key is not None and (
+            self.preview_key[0] is key[0] and self.preview_key[1] == key[1]
+        ):
+            return
+        self.preview_key = key
 
-        image_scene.addPixmap(pixmap.copy())
-        self.graphicsView.setScene(image_scene)
+        previews = EffectFilter.preview_all(self.current_image, self.PREVIEW_SIZE)
+        for name, preview in previews.items():
+            preview = self.pending_orientation.apply(preview)
+            height, width = preview.shape[:2]
+            button = self.filter_buttons[name]
+            button.setIcon(QIcon(array_to_pixmap(preview)))
+            button.setIconSize(QSize(width, height))
 
-    def scale_image(self, width, height):
-        k = self.graphicsView.frameGeometry().height() / height
-        if width * k <= self.graphicsView.frameGeometry().width():
-            w = width * k
-            h = self.graphicsView.frameGeometry().height()
+    def materialize_orientation(self):
+        """
+        Transpose the pixels once, before an operation that needs them
+        """
+        if self.pending_orientation.is_identity():
+            return
+        if self.selection is not None:
+            self.selection = self.selection.oriented(
+                self.pending_orientation, self.image_size()
+            )
+            self.tile_view.show_selection(self.selection.outlines())
+        self.current_image = self.pending_orientation.apply(self.current_image)
+        self.pending_orientation = Orientation()
+
+    def image_size(self) -> tuple:
+        image = self.current_image
+        if isinstance(image, np.ndarray):
+            return image.shape[1], image.shape[0]
+        return image.size
+
+    @pyqtSlot(str, list)
+    def set_selection(self, kind: str, points: list):
+        """
+        Limit the next operations to the drawn rectangle or lasso
+        """
+        if self.current_image is None:
+            self.tile_view.clear_selection()
+            return
+        if kind == "rect":
+            self.selection = Region.from_rect(points[0] + points[1], self.image_size())
         else:
-            k = self.graphicsView.frameGeometry().width() / width
-            w = self.graphicsView.frameGeometry().width()
-            h = height * k
+            self.selection = Region.from_polygon(points, self.image_size())
+        if self.selection is None:
+            self.clear_selection()
+            return
+        self.tile_view.show_selection(self.selection.outlines())
+        self.statusbar.showMessage(
+            f"Selection {self.selection.width}x{self.selection.height} "
+            f"at {self.selection.box[:2]}, Esc to select all",
+            5000,
+        )
+
+    @pyqtSlot()
+    def clear_selection(self):
+        self.selection = None
+        self.tile_view.clear_selection()
+
+    def edit_image(self, name: str, source=None, **params) -> tuple:
+        """
+        Run a Recipe operation on source (the current image by default),
+        only inside the selection when there is one. Copy on write: the
+        current image is overwritten only when no other state shares it
+        :return: (new image, changed box or None for the whole image)
+        """
+        in_place = source is None and self.image_memory.is_exclusive("current_image")
+        source = self.current_image if source is None else source
+        if self.selection is None:
+            return Recipe.run_step(source, name, params, in_place), None
+        return RegionEdit.apply(source, self.selection, name, params, in_place)
+
+    def run_operation(self, name: str, **params):
+        """
+        Run a Recipe operation like edit_image, on a thread in strips so it
+        can be cancelled. The current image is replaced only once the
+        operation finished; a cancelled one leaves it untouched
+        """
+        source = self.pending_orientation.apply(self.current_image)
+        region = self.selection
+        if region is not None and not self.pending_orientation.is_identity():
+            region = region.oriented(self.pending_orientation, self.image_size())
+        self.start_operation(source, region, name, params, self.operation_finished)
+
+    def start_operation(self, source, region, name: str, params: dict, on_finished):
+        """
+        Start an OperationThread on source
+        :param on_finished: slot receiving (result, changed box or None)
+        """
+        if self.operation_thread is not None:
+            self.statusbar.showMessage("Another operation is running", 3000)
+            return
+        thread = OperationThread(self.planner, source, region, name, params, self)
+        thread.progress.connect(self.show_operation_progress)
+        thread.finished_with.connect(on_finished)
+        thread.cancelled.connect(
+            lambda: self.statusbar.showMessage(f"{name} cancelled", 3000)
+        )
+        thread.failed.connect(self.operation_failed)
+        thread.finished.connect(self.operation_ended)
+        self.operation_thread = thread
+        self.set_operation_running(True)
+        self.statusbar.showMessage(f"Running {name}...")
+        thread.start()
+
+    @pyqtSlot()
+    @is_image_loaded
+    def apply_operation(self, name: str, *args):
+        """
+        Run a registered operation without params, e.g. from a generated button
+        """
+        try:
+            self.operations[name].check(self.current_image)
+        except ValueError as error:
+            return self.display_error_message(str(error))
+        self.run_operation(name)
+
+    def set_operation_running(self, running: bool):
+        # Editing is blocked while running, the view can still be zoomed
+        self.stackedWidget.setEnabled(not running)
+        self.horizontalLayoutWidget.setEnabled(not running)
+        self.menubar.setEnabled(not running)
+        self.progress_bar.setValue(0)
+        self.progress_bar.setFormat("%p%")
+        self.progress_bar.setVisible(running)
+        self.cancel_button.setEnabled(running)
+        self.cancel_button.setVisible(running)
+
+    @pyqtSlot(float, float)
+    def show_operation_progress(self, fraction: float, remaining: float):
+        self.progress_bar.setValue(round(1000 * fraction))
+        if remaining >= 0:
+            self.progress_bar.setFormat(f"%p% - {remaining:.0f} s left")
+
+    @pyqtSlot(object, object)
+    def operation_finished(self, result, box):
+        self.statusbar.clearMessage()
+        self.set_previous_image()
+        self.current_image = result
+        self.display_image(box)
 
-        return w, h
+    @pyqtSlot(str)
+    def operation_failed(self, msg: str):
+        self.statusbar.clearMessage()
+        self.display_error_message(msg)
+
+    @pyqtSlot()
+    def operation_ended(self):
+        self.operation_thread = None
+        self.set_operation_running(False)
+
+    @pyqtSlot()
+    def cancel_operation(self):
+        if self.operation_thread is not None:
+            self.cancel_button.setEnabled(False)
+            self.operation_thread.cancel()
 
     def set_previous_image(self):
+        self.materialize_orientation()
+        self.reset_adjustments()
+        self.pixels_edited = True
         self.undo_button.setEnabled(True)
         self.original_image_button.setEnabled(True)
         self.previous_image = self.current_image
+        self.previous_orientation = Orientation()
 
     def display_error_message(self, msg):
         e = QErrorMessage(self)
@@ -186,11 +529,7 @@ class ImageEditor(QMainWindow, Ui_MainWindow):
     @pyqtSlot()
     @is_image_loaded
     def histogram_equalization(self):
-        # Store current image to previous
-        self.set_previous_image()
-
-        self.current_image = ImageOperation.histogram_equalization(self.current_image)
-        self.display_image()
+        self.run_operation("histogram_equalization")
 
     @pyqtSlot()
     @is_image_loaded
@@ -199,6 +538,15 @@ class ImageEditor(QMainWindow, Ui_MainWindow):
         if len(image.shape) > 2:
             self.display_error_message("Histogram equalization first!!")
             return
+        if image.dtype == np.uint16:
+            # 16-bit: binned counts instead of one bar per value
+            histogram = LookupTable.histogram(image, bins=1024)
+            plt.figure(num="Image Histogram")
+            plt.stairs(histogram, np.linspace(0, 65536, len(histogram) + 1))
+            plt.xlabel("Intensity levels")
+            plt.ylabel("No. of pixels")
+            plt.show()
+            return
         # histogram = np.bincount(image[:, :, 2].ravel(), minlength=256)
         plt.figure(num="Image Histogram")
         plt.hist(image)
@@ -210,13 +558,16 @@ class ImageEditor(QMainWindow, Ui_MainWindow):
     @pyqtSlot()
     @is_image_loaded
     def log_transform(self):
-        self.set_previous_image()
-        self.current_image = ImageOperation.log_transform(self.current_image)
-        self.display_image()
+        self.run_operation("log_transform")
 
     @pyqtSlot()
     @is_image_loaded
     def gamma_transform(self):
+        if not isinstance(self.current_image, np.ndarray):
+            # 8-bit: pick the value on a sheet of previews
+            self.sweep_operation("gamma_transform")
+            return
+
         self.set_previous_image()
 
         # Create input dialog
@@ -232,31 +583,138 @@ class ImageEditor(QMainWindow, Ui_MainWindow):
             self.display_error_message("Please input right format for gamma value!")
             return
 
-        self.current_image = ImageOperation.gamma_transform(
-            self.current_image, gamma_value
+        self.current_image, box = self.edit_image(
+            "gamma_transform", gamma_value=gamma_value
+        )
+        self.display_image(box)
+
+    @is_image_loaded
+    @is_8bit_image
+    def sweep_operation(self, name: str, *args):
+        """
+        Show one operation over a range of values on a small proxy,
+        the picked value is applied at full resolution
+        """
+        sweep = ParameterSweep(self.current_image, name)
+        sweep.proxy = self.pending_orientation.apply(sweep.proxy)
+        dialog = SweepDialog(sweep, self)
+        if not dialog.exec_() or dialog.value is None:
+            return
+
+        self.set_previous_image()
+        self.current_image, box = self.edit_image(name, **sweep.params(dialog.value))
+        self.display_image(box)
+
+    @pyqtSlot()
+    @is_image_loaded
+    def blend_filter(self):
+        """
+        Mix a filter over the image with a blend mode and opacity,
+        inside the selection when there is one
+        """
+        specs = self.operations.group("filter")
+        label, ok = QInputDialog.getItem(
+            self, "Blend filter", "Filter:", [spec.label for spec in specs], 0, False
+        )
+        if not ok:
+            return
+        spec = specs[[spec.label for spec in specs].index(label)]
+        try:
+            spec.check(self.current_image)
+        except ValueError as error:
+            return self.display_error_message(str(error))
+
+        self.materialize_orientation()
+        self.start_operation(
+            self.current_image, None, spec.name, {}, partial(self.blend_filter_layer, spec)
+        )
+
+    def blend_filter_layer(self, spec, layer, box):
+        """
+        Open the layer dialog once blend_filter computed the filtered image
+        """
+        self.statusbar.clearMessage()
+        stack = LayerStack.from_image(self.current_image)
+        mask = None
+        if self.selection is not None:
+            mask = np.zeros((stack.height, stack.width), np.uint8)
+            left, top, right, bottom = self.selection.box
+            selected = self.selection.mask
+            mask[top:bottom, left:right] = 255 if selected is None else selected
+        stack.add_layer(layer, spec.label, opacity=0.5, mask=mask)
+        self.edit_layer(stack)
+
+    @pyqtSlot()
+    @is_image_loaded
+    def add_image_layer(self):
+        """
+        Put another image over this one, at the selection corner when there is one
+        """
+        image_path, _ = QFileDialog.getOpenFileName(
+            self, "Select layer image", "/", "Images (*.png *.tif *.tiff *.jpg *.jpeg)"
         )
+        if not image_path:
+            return
+        try:
+            image = ImageIO.open_image(image_path)
+        except OSError as error:
+            return self.display_error_message(str(error))
+
+        self.materialize_orientation()
+        stack = LayerStack.from_image(self.current_image)
+        offset = (0, 0) if self.selection is None else self.selection.box[:2]
+        stack.add_layer(image, pathlib.Path(image_path).name, offset=offset)
+        self.edit_layer(stack)
+
+    def edit_layer(self, stack: LayerStack):
+        """
+        Show the stack while the top layer is edited, flatten it on apply
+        """
+
+        stack.render()
+        # Display copy of the composite, only the re-rendered box is
+        # converted into it on every change
+        display = stack.display_pixels()
+        self.tile_view.set_image(display)
+
+        def show_stack():
+            _, box = stack.render()
+            if box is not None:
+                left, top, right, bottom = box
+                display[top:bottom, left:right] = stack.display_pixels(box)
+                self.tile_view.set_image(display, box)
+
+        dialog = LayerDialog(stack, self)
+        dialog.changed.connect(show_stack)
+        if dialog.exec_():
+            self.set_previous_image()
+            self.current_image = stack.flatten()
         self.display_image()
 
     @pyqtSlot()
     @is_image_loaded
     def invert_image(self):
-        self.set_previous_image()
-        self.current_image = ImageOperation.invert_image(self.current_image)
-        self.display_image()
+        self.run_operation("invert_image")
 
     @pyqtSlot()
     @is_image_loaded
     def transpose_image(self, direction: Image.Transpose, *args):
-        self.set_previous_image()
-        self.current_image = ImageOperation.transpose_image(
-            self.current_image, direction
+        # Nothing is copied: the previous state shares the same pixels
+        self.undo_button.setEnabled(True)
+        self.original_image_button.setEnabled(True)
+        self.previous_image = self.current_image
+        self.previous_orientation = self.pending_orientation
+        self.reset_adjustments()
+        self.pending_orientation = self.pending_orientation.then(
+            Orientation.from_transpose(direction)
         )
-        self.display_image()
+        self.display_orientation()
 
     @pyqtSlot()
     @is_image_loaded
+    @is_8bit_image
     def blur_image(self):
-        if type(self._image_blur) == list:
+        if not self.blur_adjusted:
             self.set_previous_image()
 
         blur_value = self.blur_slider.value()
@@ -269,16 +727,17 @@ class ImageEditor(QMainWindow, Ui_MainWindow):
         if blur_value == 0:
             return
 
-        self._image_blur = self.current_image
-        self.current_image = ImageOperation.blur_image(
-            self.previous_image, radius=blur_value
+        self.blur_adjusted = True
+        self.current_image, box = self.edit_image(
+            "blur_image", self.previous_image, radius=blur_value
         )
-        self.display_image()
+        self.display_image(box)
 
     @pyqtSlot()
     @is_image_loaded
+    @is_8bit_image
     def bright_image(self):
-        if type(self._image_bright) == list:
+        if not self.bright_adjusted:
             self.set_previous_image()
 
         value = self.bright_slider.value()
@@ -291,16 +750,17 @@ class ImageEditor(QMainWindow, Ui_MainWindow):
         if bright_value == 0:
             return
 
-        self._image_bright = self.current_image
-        self.current_image = ImageOperation.brightness_image(
-            self.previous_image, factor=bright_value
+        self.bright_adjusted = True
+        self.current_image, box = self.edit_image(
+            "brightness_image", self.previous_image, factor=bright_value
         )
-        self.display_image()
+        self.display_image(box)
 
     @pyqtSlot()
     @is_image_loaded
+    @is_8bit_image
     def color_image(self):
-        if type(self._image_bright) == list:
+        if not self.color_adjusted:
             self.set_previous_image()
 
         value = self.color_slider.value()
@@ -313,16 +773,17 @@ class ImageEditor(QMainWindow, Ui_MainWindow):
         if color_value == 0:
             return
 
-        self._image_bright = self.current_image
-        self.current_image = ImageOperation.color_image(
-            self.previous_image, factor=color_value
+        self.color_adjusted = True
+        self.current_image, box = self.edit_image(
+            "color_image", self.previous_image, factor=color_value
         )
-        self.display_image()
+        self.display_image(box)
 
     @pyqtSlot()
     @is_image_loaded
+    @is_8bit_image
     def contrast_image(self):
-        if type(self._image_contrast) == list:
+        if not self.contrast_adjusted:
             self.set_previous_image()
 
         value = self.contrast_slider.value()
@@ -335,16 +796,17 @@ class ImageEditor(QMainWindow, Ui_MainWindow):
         if contrast_value == 0:
             return
 
-        self._image_contrast = self.current_image
-        self.current_image = ImageOperation.color_image(
-            self.previous_image, factor=contrast_value
+        self.contrast_adjusted = True
+        self.current_image, box = self.edit_image(
+            "contrast_image", self.previous_image, factor=contrast_value
         )
-        self.display_image()
+        self.display_image(box)
 
     @pyqtSlot()
     @is_image_loaded
+    @is_8bit_image
     def sharpen_image(self):
-        if type(self._image_sharpen) == list:
+        if not self.sharpen_adjusted:
             self.set_previous_image()
 
         value = self.sharpen_slider.value()
@@ -357,105 +819,11 @@ class ImageEditor(QMainWindow, Ui_MainWindow):
         if sharpen_value == 0:
             return
 
-        self._image_contrast = self.current_image
-        self.current_image = ImageOperation.sharpen_image(
-            self.previous_image, factor=sharpen_value
-        )
-        self.display_image()
-
-    """
-    Filter
-    """
-
-    @pyqtSlot()
-    @is_image_loaded
-    def apply_pink_dream(self):
-        self.set_previous_image()
-        self.current_image = Image.fromarray(
-            EffectFilter.pink_dream(self.current_image)
-        )
-        self.display_image()
-
-    @pyqtSlot()
-    @is_image_loaded
-    def apply_cyperpunk(self):
-        self.set_previous_image()
-        self.current_image = Image.fromarray(
-            EffectFilter.cyperpunk_2077(self.current_image)
+        self.sharpen_adjusted = True
+        self.current_image, box = self.edit_image(
+            "sharpen_image", self.previous_image, factor=sharpen_value
         )
-        self.display_image()
-
-    @pyqtSlot()
-    @is_image_loaded
-    def apply_snowy(self):
-        self.set_previous_image()
-        self.current_image = Image.fromarray(
-            EffectFilter.snowy(self.current_image)
-        )
-        self.display_image()
-
-    @pyqtSlot()
-    @is_image_loaded
-    def apply_pastel(self):
-        self.set_previous_image()
-        self.current_image = Image.fromarray(
-            EffectFilter.pastel(self.current_image)
-        )
-        self.display_image()
-
-    @pyqtSlot()
-    @is_image_loaded
-    def apply_firestorm(self):
-        self.set_previous_image()
-        self.current_image = Image.fromarray(
-            EffectFilter.firestorm(self.current_image)
-        )
-        self.display_image()
-
-    @pyqtSlot()
-    @is_image_loaded
-    def apply_ice(self):
-        self.set_previous_image()
-        self.current_image = Image.fromarray(
-            EffectFilter.ice(self.current_image)
-        )
-        self.display_image()
-
-    @pyqtSlot()
-    @is_image_loaded
-    def apply_darkness(self):
-        self.set_previous_image()
-        self.current_image = Image.fromarray(
-            EffectFilter.darkness(self.current_image)
-        )
-        self.display_image()
-
-    @pyqtSlot()
-    @is_image_loaded
-    def apply_gray_nos(self):
-        self.set_previous_image()
-        self.current_image = Image.fromarray(
-            EffectFilter.gray_nostalgia(self.current_image)
-        )
-        self.display_image()
-
-    @pyqtSlot()
-    @is_image_loaded
-    def apply_sweet_dream(self):
-        self.set_previous_image()
-        self.current_image = Image.fromarray(
-            EffectFilter.sweet_dream(self.current_image)
-        )
-        self.display_image()
-
-    @pyqtSlot()
-    @is_image_loaded
-    def apply_cartoon(self):
-        self.set_previous_image()
-        self.current_image = Image.fromarray(
-            EffectFilter.cartoon(self.current_image)
-        )
-        self.display_image()
+        self.display_image(box)
 
     """
     App
@@ -481,6 +849,7 @@ class ImageEditor(QMainWindow, Ui_MainWindow):
         self.reset_slider_value()
         self.undo_button.setEnabled(True)
         self.current_image = self.previous_image
+        self.pending_orientation = self.previous_orientation
         self.display_image()
 
     @pyqtSlot()
@@ -488,6 +857,8 @@ class ImageEditor(QMainWindow, Ui_MainWindow):
         self.reset_slider_value()
         self.original_image_button.setEnabled(True)
         self.current_image = self.original_image
+        self.pending_orientation = Orientation()
+        self.pixels_edited = False
         self.display_image()
 
 
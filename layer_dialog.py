@@ -0,0 +1,69 @@
+from PyQt5.QtCore import Qt, pyqtSignal
+from PyQt5.QtWidgets import (
+    QComboBox,
+    QDialog,
+    QFormLayout,
+    QHBoxLayout,
+    QLabel,
+    QPushButton,
+    QSlider,
+    QVBoxLayout,
+)
+
+from models.layer_stack import LayerStack
+
+
+class LayerDialog(QDialog):
+    """
+    Dialog setting the blend mode and opacity of the top layer of a
+    LayerStack. changed is emitted on every edit, the editor then renders
+    the stack again, which only recomposites the tiles the layer covers
+    """
+
+    changed = pyqtSignal()
+
+    def __init__(self, stack: LayerStack, parent=None):
+        super().__init__(parent)
+        self.stack = stack
+        self.index = len(stack) - 1
+        layer = stack[self.index]
+        self.setWindowTitle(f"Layer: {layer.name}")
+
+        layout = QVBoxLayout(self)
+        form = QFormLayout()
+        self.blend_box = QComboBox(self)
+        for blend in LayerStack.BLEND_MODES:
+            self.blend_box.addItem(blend.capitalize(), blend)
+        self.blend_box.setCurrentIndex(LayerStack.BLEND_MODES.index(layer.blend))
+        self.blend_box.currentIndexChanged.connect(self.set_blend)
+        form.addRow("Blend mode:", self.blend_box)
+
+        opacity_row = QHBoxLayout()
+        self.opacity_slider = QSlider(Qt.Horizontal, self)
+        self.opacity_slider.setRange(0, 100)
+        self.opacity_slider.setValue(round(100 * layer.opacity))
+        self.opacity_slider.valueChanged.connect(self.set_opacity)
+        opacity_row.addWidget(self.opacity_slider)
+        self.opacity_label = QLabel(f"{self.opacity_slider.value()}%", self)
+        self.opacity_label.setMinimumWidth(40)
+        opacity_row.addWidget(self.opacity_label)
+        form.addRow("Opacity:", opacity_row)
+        layout.addLayout(form)
+
+        buttons = QHBoxLayout()
+        apply_button = QPushButton("Apply", self)
+        apply_button.clicked.connect(self.accept)
+        buttons.addWidget(apply_button)
+        cancel_button = QPushButton("Cancel", self)
+        cancel_button.clicked.connect(self.reject)
+        buttons.addWidget(cancel_button)
+        layout.addLayout(buttons)
+
+    def set_blend(self, *args):
+        self.stack.set_blend(self.index, self.blend_box.currentData())
+        self.changed.emit()
+
+    def set_opacity(self, value: int):
+        self.opacity_label.setText(f"{value}%")
+        self.stack.set_opacity(self.index, value / 100)
+        self.changed.emit()
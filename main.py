@@ -251,36 +251,6 @@ class Ui_MainWindow(object):
         self.groupBox.setObjectName("groupBox")
         self.verticalLayout_6 = QtWidgets.QVBoxLayout(self.groupBox)
         self.verticalLayout_6.setObjectName("verticalLayout_6")
-        self.pink_dream_filter_button = QtWidgets.QPushButton(self.groupBox)
-        self.pink_dream_filter_button.setObjectName("pink_dream_filter_button")
-        self.verticalLayout_6.addWidget(self.pink_dream_filter_button)
-        self.cyperpunk_filter_button = QtWidgets.QPushButton(self.groupBox)
-        self.cyperpunk_filter_button.setObjectName("cyperpunk_filter_button")
-        self.verticalLayout_6.addWidget(self.cyperpunk_filter_button)
-        self.snowy_filter_button = QtWidgets.QPushButton(self.groupBox)
-        self.snowy_filter_button.setObjectName("snowy_filter_button")
-        self.verticalLayout_6.addWidget(self.snowy_filter_button)
-        self.pastel_filter_button = QtWidgets.QPushButton(self.groupBox)
-        self.pastel_filter_button.setObjectName("pastel_filter_button")
-        self.verticalLayout_6.addWidget(self.pastel_filter_button)
-        self.firestorm_filter_button = QtWidgets.QPushButton(self.groupBox)
-        self.firestorm_filter_button.setObjectName("firestorm_filter_button")
-        self.verticalLayout_6.addWidget(self.firestorm_filter_button)
-        self.ice_filter_button = QtWidgets.QPushButton(self.groupBox)
-        self.ice_filter_button.setObjectName("ice_filter_button")
-        self.verticalLayout_6.addWidget(self.ice_filter_button)
-        self.darkness_filter_button = QtWidgets.QPushButton(self.groupBox)
-        self.darkness_filter_button.setObjectName("darkness_filter_button")
-        self.verticalLayout_6.addWidget(self.darkness_filter_button)
-        self.gray_nostalgia_filter_button = QtWidgets.QPushButton(self.groupBox)
-        self.gray_nostalgia_filter_button.setObjectName("gray_nostalgia_filter_button")
-        self.verticalLayout_6.addWidget(self.gray_nostalgia_filter_button)
-        self.sweet_dream_filter_button = QtWidgets.QPushButton(self.groupBox)
-        self.sweet_dream_filter_button.setObjectName("sweet_dream_filter_button")
-        self.verticalLayout_6.addWidget(self.sweet_dream_filter_button)
-        self.cartoon_filter_button = QtWidgets.QPushButton(self.groupBox)
-        self.cartoon_filter_button.setObjectName("cartoon_filter_button")
-        self.verticalLayout_6.addWidget(self.cartoon_filter_button)
         self.verticalLayout_5.addWidget(self.groupBox)
         self.stackedWidget.addWidget(self.page_3)
         self.horizontalLayoutWidget = QtWidgets.QWidget(self.centralwidget)
@@ -357,16 +327,6 @@ class Ui_MainWindow(object):
         self.rotate_right_button.setText(_translate("MainWindow", "Right 90"))
         self.pushButton.setText(_translate("MainWindow", "PushButton"))
         self.groupBox.setTitle(_translate("MainWindow", "Filter List"))
-        self.pink_dream_filter_button.setText(_translate("MainWindow", "Pink Dream"))
-        self.cyperpunk_filter_button.setText(_translate("MainWindow", "Cyperpunk 2077"))
-        self.snowy_filter_button.setText(_translate("MainWindow", "Snowy"))
-        self.pastel_filter_button.setText(_translate("MainWindow", "Pastel"))
-        self.firestorm_filter_button.setText(_translate("MainWindow", "Firestorm"))
-        self.ice_filter_button.setText(_translate("MainWindow", "Ice"))
-        self.darkness_filter_button.setText(_translate("MainWindow", "Darkness"))
-        self.gray_nostalgia_filter_button.setText(_translate("MainWindow", "Gray Nostalgia"))
-        self.sweet_dream_filter_button.setText(_translate("MainWindow", "Sweet Dream"))
-        self.cartoon_filter_button.setText(_translate("MainWindow", "Cartoon"))
         self.open_button.setText(_translate("MainWindow", "Open"))
         self.save_button.setText(_translate("MainWindow", "Save"))
         self.prev_page_button.setText(_translate("MainWindow", "Prev"))
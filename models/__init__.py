@@ -0,0 +1,3 @@
+# Part of the batch cache key (see BatchIndex), change it when operation
+# results change so cached outputs are not reused
+__version__ = "0.2.0"
@@ -0,0 +1,289 @@
+""" Flips, rotations, scales and crops folded into one affine resampling """
+import math
+
+import cv2
+import numpy as np
+from PIL import Image
+
+
+class AffineTransform:
+    """
+    Class accumulate geometric steps into one 3x3 matrix mapping input
+    coordinates to output coordinates, with the output size. apply() then
+    reads the image once: a single cv2.warpAffine (multithreaded by OpenCV)
+    computing only the output pixels, so a rotate followed by a resize
+    interpolates once and a crop costs nothing more.
+    Coordinates are continuous like in PIL: pixel (x, y) covers
+    [x, x + 1) x [y, y + 1). Steps follow the ImageOperation conventions
+    (rotate counter-clockwise with expand, resize by an integer radius).
+    A crop cuts the image to its box, which later steps (e.g. a larger
+    crop) must not bring back: every crop is kept as a clip, and apply()
+    blacks out the output pixels outside of it
+    """
+
+    # Image.Transpose -> (2x3 matrix for a (width, height) image, swaps axes)
+    TRANSPOSE_MATRICES = {
+        Image.Transpose.FLIP_LEFT_RIGHT: (lambda w, h: ((-1, 0, w), (0, 1, 0)), False),
+        Image.Transpose.FLIP_TOP_BOTTOM: (lambda w, h: ((1, 0, 0), (0, -1, h)), False),
+        Image.Transpose.ROTATE_90: (lambda w, h: ((0, 1, 0), (-1, 0, w)), True),
+        Image.Transpose.ROTATE_180: (lambda w, h: ((-1, 0, w), (0, -1, h)), False),
+        Image.Transpose.ROTATE_270: (lambda w, h: ((0, -1, h), (1, 0, 0)), True),
+        Image.Transpose.TRANSPOSE: (lambda w, h: ((0, 1, 0), (1, 0, 0)), True),
+        Image.Transpose.TRANSVERSE: (lambda w, h: ((0, -1, h), (-1, 0, w)), True),
+    }
+    QUARTER_TURNS = {
+        90: Image.Transpose.ROTATE_90,
+        180: Image.Transpose.ROTATE_180,
+        270: Image.Transpose.ROTATE_270,
+    }
+    STEPS = ("resize_image", "rotate_image", "transpose_image", "crop_image", "affine_transform")
+    PIL_MODES = ("L", "RGB", "RGBA", "I;16")
+    # Source pixels read around the needed box, for interpolation
+    MARGIN = 2
+
+    def __init__(
+        self,
+        size: tuple,
+        matrix: np.ndarray = None,
+        output_size: tuple = None,
+        clips: tuple = (),
+    ):
+        """
+        :param size: (width, height) of the input image
+        :param clips: (matrix from the input, (width, height)) of the images
+            cut by earlier crops
+        """
+        self.input_size = tuple(size)
+        self.matrix = np.eye(3) if matrix is None else matrix
+        self.size = tuple(output_size or size)
+        self.clips = tuple(clips)
+
+    def __repr__(self):
+        return f"AffineTransform({self.input_size} -> {self.size}, {self.matrix[:2].tolist()})"
+
+    def then(self, matrix, size: tuple) -> "AffineTransform":
+        """
+        Transform applying self first, then matrix (2x3 or 3x3) giving an image of size
+        """
+        matrix = np.vstack([np.asarray(matrix, dtype=np.float64)[:2], (0, 0, 1)])
+        return AffineTransform(self.input_size, matrix @ self.matrix, size, self.clips)
+
+    """
+    Steps
+    """
+
+    def transpose(self, direction: Image.Transpose) -> "AffineTransform":
+        make, swaps = self.TRANSPOSE_MATRICES[Image.Transpose(direction)]
+        width, height = self.size
+        return self.then(make(width, height), (height, width) if swaps else (width, height))
+
+    def rotate(self, degrees: float) -> "AffineTransform":
+        """
+        Counter-clockwise around the center, the output grows to hold the
+        whole rotated image (same size as Image.rotate with expand=True)
+        """
+        if degrees % 360 == 0:
+            return self
+        if degrees % 90 == 0:
+            return self.transpose(self.QUARTER_TURNS[degrees % 360])
+        angle = math.radians(degrees)
+        cos, sin = round(math.cos(angle), 15), round(math.sin(angle), 15)
+        width, height = self.size
+        center_x, center_y = width / 2, height / 2
+        # Size of the bounding box computed like Image.rotate, from its
+        # output to input matrix, so both give the same size
+        offset_x = cos * -center_x + -sin * -center_y + 0.0 + center_x
+        offset_y = sin * -center_x + cos * -center_y + 0.0 + center_y
+        corners = ((0, 0), (width, 0), (width, height), (0, height))
+        xs = [cos * x - sin * y + offset_x for x, y in corners]
+        ys = [sin * x + cos * y + offset_y for x, y in corners]
+        size = (
+            math.ceil(max(xs)) - math.floor(min(xs)),
+            math.ceil(max(ys)) - math.floor(min(ys)),
+        )
+        matrix = (
+            (cos, sin, size[0] / 2 - cos * center_x - sin * center_y),
+            (-sin, cos, size[1] / 2 + sin * center_x - cos * center_y),
+        )
+        return self.then(matrix, size)
+
+    def resize(self, size: tuple) -> "AffineTransform":
+        width, height = self.size
+        return self.then(((size[0] / width, 0, 0), (0, size[1] / height, 0)), size)
+
+    def reduce(self, radius: int) -> "AffineTransform":
+        """
+        Size divided by radius, like ImageOperation.resize_image
+        """
+        width, height = self.size
+        return self.resize((max(1, width // radius), max(1, height // radius)))
+
+    def crop(self, box: tuple) -> "AffineTransform":
+        """
+        :param box: (left, top, right, bottom), outside the image is black
+        """
+        left, top, right, bottom = box
+        transform = self.then(((1, 0, -left), (0, 1, -top)), (right - left, bottom - top))
+        transform.clips += ((transform.matrix, transform.size),)
+        return transform
+
+    def step(self, name: str, params: dict) -> "AffineTransform":
+        if name == "resize_image":
+            return self.reduce(params["radius"])
+        if name == "rotate_image":
+            return self.rotate(params["degrees"])
+        if name == "transpose_image":
+            return self.transpose(params["direction"])
+        if name == "crop_image":
+            return self.crop(params["box"])
+        if name == "affine_transform":
+            return self.steps(params["steps"])
+        raise ValueError(f"{name} is not a geometric operation")
+
+    def steps(self, steps) -> "AffineTransform":
+        transform = self
+        for name, params in steps:
+            transform = transform.step(name, params)
+        return transform
+
+    @classmethod
+    def from_steps(cls, size: tuple, steps) -> "AffineTransform":
+        """
+        :param steps: list of (name, params) of STEPS
+        """
+        return cls(size).steps(steps)
+
+    """
+    Resampling
+    """
+
+    def source_box(self) -> tuple:
+        """
+        Part of the input read to make the output, clipped to the image
+        :return: (left, top, right, bottom), empty when nothing is read
+        """
+        width, height = self.size
+        corners = np.linalg.inv(self.matrix) @ np.array(
+            [(0, width, width, 0), (0, 0, height, height), (1, 1, 1, 1)], dtype=np.float64
+        )
+        left = max(0, math.floor(corners[0].min() + 1e-6) - self.MARGIN)
+        top = max(0, math.floor(corners[1].min() + 1e-6) - self.MARGIN)
+        right = min(self.input_size[0], math.ceil(corners[0].max() - 1e-6) + self.MARGIN)
+        bottom = min(self.input_size[1], math.ceil(corners[1].max() - 1e-6) + self.MARGIN)
+        return left, top, max(left, right), max(top, bottom)
+
+    def pixel_copy(self):
+        """
+        :return: (source box, swaps axes, flips x, flips y) when the
+            transform only moves whole pixels, None otherwise
+        """
+        linear = self.matrix[:2, :2]
+        if not np.all(np.isin(linear, (-1, 0, 1))) or abs(np.linalg.det(linear)) != 1:
+            return None
+        offsets = self.matrix[:2, 2]
+        if not np.allclose(offsets, np.round(offsets), atol=1e-9):
+            return None
+        corners = np.rint(
+            np.linalg.inv(self.matrix)
+            @ np.array([(0, self.size[0]), (0, self.size[1]), (1, 1)], dtype=np.float64)
+        ).astype(int)
+        left, right = sorted(corners[0])
+        top, bottom = sorted(corners[1])
+        if left < 0 or top < 0 or right > self.input_size[0] or bottom > self.input_size[1]:
+            return None
+        swaps = linear[0, 1] != 0
+        flip_x = (linear[0, 1] if swaps else linear[0, 0]) < 0
+        flip_y = (linear[1, 0] if swaps else linear[1, 1]) < 0
+        return (left, top, right, bottom), swaps, flip_x, flip_y
+
+    def clip_mask(self):
+        """
+        :return: bool array of size, False where an earlier crop cut the
+            image away, None when no crop cuts the output
+        """
+        width, height = self.size
+        corners = np.array([(0, width, width, 0), (0, 0, height, height), (1, 1, 1, 1)])
+        to_input = np.linalg.inv(self.matrix)
+        mask = None
+        for matrix, (clip_width, clip_height) in self.clips:
+            x, y, _ = matrix @ to_input @ corners
+            if x.min() > -1e-6 and y.min() > -1e-6:
+                if x.max() < clip_width + 1e-6 and y.max() < clip_height + 1e-6:
+                    continue
+            # Pixels whose center falls in the clip, sampled like the image
+            inside = AffineTransform(
+                (clip_width, clip_height), self.matrix @ np.linalg.inv(matrix), self.size
+            ).apply_array(np.ones((clip_height, clip_width), np.uint8), cv2.INTER_NEAREST)
+            inside = inside.astype(bool)
+            mask = inside if mask is None else mask & inside
+        return mask
+
+    def apply_array(self, image: np.ndarray, interpolation: int = cv2.INTER_LINEAR) -> np.ndarray:
+        result = self.resample(image, interpolation)
+        mask = self.clip_mask()
+        if mask is None:
+            return result
+        clipped = np.zeros_like(result)
+        np.copyto(clipped, result, where=mask.reshape(mask.shape + (1,) * (result.ndim - 2)))
+        return clipped
+
+    def resample(self, image: np.ndarray, interpolation: int = cv2.INTER_LINEAR) -> np.ndarray:
+        width, height = self.size
+        copy = self.pixel_copy()
+        if copy is not None:
+            (left, top, right, bottom), swaps, flip_x, flip_y = copy
+            result = image[top:bottom, left:right]
+            if swaps:
+                result = result.swapaxes(0, 1)
+            if flip_x:
+                result = result[:, ::-1]
+            if flip_y:
+                result = result[::-1]
+            return np.ascontiguousarray(result)
+
+        left, top, right, bottom = self.source_box()
+        if right <= left or bottom <= top:
+            return np.zeros((height, width) + image.shape[2:], image.dtype)
+        source = image[top:bottom, left:right]
+        matrix = self.matrix @ np.array([(1, 0, left), (0, 1, top), (0, 0, 1)], dtype=np.float64)
+
+        # Interpolation reads 2x2 pixels: shrink by an integer factor first
+        # so every source pixel counts, as an area resize would
+        scale = math.sqrt(abs(np.linalg.det(matrix[:2, :2])))
+        factor = int(1 / scale) if scale < 0.5 else 1
+        if factor > 1:
+            source_height, source_width = source.shape[:2]
+            reduced = (max(1, source_width // factor), max(1, source_height // factor))
+            source = cv2.resize(source, reduced, interpolation=cv2.INTER_AREA)
+            matrix = matrix @ np.diag(
+                (source_width / reduced[0], source_height / reduced[1], 1.0)
+            )
+
+        # cv2 samples at pixel centers
+        to_center = np.array([(1, 0, 0.5), (0, 1, 0.5), (0, 0, 1)])
+        from_center = np.array([(1, 0, -0.5), (0, 1, -0.5), (0, 0, 1)])
+        matrix = from_center @ matrix @ to_center
+        result = cv2.warpAffine(
+            source,
+            matrix[:2],
+            (width, height),
+            flags=interpolation,
+            borderMode=cv2.BORDER_CONSTANT,
+            borderValue=0,
+        )
+        if image.ndim == 3 and result.ndim == 2:
+            result = result[:, :, None]
+        return result
+
+    def apply(self, image, interpolation: int = cv2.INTER_LINEAR):
+        """
+        Resample image once
+        :param image: Image object (PIL) or numpy array of input_size
+        :param interpolation: cv2 flag used for resampling
+        :return: Image object (PIL) or numpy array of size
+        """
+        if isinstance(image, np.ndarray):
+            return self.apply_array(image, interpolation)
+        if image.mode not in self.PIL_MODES:
+            image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+        return Image.fromarray(self.apply_array(np.asarray(image), interpolation), image.mode)
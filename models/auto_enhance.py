@@ -0,0 +1,179 @@
+""" Automatic levels, gamma and contrast from a pixel sample """
+import math
+import time
+
+import numpy as np
+from PIL import Image
+
+from models.lookup_table import LookupTable
+
+
+class AutoEnhance:
+    """
+    Class pick levels, gamma and contrast for an image from a random
+    sample of its pixels, so the analysis costs the same on any image size.
+    With n samples, every estimated percentile rank is within
+    rank_error = sqrt(ln(2 / alpha) / 2n) of the true one (DKW inequality)
+    and the mean luminance within mean_error = max * rank_error (Hoeffding),
+    with probability 1 - alpha.
+    The three corrections are folded into one lookup table, applied in a
+    single pass
+    """
+
+    SAMPLE_SIZE = 1 << 16
+    CONFIDENCE = 0.99
+    # Percentiles mapped to black and white
+    LOW_PERCENTILE = 0.5
+    HIGH_PERCENTILE = 99.5
+    # Black to white range never stretched by more than this factor
+    MAX_STRETCH = 4.0
+    TARGET_MEAN = 0.46
+    GAMMA_RANGE = (0.5, 2.0)
+    # Contrast is only raised, for flat images
+    TARGET_STD = 0.22
+    CONTRAST_RANGE = (1.0, 1.3)
+
+    @staticmethod
+    def sample(image, sample_size: int = SAMPLE_SIZE, seed: int = 0) -> np.ndarray:
+        """
+        :param image: Image object (PIL) or numpy array
+        :return: (n, channels) numpy array of pixels
+        """
+        rng = np.random.default_rng(seed)
+        if isinstance(image, np.ndarray):
+            height, width = image.shape[:2]
+            count = min(sample_size, width * height)
+            indices = rng.choice(width * height, count, replace=False)
+            pixels = image[indices // width, indices % width]
+            return pixels.reshape(count, -1)
+
+        if image.mode not in ("L", "RGB", "RGBA"):
+            image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+        width, height = image.size
+        if width * height <= sample_size:
+            return np.asarray(image).reshape(width * height, -1)
+
+        # Nearest neighbour resize reads one pixel per output pixel only:
+        # a grid starting at a random offset
+        scale = math.sqrt(sample_size / (width * height))
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        step_x, step_y = width / size[0], height / size[1]
+        left, top = rng.uniform(0, step_x), rng.uniform(0, step_y)
+        box = (left, top, left + width - step_x, top + height - step_y)
+        grid = image.resize(size, Image.Resampling.NEAREST, box=box)
+        return np.asarray(grid).reshape(size[0] * size[1], -1)
+
+    @staticmethod
+    def luminance(pixels: np.ndarray) -> np.ndarray:
+        """
+        ITU-R 601 luma like Image.convert("L"), alpha ignored
+        """
+        if pixels.shape[1] < 3:
+            return pixels[:, 0].astype(np.float64)
+        return pixels[:, :3].astype(np.float64) @ np.array([0.299, 0.587, 0.114])
+
+    @staticmethod
+    def solve_gamma(values: np.ndarray, target: float) -> float:
+        """
+        Gamma g with mean(values ^ g) = target, by bisection on log g
+        :param values: normalized values in [0, 1]
+        """
+        low, high = (math.log(bound) for bound in AutoEnhance.GAMMA_RANGE)
+        for _ in range(14):
+            middle = (low + high) / 2
+            # mean(values ^ g) decreases as g grows
+            if np.mean(np.power(values, math.exp(middle))) > target:
+                low = middle
+            else:
+                high = middle
+        return math.exp((low + high) / 2)
+
+    @staticmethod
+    def analyze(image, sample_size: int = SAMPLE_SIZE, seed: int = 0) -> dict:
+        """
+        Estimate statistics from a sample and derive the corrections
+        :return: dict with black, white, gamma, contrast, center (for table),
+            estimated mean and clipping fractions, error bounds and timing
+        """
+        start = time.perf_counter()
+        dtype = image.dtype if isinstance(image, np.ndarray) else np.uint8
+        max_value = LookupTable.max_value(dtype)
+        pixels = AutoEnhance.sample(image, sample_size, seed)
+        luma = AutoEnhance.luminance(pixels)
+        count = len(luma)
+        rank_error = math.sqrt(math.log(2 / (1 - AutoEnhance.CONFIDENCE)) / (2 * count))
+
+        black, white = np.percentile(
+            luma, (AutoEnhance.LOW_PERCENTILE, AutoEnhance.HIGH_PERCENTILE)
+        )
+        if white - black < max_value / AutoEnhance.MAX_STRETCH:
+            # Flat image: stretch around its middle by MAX_STRETCH at most
+            middle = (black + white) / 2
+            half = max_value / AutoEnhance.MAX_STRETCH / 2
+            black, white = max(0.0, middle - half), min(float(max_value), middle + half)
+        leveled = np.clip((luma - black) / (white - black), 0.0, 1.0)
+
+        gamma = AutoEnhance.solve_gamma(leveled, AutoEnhance.TARGET_MEAN)
+        corrected = np.power(leveled, gamma)
+        center = float(np.mean(corrected))
+        deviation = float(np.std(corrected))
+        contrast = AutoEnhance.TARGET_STD / deviation if deviation > 0 else 1.0
+        contrast = min(max(contrast, AutoEnhance.CONTRAST_RANGE[0]), AutoEnhance.CONTRAST_RANGE[1])
+
+        return {
+            "black": float(black),
+            "white": float(white),
+            "gamma": gamma,
+            "contrast": contrast,
+            "center": center,
+            "mean": float(np.mean(luma)),
+            "clipped_low": float(np.mean(luma <= 0)),
+            "clipped_high": float(np.mean(luma >= max_value)),
+            "samples": count,
+            "rank_error": rank_error,
+            "mean_error": max_value * rank_error,
+            "analysis_ms": 1000 * (time.perf_counter() - start),
+        }
+
+    @staticmethod
+    def table(analysis: dict, dtype=np.uint8) -> np.ndarray:
+        """
+        Levels, gamma and contrast as one table, rounded once
+        """
+        max_value = LookupTable.max_value(dtype)
+        black, white = analysis["black"], analysis["white"]
+        gamma, contrast, center = analysis["gamma"], analysis["contrast"], analysis["center"]
+
+        def enhance(values):
+            leveled = np.clip((values - black) / (white - black), 0.0, 1.0)
+            corrected = center + contrast * (np.power(leveled, gamma) - center)
+            return np.rint(max_value * np.clip(corrected, 0.0, 1.0))
+
+        return LookupTable.from_function(enhance, dtype)
+
+    @staticmethod
+    def apply(image, analysis: dict = None, in_place: bool = False):
+        """
+        Map the color channels through the table of analysis, alpha is kept
+        :param analysis: result of analyze, computed when None
+        :param in_place: a numpy image may be overwritten
+        :return: Image object (PIL) or numpy array
+        """
+        if analysis is None:
+            analysis = AutoEnhance.analyze(image)
+
+        if isinstance(image, np.ndarray):
+            table = AutoEnhance.table(analysis, image.dtype)
+            writable = in_place and image.flags.writeable and image.flags.c_contiguous
+            if image.ndim == 3 and image.shape[2] == 4:
+                output = image if writable else image.copy()
+                output[:, :, :3] = LookupTable.apply(np.ascontiguousarray(image[:, :, :3]), table)
+                return output
+            return LookupTable.apply(image, table, image if writable else None)
+
+        if image.mode not in ("L", "RGB", "RGBA"):
+            image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+        table = AutoEnhance.table(analysis, np.uint8).tolist()
+        bands = len(image.getbands())
+        alpha = list(range(256)) if bands == 4 else []
+        return image.point(table * min(bands, 3) + alpha)
@@ -0,0 +1,536 @@
+""" Persistent index of batch outputs for incremental re-runs """
+import argparse
+import filecmp
+import hashlib
+import json
+import os
+import pathlib
+import socket
+import sqlite3
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+
+from models import __version__
+from models.image_io import ImageIO
+from models.parallel import bounded_map
+from models.recipe import Recipe
+from models.recipe_optimizer import RecipeOptimizer
+
+
+class BatchIndex:
+    """
+    Class keep a sqlite index of batch results keyed by
+    (input content digest, recipe digest, library version):
+    - outputs: final output file of an input run through a recipe, with its
+      size and mtime so a file written over since (e.g. by another recipe
+      with the same output path) no longer counts as cached
+    - stages: cached intermediate image after the first steps of a recipe,
+      keyed by the digest of those steps
+    - inputs: content digest of a file by path, size and mtime, so
+      unchanged files are not hashed again
+    - claims: inputs being processed, so several processes sharing the
+      index do not run the same work
+    The database runs in WAL mode, every process and thread opens its own
+    connection. Rows are written only after their file is in place, and
+    reconcile() drops rows whose file went missing after a crash
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS outputs (
+        input_digest TEXT, recipe_digest TEXT, version TEXT,
+        path TEXT, size INTEGER, mtime_ns INTEGER, created REAL,
+        PRIMARY KEY (input_digest, recipe_digest, version)
+    );
+    CREATE TABLE IF NOT EXISTS stages (
+        input_digest TEXT, prefix_digest TEXT, version TEXT,
+        path TEXT, size INTEGER, mtime_ns INTEGER, mode TEXT, created REAL,
+        PRIMARY KEY (input_digest, prefix_digest, version)
+    );
+    CREATE TABLE IF NOT EXISTS inputs (
+        path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, digest TEXT
+    );
+    CREATE TABLE IF NOT EXISTS claims (
+        input_digest TEXT, recipe_digest TEXT, version TEXT,
+        owner TEXT, claimed REAL,
+        PRIMARY KEY (input_digest, recipe_digest, version)
+    );
+    """
+
+    # Seconds after which the claim of a worker on another host is stale
+    CLAIM_LEASE = 3600.0
+
+    def __init__(self, path, version: str = __version__, timeout: float = 60.0):
+        self.path = pathlib.Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.version = version
+        self.timeout = timeout
+        self._local = threading.local()
+        connection = self.connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(self.SCHEMA)
+        for table in ("outputs", "stages"):
+            columns = [row[1] for row in connection.execute(f"PRAGMA table_info({table})")]
+            if "mtime_ns" not in columns:
+                # Index written by an older version, its rows no longer validate
+                connection.execute(f"ALTER TABLE {table} ADD COLUMN mtime_ns INTEGER")
+
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # Autocommit, writes use explicit BEGIN IMMEDIATE transactions
+            connection = sqlite3.connect(str(self.path), timeout=self.timeout, isolation_level=None)
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def write(self, sql: str, params=()):
+        connection = self.connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            cursor = connection.execute(sql, params)
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return cursor
+
+    @property
+    def owner(self) -> str:
+        """
+        Claim owner: host, process and thread, so two threads of a process
+        do not take the same work
+        """
+        return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+    def close(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    """
+    Inputs
+    """
+
+    @staticmethod
+    def file_digest(path) -> str:
+        digest = hashlib.sha256()
+        with open(path, "rb") as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def input_digest(self, path) -> str:
+        """
+        Content digest of a file, hashed again only when size or mtime changed
+        """
+        path = str(pathlib.Path(path).resolve())
+        stat = os.stat(path)
+        row = self.connection().execute(
+            "SELECT digest FROM inputs WHERE path = ? AND size = ? AND mtime_ns = ?",
+            (path, stat.st_size, stat.st_mtime_ns),
+        ).fetchone()
+        if row is not None:
+            return row[0]
+        digest = self.file_digest(path)
+        self.write(
+            "INSERT OR REPLACE INTO inputs VALUES (?, ?, ?, ?)",
+            (path, stat.st_size, stat.st_mtime_ns, digest),
+        )
+        return digest
+
+    """
+    Outputs and stages
+    """
+
+    @staticmethod
+    def is_valid(path: str, size: int, mtime_ns: int) -> bool:
+        """
+        :return: whether the file at path is still the one recorded, a file
+            written over since has another mtime even with the same size
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        return stat.st_size == size and stat.st_mtime_ns == mtime_ns
+
+    def lookup(self, input_digest: str, recipe_digest: str):
+        """
+        :return: path of the cached output, None when missing or changed
+        """
+        row = self.connection().execute(
+            "SELECT path, size, mtime_ns FROM outputs"
+            " WHERE input_digest = ? AND recipe_digest = ? AND version = ?",
+            (input_digest, recipe_digest, self.version),
+        ).fetchone()
+        if row is None or not self.is_valid(*row):
+            return None
+        return row[0]
+
+    def record(self, input_digest: str, recipe_digest: str, path):
+        path = str(path)
+        stat = os.stat(path)
+        self.write(
+            "INSERT OR REPLACE INTO outputs"
+            " (input_digest, recipe_digest, version, path, size, mtime_ns, created)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                input_digest,
+                recipe_digest,
+                self.version,
+                path,
+                stat.st_size,
+                stat.st_mtime_ns,
+                time.time(),
+            ),
+        )
+
+    def lookup_stage(self, input_digest: str, prefix_digest: str):
+        """
+        :return: (path, mode) of a cached stage, None when missing
+        """
+        row = self.connection().execute(
+            "SELECT path, size, mtime_ns, mode FROM stages"
+            " WHERE input_digest = ? AND prefix_digest = ? AND version = ?",
+            (input_digest, prefix_digest, self.version),
+        ).fetchone()
+        if row is None or not self.is_valid(*row[:3]):
+            return None
+        return row[0], row[3]
+
+    def record_stage(self, input_digest: str, prefix_digest: str, path, mode: str = None):
+        path = str(path)
+        stat = os.stat(path)
+        self.write(
+            "INSERT OR REPLACE INTO stages"
+            " (input_digest, prefix_digest, version, path, size, mtime_ns, mode, created)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                input_digest,
+                prefix_digest,
+                self.version,
+                path,
+                stat.st_size,
+                stat.st_mtime_ns,
+                mode,
+                time.time(),
+            ),
+        )
+
+    def temp_name(self, name: str) -> str:
+        """
+        :return: name of the temporary file a write of name goes through,
+            tagged with the writer so reconcile() leaves live writes alone
+        """
+        return f"{name}.{socket.gethostname()}-{os.getpid()}-{threading.get_ident()}.tmp"
+
+    def is_stale_temp(self, path) -> bool:
+        """
+        :return: whether the writer of a temp_name() file is gone, for files
+            of another host or without a writer tag: older than the lease
+        """
+        modified = os.path.getmtime(path)
+        tag = os.path.basename(path)[: -len(".tmp")].partition(".")[2]
+        host, _, pid = tag.rpartition("-")[0].rpartition("-")
+        if not host:
+            return time.time() - modified > self.CLAIM_LEASE
+        return self.is_stale(f"{host}:{pid}", modified)
+
+    """
+    Claims
+    """
+
+    def is_stale(self, owner: str, claimed: float) -> bool:
+        """
+        :param owner: host:pid, or host:pid:thread of owner
+        """
+        host, pid = (owner.split(":") + [""])[:2]
+        if host != socket.gethostname():
+            return time.time() - claimed > self.CLAIM_LEASE
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except (PermissionError, ValueError):
+            return False
+        return False
+
+    def claim(self, input_digest: str, recipe_digest: str) -> bool:
+        """
+        Take the work of an input, False when a live worker already has it.
+        Claims of dead processes are taken over
+        """
+        key = (input_digest, recipe_digest, self.version)
+        connection = self.connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute(
+                "SELECT owner, claimed FROM claims"
+                " WHERE input_digest = ? AND recipe_digest = ? AND version = ?",
+                key,
+            ).fetchone()
+            taken = row is None or row[0] == self.owner or self.is_stale(*row)
+            if taken:
+                connection.execute(
+                    "INSERT OR REPLACE INTO claims VALUES (?, ?, ?, ?, ?)",
+                    key + (self.owner, time.time()),
+                )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return taken
+
+    def release(self, input_digest: str, recipe_digest: str):
+        self.write(
+            "DELETE FROM claims WHERE input_digest = ? AND recipe_digest = ? AND version = ?"
+            " AND owner = ?",
+            (input_digest, recipe_digest, self.version, self.owner),
+        )
+
+    """
+    Maintenance
+    """
+
+    def reconcile(self, stage_dir=None) -> dict:
+        """
+        Make the index agree with the disk after a crash: drop rows whose
+        file is missing or was written over, stale claims and, in
+        stage_dir, temporary files of writers that are gone
+        :return: dict of removed counts
+        """
+        connection = self.connection()
+        removed = {"outputs": 0, "stages": 0, "claims": 0, "temp_files": 0}
+        for table in ("outputs", "stages"):
+            for rowid, path, size, mtime_ns in connection.execute(
+                f"SELECT rowid, path, size, mtime_ns FROM {table}"
+            ).fetchall():
+                if not self.is_valid(path, size, mtime_ns):
+                    self.write(f"DELETE FROM {table} WHERE rowid = ?", (rowid,))
+                    removed[table] += 1
+        for rowid, owner, claimed in connection.execute(
+            "SELECT rowid, owner, claimed FROM claims"
+        ).fetchall():
+            if self.is_stale(owner, claimed):
+                self.write("DELETE FROM claims WHERE rowid = ?", (rowid,))
+                removed["claims"] += 1
+        if stage_dir is not None and os.path.isdir(stage_dir):
+            for name in os.listdir(stage_dir):
+                if not name.endswith(".tmp"):
+                    continue
+                path = os.path.join(stage_dir, name)
+                try:
+                    if self.is_stale_temp(path):
+                        os.remove(path)
+                        removed["temp_files"] += 1
+                except FileNotFoundError:
+                    # Renamed in place by its writer meanwhile
+                    pass
+        return removed
+
+    def stats(self) -> dict:
+        connection = self.connection()
+        return {
+            table: connection.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            for table in ("outputs", "stages", "inputs", "claims")
+        }
+
+
+class IncrementalBatch:
+    """
+    Class run a Recipe over a directory tree, skipping inputs whose output
+    for the same content, recipe and version is already in the BatchIndex.
+    The image after an expensive step is kept as a stage, so a recipe
+    whose later steps changed resumes from the longest cached prefix
+    """
+
+    # Steps costing at least this (RecipeOptimizer.COSTS) get a stage
+    STAGE_COST = 10.0
+    INDEX_NAME = ".batch-index.sqlite"
+    # Seconds between tries of inputs claimed by another worker
+    CLAIM_POLL = 0.2
+
+    def __init__(self, recipe: Recipe, output_dir, index: BatchIndex = None, stage_dir=None):
+        self.recipe = recipe
+        self.steps = list(recipe)
+        self.digest = recipe.digest()
+        self.output_dir = pathlib.Path(output_dir)
+        self.index = index or BatchIndex(self.output_dir / self.INDEX_NAME)
+        self.stage_dir = pathlib.Path(stage_dir or self.output_dir / ".stages")
+        self.stage_dir.mkdir(parents=True, exist_ok=True)
+        self.extensions = Image.registered_extensions()
+        # Error message by input path of the inputs that failed
+        self.errors = {}
+
+    def stage_points(self) -> list:
+        """
+        :return: step counts k after which the image is kept, last step excluded
+        """
+        return [
+            count
+            for count, (name, _) in enumerate(self.steps[:-1], start=1)
+            if RecipeOptimizer.COSTS.get(name, RecipeOptimizer.DEFAULT_COST) >= self.STAGE_COST
+        ]
+
+    def prefix_digest(self, count: int) -> str:
+        return Recipe(self.steps[:count]).digest()
+
+    """
+    Files
+    """
+
+    @staticmethod
+    def replace(temp_path: pathlib.Path, path: pathlib.Path, data: bytes):
+        with open(temp_path, "wb") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, path)
+
+    def write_output(self, image, path: pathlib.Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        image_format = self.extensions.get(path.suffix.lower(), "PNG")
+        data = ImageIO.encode_bytes(image, image_format)
+        self.replace(path.with_name("." + self.index.temp_name(path.name)), path, data)
+
+    def save_stage(self, input_digest: str, count: int, image):
+        prefix = self.prefix_digest(count)
+        name = hashlib.sha1(f"{input_digest}:{prefix}:{self.index.version}".encode()).hexdigest()
+        path = self.stage_dir / f"{name}.npy"
+        temp_path = self.stage_dir / self.index.temp_name(name)
+        with open(temp_path, "wb") as file:
+            np.save(file, np.asarray(image))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, path)
+        mode = None if isinstance(image, np.ndarray) else image.mode
+        self.index.record_stage(input_digest, prefix, path, mode)
+
+    def load_stage(self, input_digest: str):
+        """
+        :return: (steps already done, image), (0, None) without a cached stage
+        """
+        for count in reversed(self.stage_points()):
+            found = self.index.lookup_stage(input_digest, self.prefix_digest(count))
+            if found is None:
+                continue
+            path, mode = found
+            array = np.load(path)
+            return count, array if mode is None else Image.fromarray(array, mode)
+        return 0, None
+
+    """
+    Running
+    """
+
+    def process(self, item: tuple) -> str:
+        """
+        :param item: (input path, output path)
+        :return: "skipped", "copied", "resumed", "processed", "claimed" or
+            "failed", the error of a failed input is kept in errors
+        """
+        source, output = item
+        try:
+            input_digest = self.index.input_digest(source)
+            cached = self.index.lookup(input_digest, self.digest)
+            if cached is not None:
+                if os.path.abspath(cached) == os.path.abspath(output) or (
+                    os.path.isfile(output) and filecmp.cmp(cached, output, shallow=False)
+                ):
+                    return "skipped"
+                # Same content under another name
+                with open(cached, "rb") as file:
+                    data = file.read()
+                output.parent.mkdir(parents=True, exist_ok=True)
+                self.replace(output.with_name("." + self.index.temp_name(output.name)), output, data)
+                return "copied"
+
+            if not self.index.claim(input_digest, self.digest):
+                return "claimed"
+            try:
+                done, image = self.load_stage(input_digest)
+                status = "resumed" if done else "processed"
+                if image is None:
+                    image = ImageIO.open_image(source)
+                stage_points = set(self.stage_points())
+                for count in range(done + 1, len(self.steps) + 1):
+                    name, params = self.steps[count - 1]
+                    # The decoded or loaded image is ours, steps may write over it
+                    image = Recipe.run_step(image, name, params, in_place=True)
+                    if count in stage_points:
+                        self.save_stage(input_digest, count, image)
+                self.write_output(image, output)
+                self.index.record(input_digest, self.digest, output)
+                return status
+            finally:
+                self.index.release(input_digest, self.digest)
+        except Exception as error:
+            self.errors[str(source)] = f"{type(error).__name__}: {error}"
+            return "failed"
+
+    def items(self, input_dir, output_format: str = None):
+        input_dir = pathlib.Path(input_dir)
+        for path in sorted(input_dir.rglob("*")):
+            if path.name.startswith(".") or path.suffix.lower() not in self.extensions:
+                continue
+            if self.output_dir.resolve() in path.resolve().parents:
+                continue
+            relative = path.relative_to(input_dir)
+            if output_format:
+                relative = relative.with_suffix(output_format)
+            yield path, self.output_dir / relative
+
+    def run(self, input_dir, workers: int = None, output_format: str = None) -> dict:
+        """
+        Inputs whose content another worker is processing are tried again
+        once the rest is done, until its output can be copied or the claim
+        is released or stale
+        :return: dict of counts per status and seconds, with errors by input
+            path when some failed
+        """
+        start = time.perf_counter()
+        self.errors = {}
+        self.index.reconcile(self.stage_dir)
+        counts = {}
+        claimed = []
+        items = self.items(input_dir, output_format)
+        while True:
+            for item, status in bounded_map(
+                lambda item: (item, self.process(item)), items, workers, ordered=False
+            ):
+                if status == "claimed":
+                    claimed.append(item)
+                else:
+                    counts[status] = counts.get(status, 0) + 1
+            if not claimed:
+                break
+            items, claimed = claimed, []
+            time.sleep(self.CLAIM_POLL)
+        counts["seconds"] = time.perf_counter() - start
+        if self.errors:
+            counts["errors"] = dict(self.errors)
+        return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a recipe on a folder, skipping done work")
+    parser.add_argument("input_dir")
+    parser.add_argument("recipe", help="recipe JSON file")
+    parser.add_argument("--output", required=True)
+    parser.add_argument("--index", help="index database, in the output directory by default")
+    parser.add_argument("--stages", help="stage directory, in the output directory by default")
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--format", help="output suffix, e.g. .png")
+    args = parser.parse_args()
+
+    index = BatchIndex(args.index) if args.index else None
+    batch = IncrementalBatch(Recipe.load(args.recipe), args.output, index, args.stages)
+    print(json.dumps(batch.run(args.input_dir, args.workers, args.format)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,315 @@
+""" Operations on stacks of same size images """
+import argparse
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from models.colormap_filter import ColormapFilter
+from models.lookup_table import LookupTable
+from models.recipe import Recipe
+
+
+class BatchOperation:
+    """
+    Class run operations on a batch: a (N, H, W, C) or (N, H, W) uint8 array
+    of N images with the same size, in RGB(A) order like np.array(Image).
+    Point operations and colormaps run once over the whole batch; the other
+    operations fall back to running on every image. Results are the same
+    as the per image ImageOperation / EffectFilter calls.
+    With in_place=True the batch is given away and point operations write
+    their result over it
+    """
+
+    @staticmethod
+    def stack(images) -> np.ndarray:
+        """
+        :param images: Image objects (PIL) or numpy arrays of the same size
+        :return: numpy array (N, H, W[, C])
+        """
+        arrays = [np.asarray(image) for image in images]
+        if not arrays:
+            raise ValueError("Empty batch")
+        shape = arrays[0].shape
+        for array in arrays:
+            if array.shape != shape or array.dtype != np.uint8:
+                raise ValueError(f"Batch images differ: {array.shape} {array.dtype} and {shape}")
+        return np.stack(arrays)
+
+    @staticmethod
+    def unstack(batch: np.ndarray) -> list:
+        """
+        :return: list of Image objects (PIL)
+        """
+        return [Image.fromarray(image) for image in batch]
+
+    @staticmethod
+    def check_batch(batch: np.ndarray) -> np.ndarray:
+        if batch.dtype != np.uint8 or batch.ndim not in (3, 4):
+            raise TypeError(f"Expected (N, H, W[, C]) uint8 batch, got {batch.shape} {batch.dtype}")
+        return np.ascontiguousarray(batch)
+
+    @staticmethod
+    def channels(batch: np.ndarray) -> int:
+        return 1 if batch.ndim == 3 else batch.shape[3]
+
+    @staticmethod
+    def drop_alpha(batch: np.ndarray) -> np.ndarray:
+        if BatchOperation.channels(batch) == 4:
+            return np.ascontiguousarray(batch[..., :3])
+        return batch
+
+    @staticmethod
+    def apply_table(batch: np.ndarray, table: np.ndarray, in_place: bool = False) -> np.ndarray:
+        """
+        Map every value of the batch through a 256 entries table, one pass.
+        The batch is seen as one tall 2-D image so cv2.LUT runs once
+        """
+        batch = BatchOperation.check_batch(batch)
+        flat = batch.reshape(batch.shape[0] * batch.shape[1], -1)
+        table = np.asarray(table, dtype=np.uint8)
+        out = flat if in_place and batch.flags.writeable else None
+        return cv2.LUT(flat, table, dst=out).reshape(batch.shape)
+
+    @staticmethod
+    def apply_lookup_table(batch: np.ndarray, table, in_place: bool = False) -> np.ndarray:
+        table = np.asarray(table).astype(np.uint8)
+        if len(table) != 256:
+            raise ValueError(f"Table of {len(table)} entries for uint8 batch")
+        return BatchOperation.apply_table(batch, table, in_place)
+
+    @staticmethod
+    def invert_image(batch: np.ndarray, in_place: bool = False) -> np.ndarray:
+        batch = BatchOperation.drop_alpha(BatchOperation.check_batch(batch))
+        return np.invert(batch, out=batch if in_place and batch.flags.writeable else None)
+
+    @staticmethod
+    def gamma_transform(batch: np.ndarray, gamma_value: float, in_place: bool = False) -> np.ndarray:
+        return BatchOperation.apply_table(batch, LookupTable.gamma(gamma_value, np.uint8), in_place)
+
+    @staticmethod
+    def brightness_image(batch: np.ndarray, factor: float, in_place: bool = False) -> np.ndarray:
+        return BatchOperation.apply_table(batch, LookupTable.brightness(factor, np.uint8), in_place)
+
+    @staticmethod
+    def log_transform(batch: np.ndarray, scale: float = 1.0, in_place: bool = False) -> np.ndarray:
+        """
+        The log table depends on the maximum of each image, images are
+        grouped by maximum and every group is mapped in one pass
+        """
+        batch = BatchOperation.drop_alpha(BatchOperation.check_batch(batch))
+        maxima = batch.reshape(batch.shape[0], -1).max(axis=1)
+        result = batch if in_place and batch.flags.writeable else np.empty_like(batch)
+        for max_input in np.unique(maxima):
+            group = maxima == max_input
+            table = LookupTable.log(int(max_input), np.uint8, scale)
+            result[group] = BatchOperation.apply_table(batch[group], table)
+        return result
+
+    @staticmethod
+    def colormap_filter(batch: np.ndarray, spec) -> np.ndarray:
+        """
+        Colormap filter over the batch. Gray conversion and the table pass
+        are per pixel and run on the whole batch; median and post stages
+        need neighbours and run per image
+        :param spec: registered filter name or filter dict
+        """
+        batch = BatchOperation.check_batch(batch)
+        spec_dict, table = ColormapFilter.resolve(spec)
+        count, height = batch.shape[:2]
+        gray, median = ColormapFilter.input_stage(spec)
+
+        # Stacked vertically the batch is one tall image for per pixel steps
+        tall = batch.reshape(count * height, *batch.shape[2:])
+        if gray and tall.ndim == 3:
+            tall = cv2.cvtColor(tall, cv2.COLOR_BGR2GRAY)
+        if median:
+            tall = np.concatenate(
+                [cv2.medianBlur(image, median) for image in np.split(tall, count)]
+            )
+        tall = cv2.applyColorMap(tall, table)
+        images = tall.reshape(count, height, *tall.shape[1:])
+
+        post = spec_dict.get("post", ())
+        if not post:
+            return images
+        finished = []
+        for image in images:
+            for stage in post:
+                name, params = ColormapFilter.parse_stage(stage)
+                image = ColormapFilter.POST_STAGES[name](image, params)
+            finished.append(image)
+        return np.stack(finished)
+
+    # Recipe operation name: batched implementation
+    BATCHED = {
+        "invert_image": invert_image.__func__,
+        "gamma_transform": gamma_transform.__func__,
+        "log_transform": log_transform.__func__,
+        "apply_lookup_table": apply_lookup_table.__func__,
+        "brightness_image": brightness_image.__func__,
+        "colormap_filter": colormap_filter.__func__,
+    }
+
+    # Batched operations taking in_place=True
+    IN_PLACE = (
+        "invert_image",
+        "gamma_transform",
+        "log_transform",
+        "apply_lookup_table",
+        "brightness_image",
+    )
+
+    @staticmethod
+    def can_batch(batch: np.ndarray, name: str) -> bool:
+        if name in ColormapFilter.FILTERS:
+            return True
+        if name == "brightness_image":
+            # Same as ImageEnhance for L and RGB only
+            return BatchOperation.channels(batch) in (1, 3)
+        return name in BatchOperation.BATCHED
+
+    @staticmethod
+    def per_image(batch: np.ndarray, name: str, params: dict) -> np.ndarray:
+        """
+        Fallback: run the operation on every image
+        """
+        return BatchOperation.stack(
+            [np.asarray(Recipe.run_step(Image.fromarray(image), name, params)) for image in batch]
+        )
+
+    @staticmethod
+    def apply(batch: np.ndarray, name: str, params: dict = None, in_place: bool = False) -> np.ndarray:
+        """
+        Run one recipe operation on the batch
+        :param name: operation name of Recipe.OPERATIONS
+        :param in_place: batch may be overwritten by point operations
+        :return: numpy array (N, H', W'[, C'])
+        """
+        params = params or {}
+        checked = BatchOperation.check_batch(batch)
+        # check_batch copies a non contiguous batch, that copy may be overwritten
+        in_place = in_place or checked is not batch
+        batch = checked
+        if not BatchOperation.can_batch(batch, name):
+            return BatchOperation.per_image(batch, name, params)
+        if name in ColormapFilter.FILTERS:
+            return BatchOperation.colormap_filter(batch, name)
+        if in_place and name in BatchOperation.IN_PLACE:
+            params = dict(params, in_place=True)
+        return BatchOperation.BATCHED[name](batch, **params)
+
+    @staticmethod
+    def apply_recipe(batch: np.ndarray, recipe: Recipe, in_place: bool = False) -> np.ndarray:
+        """
+        Copy on write like Recipe.apply: the first step copies the batch
+        unless in_place, later steps overwrite the batches made on the way
+        """
+        source = batch
+        owned = in_place
+        for name, params in recipe:
+            batch = BatchOperation.apply(batch, name, params, owned)
+            owned = owned or not Recipe.shares_buffer(batch, source)
+        return batch
+
+    @staticmethod
+    def peak_allocation(func) -> int:
+        """
+        Most bytes allocated at once while func runs (numpy and OpenCV
+        arrays included)
+        """
+        started = tracemalloc.is_tracing()
+        if not started:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+        if not started:
+            tracemalloc.stop()
+        return peak - baseline
+
+    @staticmethod
+    def compare(
+        batch: np.ndarray, name: str, params: dict = None, repeat: int = 3, in_place: bool = False
+    ) -> dict:
+        """
+        Time the batched call against one call per image. Allocations of the
+        batched call are counted in image sized buffers; the per image calls
+        allocate in PIL, which tracemalloc does not see
+        :param in_place: run the batched call on a copy it may overwrite
+        :return: dict with per image milliseconds, speedup and buffers
+        """
+        params = params or {}
+        images = BatchOperation.unstack(batch)
+        image_bytes = batch[0].nbytes
+
+        def run_batch():
+            # The copy given away is made before the measure
+            source = batch.copy() if in_place else batch
+            return lambda: BatchOperation.apply(source, name, params, in_place)
+
+        def best(make) -> float:
+            times = []
+            for _ in range(repeat):
+                func = make()
+                start = time.perf_counter()
+                func()
+                times.append(time.perf_counter() - start)
+            return min(times)
+
+        batched = best(run_batch)
+        looped = best(lambda: lambda: [Recipe.run_step(image, name, params) for image in images])
+        batch_bytes = BatchOperation.peak_allocation(run_batch())
+        count = len(images)
+        return {
+            "op": name,
+            "images": count,
+            "batched": BatchOperation.can_batch(batch, name),
+            "batch_ms_per_image": 1000 * batched / count,
+            "loop_ms_per_image": 1000 * looped / count,
+            "speedup": looped / batched if batched else float("inf"),
+            "buffers_per_image": batch_bytes / count / image_bytes,
+        }
+
+
+def format_report(rows: list) -> str:
+    lines = [
+        f"{'operation':<20} {'batched':>7} {'batch ms':>9} {'loop ms':>9} {'speedup':>8}"
+        f" {'buffers':>8}"
+    ]
+    for row in rows:
+        lines.append(
+            f"{row['op']:<20} {str(row['batched']):>7} {row['batch_ms_per_image']:>9.3f}"
+            f" {row['loop_ms_per_image']:>9.3f} {row['speedup']:>7.1f}x"
+            f" {row['buffers_per_image']:>8.2f}"
+        )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare batched and per image operations")
+    parser.add_argument("image")
+    parser.add_argument("recipe", help="recipe JSON file")
+    parser.add_argument("--count", type=int, default=32, help="images in the batch")
+    parser.add_argument("--size", type=int, nargs=2, metavar=("WIDTH", "HEIGHT"))
+    parser.add_argument(
+        "--in-place", action="store_true", help="batched calls may overwrite their input"
+    )
+    args = parser.parse_args()
+
+    image = Image.open(args.image).convert("RGB")
+    if args.size:
+        image = image.resize(tuple(args.size))
+    batch = BatchOperation.stack([image] * args.count)
+    rows = [
+        BatchOperation.compare(batch, name, params, in_place=args.in_place)
+        for name, params in Recipe.load(args.recipe)
+    ]
+    print(format_report(rows))
+
+
+if __name__ == "__main__":
+    main()
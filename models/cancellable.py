@@ -0,0 +1,173 @@
+""" Cancellable operations run in strips with progress reporting """
+import math
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+
+from models.parallel import bounded_map
+from models.recipe import Recipe
+from models.region_edit import RegionEdit
+
+
+class OperationCancelled(Exception):
+    """
+    The operation was stopped through its CancelToken
+    """
+
+
+class CancelToken:
+    """
+    Flag shared between the thread running an operation and the one that
+    may stop it
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def check(self):
+        if self._event.is_set():
+            raise OperationCancelled()
+
+
+class ChunkedOperation:
+    """
+    Class run a Recipe operation on horizontal strips of the image so it
+    can be cancelled between strips and report its progress.
+    Each strip is processed with the halo the operation reads around a
+    pixel (RegionEdit.HALOS), so the assembled result is the same as one
+    call on the whole image. Operations needing the whole image (no halo
+    in RegionEdit.HALOS, or geometry) run as a single chunk
+    """
+
+    # Strips per image, for progress steps and cancel latency
+    TARGET_STRIPS = 16
+    MIN_ROWS = 64
+    # Strips are at least this many halos high, to bound the overlap work
+    HALO_FACTOR = 4
+
+    def __init__(
+        self,
+        token: CancelToken = None,
+        on_progress=None,
+        workers: int = None,
+        split: bool = True,
+        runner=Recipe.run_step,
+    ):
+        """
+        :param on_progress: callable(fraction done, seconds left or None)
+        :param workers: strips processed at the same time
+        :param split: False runs every operation as a single chunk
+        :param runner: callable(strip, name, params) running the operation on a strip
+        """
+        self.token = token or CancelToken()
+        self.on_progress = on_progress
+        self.workers = workers
+        self.split = split
+        self.runner = runner
+
+    @staticmethod
+    def halo(name: str, params: dict):
+        """
+        :return: rows read around a strip, None when the operation cannot be split
+        """
+        if name in RegionEdit.GEOMETRIC:
+            return None
+        return RegionEdit.halo(name, params)
+
+    @staticmethod
+    def strips(height: int, halo: int) -> list:
+        """
+        :return: list of (top, bottom) rows covering the image
+        """
+        rows = max(
+            math.ceil(height / ChunkedOperation.TARGET_STRIPS),
+            ChunkedOperation.MIN_ROWS,
+            ChunkedOperation.HALO_FACTOR * halo,
+        )
+        return [(top, min(height, top + rows)) for top in range(0, height, rows)]
+
+    def report(self, done: int, total: int, start: float):
+        if self.on_progress is None:
+            return
+        fraction = done / total
+        elapsed = time.monotonic() - start
+        remaining = elapsed * (1 - fraction) / fraction if fraction > 0 else None
+        self.on_progress(fraction, remaining)
+
+    def run_step(self, image, name: str, params: dict, in_place: bool = False):
+        """
+        Same as Recipe.run_step, in strips
+        :param in_place: image may be written over, only when the operation
+            runs as a single chunk through Recipe.run_step; that chunk is
+            not interrupted once started
+        :raise OperationCancelled: when the token is cancelled, image is untouched
+        """
+        self.token.check()
+        start = time.monotonic()
+        self.report(0, 1, start)
+        is_array = isinstance(image, np.ndarray)
+        image = RegionEdit.to_native(image)
+        height = image.shape[0] if is_array else image.height
+        halo = self.halo(name, params)
+        if halo is None or not self.split:
+            strips = [(0, height)]
+        else:
+            strips = self.strips(height, halo)
+        if len(strips) == 1:
+            if self.runner is Recipe.run_step:
+                result = Recipe.run_step(image, name, params, in_place)
+            else:
+                result = self.runner(image, name, params)
+            if not in_place:
+                self.token.check()
+            self.report(1, 1, start)
+            return result
+
+        width = image.shape[1] if is_array else image.width
+
+        def process(strip: tuple) -> tuple:
+            top, bottom = strip
+            outer_top, outer_bottom = max(0, top - halo), min(height, bottom + halo)
+            if self.token.cancelled:
+                return strip, (None, None)
+            if is_array:
+                crop = image[outer_top:outer_bottom]
+            else:
+                crop = image.crop((0, outer_top, width, outer_bottom))
+            result = self.runner(crop, name, params)
+            mode = None if isinstance(result, np.ndarray) else result.mode
+            return strip, (np.asarray(result)[top - outer_top : bottom - outer_top], mode)
+
+        output = None
+        done = 0
+        for (top, bottom), (rows, mode) in bounded_map(
+            process, strips, self.workers, ordered=False
+        ):
+            self.token.check()
+            if output is None:
+                output = np.empty((height,) + rows.shape[1:], rows.dtype)
+            output[top:bottom] = rows
+            done += 1
+            self.report(done, len(strips), start)
+        if mode is None:
+            return output
+        return Image.fromarray(output, mode)
+
+    def apply(self, image, region, name: str, params: dict = None):
+        """
+        Run name on image, only inside region (RegionEdit) when it is not None
+        :return: (new image, changed box or None for the whole image)
+        """
+        params = params or {}
+        if region is None:
+            return self.run_step(image, name, params), None
+        return RegionEdit.apply(image, region, name, params, run_step=self.run_step)
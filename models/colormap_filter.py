@@ -0,0 +1,175 @@
+""" Colormap filters compiled to a single lookup table """
+import copy
+
+import cv2
+import numpy as np
+
+from models.lookup_table import LookupTable
+
+
+class ColormapFilter:
+    """
+    Class declare colormap based filters as data and compile their
+    per-pixel part into one 256 x 3 table.
+    A filter is a dict (JSON friendly), every key but "colormap" is optional:
+    {
+        "gray": True,                     # convert to gray first
+        "median": 5,                      # median blur kernel size
+        "before": ["invert"],             # table stages on gray values
+        "colormap": "PARULA",             # cv2.COLORMAP_* name
+        "after": [{"op": "gamma", "gamma_value": 0.8}],  # stages on colors
+        "post": [{"op": "stylization", "sigma_s": 60, "sigma_r": 0.6}],
+    }
+    "before", "colormap" and "after" collapse into one table that
+    cv2.applyColorMap applies in a single pass (gray conversion + lookup)
+    """
+
+    FILTERS = {
+        "pink_dream": {
+            "colormap": "PINK",
+            "post": [{"op": "stylization", "sigma_s": 60, "sigma_r": 0.6}],
+        },
+        "pastel": {"median": 5, "colormap": "JET"},
+        "firestorm": {"colormap": "PARULA", "after": ["invert"]},
+        "ice": {"colormap": "OCEAN"},
+        "gray_nostalgia": {"gray": True, "median": 3, "colormap": "BONE"},
+        "sweet_dream": {
+            "colormap": "TWILIGHT_SHIFTED",
+            "post": [
+                {"op": "edge_preserving", "flags": 1, "sigma_r": 0.6, "sigma_s": 40}
+            ],
+        },
+    }
+
+    TABLE_STAGES = {
+        "invert": lambda params: LookupTable.invert(np.uint8),
+        "gamma": lambda params: LookupTable.gamma(params["gamma_value"], np.uint8),
+        "brightness": lambda params: LookupTable.brightness(params["factor"], np.uint8),
+    }
+
+    POST_STAGES = {
+        "stylization": lambda image, params: cv2.stylization(image, **params),
+        "edge_preserving": lambda image, params: cv2.edgePreservingFilter(image, **params),
+        "median": lambda image, params: cv2.medianBlur(image, params["ksize"]),
+    }
+
+    # Compiled tables by filter name
+    _tables = {}
+
+    @staticmethod
+    def colormap_id(name) -> int:
+        if isinstance(name, int):
+            return name
+        try:
+            return getattr(cv2, f"COLORMAP_{name.upper()}")
+        except AttributeError:
+            raise ValueError(f"Unknown colormap: {name}") from None
+
+    @staticmethod
+    def parse_stage(stage) -> tuple:
+        """
+        :param stage: name or {"op": name, **params}
+        :return: (name, params)
+        """
+        if isinstance(stage, str):
+            return stage, {}
+        params = dict(stage)
+        return params.pop("op"), params
+
+    @staticmethod
+    def stage_table(stage) -> np.ndarray:
+        name, params = ColormapFilter.parse_stage(stage)
+        if name not in ColormapFilter.TABLE_STAGES:
+            raise ValueError(f"Unknown table stage: {name}")
+        return ColormapFilter.TABLE_STAGES[name](params)
+
+    @staticmethod
+    def compile(spec: dict) -> np.ndarray:
+        """
+        Collapse before -> colormap -> after into one table
+        :return: (256, 1, 3) uint8 table for cv2.applyColorMap
+        """
+        values = LookupTable.identity(np.uint8)
+        for stage in spec.get("before", ()):
+            values = LookupTable.compose(values, ColormapFilter.stage_table(stage))
+
+        ramp = values.reshape(256, 1)
+        table = cv2.applyColorMap(ramp, ColormapFilter.colormap_id(spec["colormap"]))
+        for stage in spec.get("after", ()):
+            table = ColormapFilter.stage_table(stage)[table]
+        return np.ascontiguousarray(table)
+
+    @staticmethod
+    def register(name: str, spec: dict):
+        """
+        Add or replace a filter declared as data
+        """
+        ColormapFilter.compile(spec)  # fail early on a bad spec
+        ColormapFilter.FILTERS[name] = copy.deepcopy(spec)
+        ColormapFilter._tables.pop(name, None)
+
+    @staticmethod
+    def table(name: str) -> np.ndarray:
+        """
+        Compiled table of a registered filter, built once
+        """
+        table = ColormapFilter._tables.get(name)
+        if table is None:
+            table = ColormapFilter.compile(ColormapFilter.get_spec(name))
+            ColormapFilter._tables[name] = table
+        return table
+
+    @staticmethod
+    def get_spec(name: str) -> dict:
+        if name not in ColormapFilter.FILTERS:
+            raise ValueError(f"Unknown colormap filter: {name}")
+        return ColormapFilter.FILTERS[name]
+
+    @staticmethod
+    def resolve(spec) -> tuple:
+        """
+        :param spec: registered filter name or filter dict
+        :return: (spec dict, compiled table)
+        """
+        if isinstance(spec, str):
+            return ColormapFilter.get_spec(spec), ColormapFilter.table(spec)
+        return spec, ColormapFilter.compile(spec)
+
+    @staticmethod
+    def input_stage(spec) -> tuple:
+        """
+        Neighbourhood stages run before the table, as (gray, median size).
+        Filters with the same input stage can share its result
+        """
+        spec, _ = ColormapFilter.resolve(spec)
+        return bool(spec.get("gray")), spec.get("median") or 0
+
+    @staticmethod
+    def prepare(image: np.ndarray, spec) -> np.ndarray:
+        gray, median = ColormapFilter.input_stage(spec)
+        if gray and image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        if median:
+            image = cv2.medianBlur(image, median)
+        return image
+
+    @staticmethod
+    def finish(image: np.ndarray, spec) -> np.ndarray:
+        """
+        Table pass and post stages on an image returned by prepare
+        """
+        spec, table = ColormapFilter.resolve(spec)
+        image = cv2.applyColorMap(image, table)
+        for stage in spec.get("post", ()):
+            name, params = ColormapFilter.parse_stage(stage)
+            image = ColormapFilter.POST_STAGES[name](image, params)
+        return image
+
+    @staticmethod
+    def apply(image: np.ndarray, spec) -> np.ndarray:
+        """
+        Run a filter: neighbourhood stages, one table pass, post stages
+        :param spec: registered filter name or filter dict
+        :return: numpy array
+        """
+        return ColormapFilter.finish(ColormapFilter.prepare(image, spec), spec)
@@ -0,0 +1,202 @@
+""" Persistent cache of decoded images """
+import argparse
+import hashlib
+import os
+import pathlib
+import tempfile
+
+import numpy as np
+from PIL import Image
+
+from models.image_io import ImageIO
+
+
+class DecodeCache:
+    """
+    Class store decoded pixel buffers as .npy files keyed by path, mtime and size.
+    Cached files are memory-mapped on reopen, so nothing is decoded and
+    load() only reads the touched pages from disk (open_image() reads more
+    for some modes, see there). Least recently used entries are evicted
+    when the cache grows over max_bytes
+    """
+
+    DEFAULT_DIRECTORY = pathlib.Path.home() / ".cache" / "pyimgedit" / "decoded"
+    DEFAULT_MAX_BYTES = 2 * 1024**3
+
+    # Modes stored as they are, everything else is converted first: to
+    # RGBA when it has transparency (e.g. P with a transparent index), else RGB
+    CACHED_MODES = {"L": "L", "LA": "LA", "RGB": "RGB", "RGBA": "RGBA", "PA": "RGBA"}
+    # Part of the key, changed when decode() stores other pixels for a file
+    FORMAT = 2
+
+    def __init__(self, directory=None, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.directory = pathlib.Path(directory or self.DEFAULT_DIRECTORY)
+        self.max_bytes = max_bytes
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(image_path) -> str:
+        """
+        Cache key of a file, changes whenever the file is modified
+        :return: hex digest
+        """
+        image_path = pathlib.Path(image_path).resolve()
+        stat = image_path.stat()
+        identity = f"{DecodeCache.FORMAT}\0{image_path}\0{stat.st_mtime_ns}\0{stat.st_size}"
+        return hashlib.sha1(identity.encode("utf-8")).hexdigest()
+
+    def entry_path(self, key: str) -> pathlib.Path:
+        return self.directory / f"{key}.npy"
+
+    def entries(self) -> list:
+        """
+        Cached files, least recently used first
+        :return: list of (path, stat)
+        """
+        entries = []
+        for path in self.directory.glob("*.npy"):
+            try:
+                entries.append((path, path.stat()))
+            except FileNotFoundError:
+                continue
+        return sorted(entries, key=lambda entry: entry[1].st_mtime_ns)
+
+    def size(self) -> int:
+        """
+        Total bytes used by the cache
+        """
+        return sum(stat.st_size for _, stat in self.entries())
+
+    def get(self, image_path):
+        """
+        Map the cached pixels of image_path
+        :return: read-only numpy memmap, None if not cached
+        """
+        entry = self.entry_path(self.key(image_path))
+        try:
+            image = np.load(entry, mmap_mode="r")
+            # mtime is the LRU clock, atime is not updated on most mounts
+            os.utime(entry)
+        except (FileNotFoundError, ValueError):
+            return None
+        return image
+
+    def put(self, image_path, image: np.ndarray):
+        """
+        Store decoded pixels of image_path, then evict old entries
+        :return: read-only numpy memmap of the stored pixels
+        """
+        entry = self.entry_path(self.key(image_path))
+        fd, temp_path = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as file:
+                np.save(file, np.ascontiguousarray(image))
+            os.replace(temp_path, entry)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+        self.evict(keep=entry)
+        return np.load(entry, mmap_mode="r")
+
+    def decode(self, image_path) -> np.ndarray:
+        """
+        Decode image_path to the array stored in the cache
+        :return: numpy array
+        """
+        with Image.open(image_path) as img:
+            if ImageIO.bit_depth(img) == 16:
+                return ImageIO.read_array(image_path)
+            mode = self.CACHED_MODES.get(img.mode)
+            if mode is None:
+                mode = "RGBA" if "transparency" in img.info else "RGB"
+            if img.mode != mode:
+                img = img.convert(mode)
+            return np.array(img)
+
+    def load(self, image_path) -> np.ndarray:
+        """
+        Load pixels of image_path, decoding only on cache miss
+        :return: numpy array
+        """
+        image = self.get(image_path)
+        if image is None:
+            image = self.put(image_path, self.decode(image_path))
+        return image
+
+    def open_image(self, image_path):
+        """
+        Same pixels as ImageIO.open_image, served from the cache; palette
+        images come back as RGB, or RGBA when they have transparency.
+        L and RGBA images share the mapped pages, but PIL stores RGB and LA
+        with 4 bytes per pixel, so for them Image.fromarray reads and copies
+        the whole buffer: use load() to touch only part of the pixels
+        :return: Image object (PIL) or numpy array for 16-bit images
+        """
+        image = self.load(image_path)
+        if image.dtype == np.uint8:
+            return Image.fromarray(image)
+        return image
+
+    def evict(self, max_bytes: int = None, keep=None) -> int:
+        """
+        Remove least recently used entries until the cache fit in max_bytes
+        :param keep: entry that must not be removed
+        :return: number of removed entries
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = self.entries()
+        total = sum(stat.st_size for _, stat in entries)
+        removed = 0
+        for path, stat in entries:
+            if total <= max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                path.unlink()
+            except OSError:
+                # Still mapped by another process (Windows)
+                continue
+            total -= stat.st_size
+            removed += 1
+        return removed
+
+    def clear(self) -> int:
+        """
+        Remove every entry and leftover temporary file
+        :return: number of removed files
+        """
+        removed = self.evict(max_bytes=0)
+        for path in self.directory.glob("*.tmp"):
+            try:
+                path.unlink()
+                removed += 1
+            except OSError:
+                continue
+        return removed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the decoded image cache")
+    parser.add_argument("command", choices=["info", "evict", "clear"])
+    parser.add_argument("--directory", default=DecodeCache.DEFAULT_DIRECTORY)
+    parser.add_argument(
+        "--max-mb", type=int, help="size cap used by evict, in megabytes"
+    )
+    args = parser.parse_args()
+
+    cache = DecodeCache(args.directory)
+    if args.command == "info":
+        entries = cache.entries()
+        total = sum(stat.st_size for _, stat in entries)
+        print(f"{cache.directory}: {len(entries)} entries, {total / 1024**2:.1f} MB")
+    elif args.command == "evict":
+        max_bytes = None if args.max_mb is None else args.max_mb * 1024**2
+        print(f"Removed {cache.evict(max_bytes)} entries")
+    else:
+        print(f"Removed {cache.clear()} files")
+
+
+if __name__ == "__main__":
+    main()
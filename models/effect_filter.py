@@ -3,6 +3,9 @@ import cv2
 import numpy as np
 from PIL.Image import Image
 
+from models.colormap_filter import ColormapFilter
+from models.filter_graph import FilterGraph
+
 
 class EffectFilter:
     """
@@ -19,16 +22,9 @@ class EffectFilter:
         Apply COLORMAP_PINK
         :return: numpy array
         """
-        # Apply pink colormap filter
-        image = np.array(image)
-        filtered_image = cv2.applyColorMap(image, cv2.COLORMAP_PINK)
-
-        # Apply stylization filter that produces
+        # Apply pink colormap filter, then stylization filter that produces
         # image look like painted using water color
-        filtered_image = cv2.stylization(
-            filtered_image, sigma_s=60, sigma_r=0.6
-        )
-        return filtered_image
+        return ColormapFilter.apply(np.asarray(image), "pink_dream")
 
     @staticmethod
     def cyperpunk_2077(image: Image):
@@ -37,7 +33,8 @@ class EffectFilter:
         :return: numpy array
         """
         image = np.array(image)
-        filtered_image = cv2.applyColorMap(image, cv2.COLORMAP_PLASMA)
+        # The PLASMA colormap result was never used by the filter below,
+        # so it is not computed anymore
         # Apply Edge Preserving Filter (Bộ lọc làm mờ cạnh)
         # flags = 1 Use RECURS_FILTER
         # that 3.5x faster than 2 = NORMCONV_FILTER
@@ -52,13 +49,8 @@ class EffectFilter:
         Apply BRG2GRAY effect
         :return: numpy array
         """
-        image = np.array(image)
-        # First, convert to grayscale image
-        snowy_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        snowy_image_blur = cv2.GaussianBlur(
-            snowy_image, (25, 25), 0
-        )  # (25, 25) Kernel size
-        return cv2.divide(snowy_image, snowy_image_blur, scale=250.0)
+        # Grayscale divided by its 25x25 Gaussian blur, see FilterGraph "sketch"
+        return FilterGraph(image).get("snowy")
 
     @staticmethod
     def pastel(image: Image):
@@ -66,9 +58,7 @@ class EffectFilter:
         Apply COLORMAP_JET
         :return: numpy array
         """
-        image = np.array(image)
-        pastel_image = cv2.medianBlur(image, 5)
-        return cv2.applyColorMap(pastel_image, cv2.COLORMAP_JET)
+        return ColormapFilter.apply(np.asarray(image), "pastel")
 
     @staticmethod
     def firestorm(image: Image):
@@ -76,9 +66,8 @@ class EffectFilter:
         Apply negative COLORMAP_PARULA
         :return: numpy array
         """
-        image = np.array(image)
-        firestorm_image = cv2.applyColorMap(image, cv2.COLORMAP_PARULA)
-        return cv2.bitwise_not(firestorm_image)
+        # Colormap and negative are one table
+        return ColormapFilter.apply(np.asarray(image), "firestorm")
 
     @staticmethod
     def ice(image: Image):
@@ -86,8 +75,7 @@ class EffectFilter:
         Apply COLORMAP_OCEAN
         :return: numpy array
         """
-        image = np.array(image)
-        ice_image = cv2.applyColorMap(image, cv2.COLORMAP_OCEAN)
+        ice_image = ColormapFilter.apply(np.asarray(image), "ice")
         # Apply Edge Preserving Filter (Bộ lọc làm mờ cạnh)
         # flags = 1 Use RECURS_FILTER that 3.5x faster than 2 = NORMCONV_FILTER
         # ice_image = cv2.edgePreservingFilter(
@@ -101,12 +89,8 @@ class EffectFilter:
         Make image darker
         :return: numpy array
         """
-        image = np.array(image)
-        gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        gray_image_blur = cv2.GaussianBlur(gray_image, (25, 25), 0)
-        darkness_image = cv2.divide(gray_image, gray_image_blur, scale=250.0)
-
-        return cv2.bitwise_not(darkness_image)
+        # Negative of snowy
+        return FilterGraph(image).get("darkness")
 
     @staticmethod
     def gray_nostalgia(image: Image):
@@ -114,31 +98,31 @@ class EffectFilter:
         Apply COLORMAP_BONE
         :return: numpy array
         """
-        image = np.array(image)
-        mask_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        mask_image = cv2.medianBlur(mask_image, 3)
-        nostalgia_image = cv2.applyColorMap(mask_image, cv2.COLORMAP_BONE)
-
-        return nostalgia_image
+        return ColormapFilter.apply(np.asarray(image), "gray_nostalgia")
 
     @staticmethod
     def sweet_dream(image: Image):
-        image = np.array(image)
-        sweet_image = cv2.applyColorMap(image, cv2.COLORMAP_TWILIGHT_SHIFTED)
-        sweet_image = cv2.edgePreservingFilter(
-            sweet_image, flags=1, sigma_r=0.6, sigma_s=40
-        )
-
-        return sweet_image
+        return ColormapFilter.apply(np.asarray(image), "sweet_dream")
 
     @staticmethod
     def cartoon(image: Image):
-        image = np.array(image)
-        color = cv2.bilateralFilter(image, d=9, sigmaColor=200, sigmaSpace=200)
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        gray_1 = cv2.medianBlur(gray, 5)
-        edges = cv2.adaptiveThreshold(
-            gray_1, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 9, 5
-        )
-        new_image = cv2.bitwise_and(color, color, mask=edges)
-        return new_image
+        # Bilateral filtered colors masked by the edges of the gray image
+        return FilterGraph(image).get("cartoon")
+
+    @staticmethod
+    def colormap_filter(image: Image, spec):
+        """
+        Apply a colormap filter declared as data
+        :param spec: name registered in ColormapFilter.FILTERS or filter dict
+        :return: numpy array
+        """
+        return ColormapFilter.apply(np.asarray(image), spec)
+
+    @staticmethod
+    def preview_all(image: Image, max_size: int = 256, names=None) -> dict:
+        """
+        Small previews of every filter, stages common to several filters
+        are computed once
+        :return: dict of filter name to numpy array
+        """
+        return FilterGraph.preview(image, max_size, names)
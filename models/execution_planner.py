@@ -0,0 +1,200 @@
+""" Choose how to run an operation from its cost, the image size and the cores """
+import math
+from concurrent.futures import ProcessPoolExecutor
+
+from models.cancellable import ChunkedOperation
+from models.operation_registry import OperationRegistry
+from models.parallel import default_workers
+from models.recipe import Recipe
+from models.region_edit import RegionEdit
+from models.thumbnail_pyramid import ThumbnailPyramid
+
+
+class Plan:
+    """
+    How one call runs: strategy is one of ExecutionPlanner.STRATEGIES
+    """
+
+    __slots__ = ("name", "strategy", "workers", "estimate_ms", "size", "reason")
+
+    def __init__(
+        self, name: str, strategy: str, workers: int, estimate_ms: float, size: tuple, reason: str
+    ):
+        """
+        :param size: (width, height) the operation runs on, smaller than the
+            image for a proxy
+        """
+        self.name = name
+        self.strategy = strategy
+        self.workers = workers
+        self.estimate_ms = estimate_ms
+        self.size = size
+        self.reason = reason
+
+    def __repr__(self):
+        return (
+            f"Plan({self.name!r}, {self.strategy}, workers={self.workers},"
+            f" {self.estimate_ms:.1f} ms, {self.reason})"
+        )
+
+
+class ExecutionPlanner:
+    """
+    Class pick per call, from the OperationRegistry metadata, how an
+    operation runs:
+    - inline: one call on the calling thread, for cheap operations and
+      the ones needing the whole image
+    - strips: horizontal strips with their halo on a thread pool
+      (ChunkedOperation), cv2 and PIL release the GIL
+    - tiles: the same strips in worker processes, for expensive operations
+      on large images when there are cores to spare. Pixels are copied to
+      the workers, so it is only worth it far above the strip threshold
+    - proxy: for previews over the latency budget, the operation runs on a
+      downscaled copy sized to fit the budget
+    """
+
+    INLINE = "inline"
+    STRIPS = "strips"
+    TILES = "tiles"
+    PROXY = "proxy"
+    STRATEGIES = (INLINE, STRIPS, TILES, PROXY)
+
+    # Estimated milliseconds above which a call is split
+    STRIP_MS = 30.0
+    TILE_MS = 2000.0
+    MIN_TILE_WORKERS = 4
+    PREVIEW_BUDGET_MS = 50.0
+
+    def __init__(self, registry: OperationRegistry = None, workers: int = None):
+        """
+        :param workers: cores used, all by default
+        """
+        self.registry = registry or OperationRegistry()
+        self.workers = workers or default_workers()
+        self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def plan(
+        self, image, name: str, params: dict = None, preview: bool = False, budget_ms: float = None
+    ) -> Plan:
+        """
+        :param preview: the result is only looked at, it may be made smaller
+        :param budget_ms: latency allowed for a preview
+        """
+        params = params or {}
+        spec = self.registry[name]
+        size = ThumbnailPyramid.image_size(image)
+        estimate = self.registry.estimate_ms(name, size[0] * size[1])
+        budget = budget_ms or self.PREVIEW_BUDGET_MS
+
+        if preview and estimate > budget and spec.kind != OperationRegistry.GEOMETRIC:
+            scale = math.sqrt(budget / estimate)
+            proxy_size = (max(1, int(size[0] * scale)), max(1, int(size[1] * scale)))
+            return Plan(
+                name,
+                self.PROXY,
+                1,
+                self.registry.estimate_ms(name, proxy_size[0] * proxy_size[1]),
+                proxy_size,
+                f"preview over {budget:.0f} ms",
+            )
+
+        halo = spec.halo(params)
+        if estimate < self.STRIP_MS:
+            return Plan(name, self.INLINE, 1, estimate, size, "cheap")
+        if halo is None:
+            return Plan(name, self.INLINE, 1, estimate, size, f"{spec.kind} operation")
+        strips = len(ChunkedOperation.strips(size[1], halo))
+        if strips < 2:
+            return Plan(name, self.INLINE, 1, estimate, size, "halo as high as the image")
+
+        workers = min(self.workers, strips)
+        # Every strip also computes its halo rows
+        overlap = 1 + 2 * halo * strips / size[1]
+        if estimate > self.TILE_MS and workers >= self.MIN_TILE_WORKERS:
+            return Plan(
+                name,
+                self.TILES,
+                workers,
+                estimate * overlap / workers,
+                size,
+                f"{strips} strips in {workers} processes",
+            )
+        return Plan(
+            name,
+            self.STRIPS,
+            workers,
+            estimate * overlap / workers,
+            size,
+            f"{strips} strips on {workers} threads",
+        )
+
+    def pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(self.workers)
+        return self._pool
+
+    def run_in_process(self, strip, name: str, params: dict):
+        return self.pool().submit(Recipe.run_step, strip, name, params).result()
+
+    def run_step(
+        self,
+        image,
+        name: str,
+        params: dict = None,
+        in_place: bool = False,
+        token=None,
+        on_progress=None,
+        preview: bool = False,
+    ):
+        """
+        Same as Recipe.run_step, run the way plan() picks
+        :param token: CancelToken checked between strips
+        :param on_progress: callable(fraction done, seconds left or None)
+        :return: Image object (PIL) or numpy array, of the proxy size for a proxy plan
+        :raise ValueError: when the operation does not support image
+        :raise OperationCancelled: when token is cancelled
+        """
+        params = params or {}
+        native = RegionEdit.to_native(image)
+        in_place = in_place or native is not image
+        image = native
+        self.registry[name].check(image)
+        plan = self.plan(image, name, params, preview)
+        if plan.strategy == self.PROXY:
+            proxy = ThumbnailPyramid.resize(image, plan.size)
+            in_place = in_place or proxy is not image
+            image = proxy
+        operation = ChunkedOperation(
+            token,
+            on_progress,
+            workers=plan.workers,
+            split=plan.strategy in (self.STRIPS, self.TILES),
+            runner=self.run_in_process if plan.strategy == self.TILES else Recipe.run_step,
+        )
+        return operation.run_step(image, name, params, in_place)
+
+    def apply(self, image, region, name: str, params: dict = None, token=None, on_progress=None):
+        """
+        Run name on image, only inside region (RegionEdit) when it is not None
+        :return: (new image, changed box or None for the whole image)
+        """
+        params = params or {}
+
+        def run_step(source, step_name, step_params, in_place=False):
+            return self.run_step(source, step_name, step_params, in_place, token, on_progress)
+
+        if region is None:
+            return run_step(image, name, params), None
+        self.registry[name].check(image)
+        return RegionEdit.apply(image, region, name, params, run_step=run_step)
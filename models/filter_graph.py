@@ -0,0 +1,143 @@
+""" Named intermediate stages shared between effect filters """
+import re
+import time
+
+import cv2
+import numpy as np
+
+from models.colormap_filter import ColormapFilter
+
+
+class FilterGraph:
+    """
+    Class compute effect filters of one source image as a graph of named
+    nodes. Every node is computed at most once per graph, so filters with a
+    common sub-pipeline (gray -> 25x25 blur -> divide for snowy and
+    darkness, gray -> median for gray_nostalgia and cartoon) share it.
+    Results are cached numpy arrays, do not modify them in place
+    """
+
+    # name: (input node names, function of the inputs)
+    NODES = {
+        "gray": (("source",), lambda source: cv2.cvtColor(source, cv2.COLOR_BGR2GRAY)),
+        "gray_blur_25": (("gray",), lambda gray: cv2.GaussianBlur(gray, (25, 25), 0)),
+        "sketch": (
+            ("gray", "gray_blur_25"),
+            lambda gray, blur: cv2.divide(gray, blur, scale=250.0),
+        ),
+        "bilateral": (
+            ("source",),
+            lambda source: cv2.bilateralFilter(source, d=9, sigmaColor=200, sigmaSpace=200),
+        ),
+        "edges": (
+            ("gray_median_5",),
+            lambda gray: cv2.adaptiveThreshold(
+                gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 9, 5
+            ),
+        ),
+        # Filters
+        "cyperpunk_2077": (
+            ("source",),
+            lambda source: cv2.edgePreservingFilter(source, flags=1, sigma_r=0.6, sigma_s=40),
+        ),
+        "snowy": (("sketch",), lambda sketch: sketch),
+        "darkness": (("sketch",), cv2.bitwise_not),
+        "cartoon": (
+            ("bilateral", "edges"),
+            lambda color, edges: cv2.bitwise_and(color, color, mask=edges),
+        ),
+    }
+
+    # (gray|color)_median_<size>: median blur of the gray or color image
+    MEDIAN_NODE = re.compile(r"(gray|color)_median_(\d+)$")
+
+    FILTERS = (
+        "pink_dream",
+        "cyperpunk_2077",
+        "snowy",
+        "pastel",
+        "firestorm",
+        "ice",
+        "darkness",
+        "gray_nostalgia",
+        "sweet_dream",
+        "cartoon",
+    )
+
+    def __init__(self, image):
+        """
+        :param image: Image object (PIL) or numpy array
+        """
+        self.cache = {"source": np.asarray(image)}
+        self.timings = {}
+
+    @staticmethod
+    def colormap_input(name: str) -> str:
+        """
+        Node feeding a colormap filter. applyColorMap turns color input to
+        gray itself, so filters without a median all read the gray node
+        """
+        gray, median = ColormapFilter.input_stage(name)
+        if median:
+            return f"{'gray' if gray else 'color'}_median_{median}"
+        return "gray"
+
+    @staticmethod
+    def definition(name: str) -> tuple:
+        """
+        :return: (input node names, function) of node name
+        """
+        if name in FilterGraph.NODES:
+            return FilterGraph.NODES[name]
+        if name in ColormapFilter.FILTERS:
+            return (
+                (FilterGraph.colormap_input(name),),
+                lambda image: ColormapFilter.finish(image, name),
+            )
+        match = FilterGraph.MEDIAN_NODE.match(name)
+        if match:
+            size = int(match.group(2))
+            source = "gray" if match.group(1) == "gray" else "source"
+            return (source,), lambda image: cv2.medianBlur(image, size)
+        raise ValueError(f"Unknown filter node: {name}")
+
+    def get(self, name: str) -> np.ndarray:
+        """
+        Result of node name, computing missing inputs first
+        """
+        if name in self.cache:
+            return self.cache[name]
+        inputs, func = FilterGraph.definition(name)
+        arguments = [self.get(node) for node in inputs]
+        start = time.perf_counter()
+        result = func(*arguments)
+        self.timings[name] = time.perf_counter() - start
+        self.cache[name] = result
+        return result
+
+    def apply_all(self, names=None) -> dict:
+        """
+        :param names: filter names, all filters when None
+        :return: dict of filter name to numpy array
+        """
+        return {name: self.get(name) for name in (names or FilterGraph.FILTERS)}
+
+    @staticmethod
+    def preview(image, max_size: int = 256, names=None) -> dict:
+        """
+        Small previews of several filters sharing every common stage
+        :param max_size: longest side of the previews
+        :return: dict of filter name to numpy array
+        """
+        source = np.asarray(image)
+        # Every filter accepts 3 channels, gray and RGBA sources are converted
+        if source.ndim == 2:
+            source = cv2.cvtColor(source, cv2.COLOR_GRAY2BGR)
+        elif source.shape[2] == 4:
+            source = cv2.cvtColor(source, cv2.COLOR_BGRA2BGR)
+        height, width = source.shape[:2]
+        scale = max_size / max(height, width)
+        if scale < 1:
+            size = (max(1, round(width * scale)), max(1, round(height * scale)))
+            source = cv2.resize(source, size, interpolation=cv2.INTER_AREA)
+        return FilterGraph(source).apply_all(names)
@@ -0,0 +1,136 @@
+""" Streaming pipeline for animated GIF and multi-page TIFF """
+import argparse
+import pathlib
+
+from PIL import GifImagePlugin, Image, ImageSequence, TiffImagePlugin
+
+from models.parallel import bounded_map, default_workers
+from models.recipe import Recipe
+
+
+class FramePipeline:
+    """
+    Class apply a recipe to every frame of a sequence.
+    Frames are decoded one at a time, processed on a thread pool and encoded
+    straight to the output in their original order, so only about
+    max_in_flight frames are held in memory whatever the sequence length
+    """
+
+    def __init__(self, recipe: Recipe, workers: int = None, max_in_flight: int = None):
+        self.recipe = recipe
+        self.workers = workers or default_workers()
+        self.max_in_flight = max_in_flight or 2 * self.workers
+
+    @staticmethod
+    def iter_frames(image_path):
+        """
+        Decode frames lazily
+        :return: generator of (Image, frame info dict)
+        """
+        with Image.open(image_path) as img:
+            for frame in ImageSequence.Iterator(img):
+                info = dict(frame.info)
+                if frame.mode not in ("RGB", "L", "I;16"):
+                    frame = frame.convert("RGB")
+                else:
+                    frame = frame.copy()
+                yield frame, info
+
+    def process_frame(self, item: tuple) -> tuple:
+        frame, info = item
+        # Frames are decoded for this recipe only
+        return self.recipe.apply(frame, in_place=True), info
+
+    def iter_processed(self, image_path):
+        """
+        Processed frames in input order
+        :return: generator of (Image, frame info dict)
+        """
+        return bounded_map(
+            self.process_frame,
+            self.iter_frames(image_path),
+            workers=self.workers,
+            max_in_flight=self.max_in_flight,
+        )
+
+    def process(self, image_path, output_path) -> int:
+        """
+        Apply the recipe to every frame of image_path and write output_path.
+        Output format follows the suffix: .gif or .tif/.tiff
+        :return: number of frames written
+        """
+        suffix = pathlib.Path(output_path).suffix.lower()
+        frames = self.iter_processed(image_path)
+        if suffix == ".gif":
+            return self.write_gif(frames, output_path)
+        if suffix in (".tif", ".tiff"):
+            return self.write_tiff(frames, output_path)
+        raise ValueError(f"Unsupported sequence format: {suffix}")
+
+    @staticmethod
+    def write_gif(frames, output_path, loop: int = 0) -> int:
+        """
+        Encode frames one by one, each frame carry its own palette.
+        Image.save(save_all=True) keeps every frame until the end, this doesn't
+        :return: number of frames written
+        """
+        count = 0
+        with open(output_path, "wb") as file:
+            for frame, info in frames:
+                frame = FramePipeline.to_palette(frame)
+                duration = info.get("duration", 0)
+                if count == 0:
+                    header, _ = GifImagePlugin.getheader(
+                        frame, info={"loop": info.get("loop", loop), "duration": duration}
+                    )
+                    file.writelines(header)
+                file.writelines(
+                    GifImagePlugin.getdata(
+                        frame, duration=duration, include_color_table=True
+                    )
+                )
+                count += 1
+            file.write(b";")  # GIF trailer
+        return count
+
+    @staticmethod
+    def to_palette(frame) -> Image.Image:
+        if frame.mode == "P":
+            return frame
+        if frame.mode not in ("RGB", "L"):
+            frame = frame.convert("RGB")
+        return frame.convert("P", palette=Image.Palette.ADAPTIVE)
+
+    @staticmethod
+    def write_tiff(frames, output_path) -> int:
+        """
+        Append frames as TIFF pages as soon as they are ready
+        :return: number of frames written
+        """
+        count = 0
+        with TiffImagePlugin.AppendingTiffWriter(str(output_path), new=True) as file:
+            for frame, _ in frames:
+                frame.save(file, format="TIFF")
+                file.newFrame()
+                count += 1
+        return count
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Apply a recipe to every frame of an animated GIF or multi-page TIFF"
+    )
+    parser.add_argument("input")
+    parser.add_argument("output")
+    parser.add_argument("recipe", help="recipe JSON file")
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--max-in-flight", type=int)
+    args = parser.parse_args()
+
+    pipeline = FramePipeline(Recipe.load(args.recipe), args.workers, args.max_in_flight)
+    count = pipeline.process(args.input, args.output)
+    print(f"Wrote {count} frames to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
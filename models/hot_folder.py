@@ -0,0 +1,381 @@
+""" Watch directories and run a recipe on images as they arrive """
+import argparse
+import collections
+import json
+import os
+import pathlib
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from models.image_io import ImageIO
+from models.parallel import default_workers
+from models.processing_service import ServiceMetrics
+from models.recipe import Recipe
+
+
+class Journal:
+    """
+    Append only record of handled files, one JSON object per line keyed by
+    HotFolder.key. A line is written only once the output file is in
+    place, so after a crash a file is either recorded or processed again,
+    never recorded without its output. Opening the journal drops a torn
+    last line and rewrites the file with the last entry of every key
+    """
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.entries = {}
+        self.load()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.compact()
+        self.file = open(self.path, "a", encoding="utf-8")
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def load(self):
+        if not self.path.exists():
+            return
+        with open(self.path, encoding="utf-8") as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                self.entries[entry["key"]] = entry
+
+    def compact(self):
+        temp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(temp_path, "w", encoding="utf-8") as file:
+            for entry in self.entries.values():
+                file.write(json.dumps(entry) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.path)
+
+    def record(self, key: str, **fields):
+        entry = {"key": key, **fields}
+        self.entries[key] = entry
+        self.file.write(json.dumps(entry) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+class _Job:
+    __slots__ = ("path", "output", "key", "size", "mtime_ns", "seen", "started")
+
+    def __init__(self, path: pathlib.Path, output: pathlib.Path, key: str, stat, seen: float):
+        self.path = path
+        self.output = output
+        self.key = key
+        self.size = stat.st_size
+        self.mtime_ns = stat.st_mtime_ns
+        self.seen = seen
+        self.started = None
+
+
+class HotFolder:
+    """
+    Class poll directories for new images and run a Recipe on each of them
+    on a bounded thread pool, writing results under an output directory
+    with the same relative paths.
+    A file is picked up once its size and modification time stayed the
+    same for settle seconds, so files still being copied are left alone.
+    Handled files are written to a Journal keyed by path, size, mtime and
+    recipe digest: a restart skips them, a modified file is processed again
+    """
+
+    JOURNAL_NAME = ".hotfolder-journal.jsonl"
+    # Names of files still being written by common tools
+    PARTIAL_SUFFIXES = (".part", ".partial", ".tmp", ".crdownload", ".download")
+
+    def __init__(
+        self,
+        directories,
+        output_dir,
+        recipe: Recipe,
+        workers: int = None,
+        settle: float = 1.0,
+        interval: float = 0.5,
+        output_format: str = None,
+        journal_path=None,
+    ):
+        """
+        :param directories: watched directories, searched recursively
+        :param settle: seconds a file must stay unchanged before it is processed
+        :param interval: seconds between two polls
+        :param output_format: output suffix, e.g. ".png", None keeps the input suffix
+        """
+        self.directories = [pathlib.Path(directory).resolve() for directory in directories]
+        self.output_dir = pathlib.Path(output_dir).resolve()
+        self.recipe = recipe
+        self.digest = recipe.digest()
+        self.workers = workers or default_workers()
+        self.max_in_flight = 2 * self.workers
+        self.settle = settle
+        self.interval = interval
+        self.output_format = output_format
+        self.journal = Journal(journal_path or self.output_dir / self.JOURNAL_NAME)
+        self.extensions = Image.registered_extensions()
+
+        # path: (size, mtime_ns, first seen, last change)
+        self.settling = {}
+        self.queued = collections.deque()
+        self.running = {}
+        self.active_keys = set()
+        self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix="hotfolder")
+        self._stop = threading.Event()
+
+        self.started = time.monotonic()
+        self.completed = 0
+        self.failed = 0
+        self.skipped = 0
+        self.latencies = collections.deque(maxlen=ServiceMetrics.SAMPLES)
+        self.process_times = collections.deque(maxlen=ServiceMetrics.SAMPLES)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    """
+    Scanning
+    """
+
+    def key(self, path: pathlib.Path, stat) -> str:
+        return f"{self.digest[:16]}:{stat.st_size}:{stat.st_mtime_ns}:{path}"
+
+    def is_candidate(self, name: str) -> bool:
+        if name.startswith(".") or name.lower().endswith(self.PARTIAL_SUFFIXES):
+            return False
+        return os.path.splitext(name)[1].lower() in self.extensions
+
+    def scan(self, directory: pathlib.Path):
+        """
+        :return: generator of (path, os.stat_result) of candidate files
+        """
+        stack = [directory]
+        while stack:
+            try:
+                entries = list(os.scandir(stack.pop()))
+            except OSError:
+                continue
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if not entry.name.startswith(".") and entry.path != str(self.output_dir):
+                            stack.append(entry.path)
+                    elif entry.is_file() and self.is_candidate(entry.name):
+                        yield pathlib.Path(entry.path), entry.stat()
+                except OSError:
+                    continue
+
+    def output_path(self, directory: pathlib.Path, path: pathlib.Path) -> pathlib.Path:
+        relative = path.relative_to(directory)
+        if len(self.directories) > 1:
+            relative = directory.name / relative
+        if self.output_format:
+            relative = relative.with_suffix(self.output_format)
+        return self.output_dir / relative
+
+    def poll(self):
+        """
+        One pass: find settled files, start queued jobs, record finished ones
+        """
+        now = time.monotonic()
+        present = set()
+        for directory in self.directories:
+            for path, stat in self.scan(directory):
+                present.add(path)
+                key = self.key(path, stat)
+                if key in self.journal or key in self.active_keys:
+                    continue
+                state = self.settling.get(path)
+                if state is None or state[:2] != (stat.st_size, stat.st_mtime_ns):
+                    seen = now if state is None else state[2]
+                    self.settling[path] = (stat.st_size, stat.st_mtime_ns, seen, now)
+                elif now - state[3] >= self.settle:
+                    del self.settling[path]
+                    job = _Job(path, self.output_path(directory, path), key, stat, state[2])
+                    self.queued.append(job)
+                    self.active_keys.add(key)
+        for path in list(self.settling):
+            if path not in present:
+                del self.settling[path]
+
+        self.collect()
+        while self.queued and len(self.running) < self.max_in_flight:
+            job = self.queued.popleft()
+            job.started = time.monotonic()
+            self.running[self.executor.submit(self.process, job)] = job
+
+    """
+    Processing
+    """
+
+    def process(self, job: _Job):
+        image = ImageIO.open_image(job.path)
+        if not isinstance(image, np.ndarray):
+            # A truncated file fails here rather than inside the recipe
+            image.load()
+        result = self.recipe.apply(image, in_place=True)
+        self.write(result, job.output)
+
+    def write(self, image, output: pathlib.Path):
+        """
+        Encode to a hidden file next to output then rename it, readers of
+        the output tree never see a partial file
+        """
+        image_format = self.extensions.get(output.suffix.lower(), "PNG")
+        data = ImageIO.encode_bytes(image, image_format)
+        output.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = output.with_name(f".{output.name}.tmp")
+        with open(temp_path, "wb") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, output)
+
+    def collect(self, wait: bool = False):
+        """
+        Record finished jobs in the journal
+        :param wait: block until every running job is done
+        """
+        for future in list(self.running):
+            if not (wait or future.done()):
+                continue
+            job = self.running.pop(future)
+            self.active_keys.discard(job.key)
+            error = future.exception()
+            if error is not None and self.changed(job):
+                # Still being written after all, wait for it to settle again
+                continue
+            now = time.monotonic()
+            if error is None:
+                self.completed += 1
+                self.journal.record(job.key, status="done", output=str(job.output))
+            else:
+                self.failed += 1
+                self.journal.record(job.key, status="failed", error=str(error))
+            self.latencies.append(now - job.seen)
+            self.process_times.append(now - job.started)
+
+    @staticmethod
+    def changed(job: _Job) -> bool:
+        try:
+            stat = job.path.stat()
+        except OSError:
+            return False
+        return (stat.st_size, stat.st_mtime_ns) != (job.size, job.mtime_ns)
+
+    """
+    Running
+    """
+
+    def backlog(self) -> int:
+        return len(self.settling) + len(self.queued) + len(self.running)
+
+    def metrics(self) -> dict:
+        percentile = ServiceMetrics.percentile
+        latencies = list(self.latencies)
+        process_times = list(self.process_times)
+        uptime = time.monotonic() - self.started
+        return {
+            "backlog": self.backlog(),
+            "settling": len(self.settling),
+            "queued": len(self.queued),
+            "in_flight": len(self.running),
+            "completed": self.completed,
+            "failed": self.failed,
+            "journal_entries": len(self.journal),
+            "latency_ms": {
+                f"p{percent}": 1000 * percentile(latencies, percent) for percent in (50, 95, 99)
+            },
+            "process_ms": {
+                f"p{percent}": 1000 * percentile(process_times, percent)
+                for percent in (50, 95, 99)
+            },
+            "throughput_per_s": (self.completed + self.failed) / uptime if uptime else 0.0,
+            "uptime_s": uptime,
+        }
+
+    def write_metrics(self, metrics_path):
+        metrics_path = pathlib.Path(metrics_path)
+        temp_path = metrics_path.with_name(f".{metrics_path.name}.tmp")
+        temp_path.write_text(json.dumps(self.metrics(), indent=2), encoding="utf-8")
+        os.replace(temp_path, metrics_path)
+
+    def run(self, once: bool = False, metrics_path=None):
+        """
+        Poll until stop() is called
+        :param once: stop when the files present are all handled
+        :param metrics_path: JSON file rewritten with metrics() after every poll
+        """
+        while not self._stop.is_set():
+            self.poll()
+            if metrics_path:
+                self.write_metrics(metrics_path)
+            if once and self.backlog() == 0:
+                break
+            self._stop.wait(self.interval)
+        self.collect(wait=True)
+        if metrics_path:
+            self.write_metrics(metrics_path)
+
+    def stop(self):
+        self._stop.set()
+
+    def close(self):
+        self.stop()
+        self.executor.shutdown(wait=True)
+        self.collect(wait=True)
+        self.journal.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a recipe on images dropped in directories")
+    parser.add_argument("directories", nargs="+")
+    parser.add_argument("--recipe", required=True, help="recipe JSON file")
+    parser.add_argument("--output", required=True)
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--settle", type=float, default=1.0, help="seconds a file must not change")
+    parser.add_argument("--interval", type=float, default=0.5, help="seconds between polls")
+    parser.add_argument("--format", help="output suffix, e.g. .png")
+    parser.add_argument("--journal", help="journal file, in the output directory by default")
+    parser.add_argument("--metrics", help="JSON file updated with backlog and latency")
+    parser.add_argument("--once", action="store_true", help="exit when the backlog is empty")
+    args = parser.parse_args()
+
+    watcher = HotFolder(
+        args.directories,
+        args.output,
+        Recipe.load(args.recipe),
+        workers=args.workers,
+        settle=args.settle,
+        interval=args.interval,
+        output_format=args.format,
+        journal_path=args.journal,
+    )
+    signal.signal(signal.SIGTERM, lambda *_: watcher.stop())
+    with watcher:
+        try:
+            watcher.run(args.once, args.metrics)
+        except KeyboardInterrupt:
+            pass
+    print(json.dumps(watcher.metrics()))
+
+
+if __name__ == "__main__":
+    main()
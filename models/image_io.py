@@ -0,0 +1,196 @@
+""" Decode and encode images keeping their bit depth """
+import io
+import pathlib
+
+import cv2
+import numpy as np
+from PIL import Image
+
+
+class ImageIO:
+    """
+    Class open and save images.
+    8-bit images are PIL Image objects, 16-bit images are uint16 numpy
+    arrays in RGB(A) channel order so they are never quantized on load
+    """
+
+    @staticmethod
+    def bit_depth(img: Image.Image) -> int:
+        """
+        Read bits per channel from the image header without decoding
+        :param img: Image opened by Image.open
+        :return: 8 or 16
+        """
+        if img.mode.startswith("I;16"):
+            return 16
+        for tile in img.tile:
+            raw_mode = tile[3][0] if isinstance(tile[3], tuple) else tile[3]
+            if isinstance(raw_mode, str) and ";16" in raw_mode:
+                return 16
+        return 8
+
+    @staticmethod
+    def get_information(image_path: str) -> dict:
+        """
+        Get basic information of an image file
+        :return: dict contain image's information : name, format, size, mode, depth
+        """
+        with Image.open(image_path) as img:
+            return {
+                "name": img.filename,
+                "format": img.format,
+                "size": img.size,
+                "mode": img.mode,
+                "depth": ImageIO.bit_depth(img),
+            }
+
+    @staticmethod
+    def read_array(image_path: str) -> np.ndarray:
+        """
+        Decode an image file to numpy array with its own dtype, RGB(A) order
+        :return: numpy array
+        """
+        image = cv2.imread(str(image_path), cv2.IMREAD_UNCHANGED)
+        if image is None:
+            raise OSError(f"Cannot decode image: {image_path}")
+        return ImageIO.from_cv2_order(image)
+
+    @staticmethod
+    def from_cv2_order(image: np.ndarray) -> np.ndarray:
+        """
+        BGR(A) array decoded by cv2 to RGB(A)
+        """
+        if image.ndim == 3 and image.shape[2] == 3:
+            return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        if image.ndim == 3 and image.shape[2] == 4:
+            return cv2.cvtColor(image, cv2.COLOR_BGRA2RGBA)
+        return image
+
+    @staticmethod
+    def to_cv2_order(image: np.ndarray) -> np.ndarray:
+        """
+        RGB(A) array to BGR(A) for cv2 encoders
+        """
+        if image.ndim == 3 and image.shape[2] == 3:
+            return cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+        if image.ndim == 3 and image.shape[2] == 4:
+            return cv2.cvtColor(image, cv2.COLOR_RGBA2BGRA)
+        return image
+
+    @staticmethod
+    def open_image(image_path: str):
+        """
+        Open image, 16-bit files are decoded to uint16 numpy array
+        :return: Image object (PIL) or numpy array
+        """
+        img = Image.open(image_path)
+        if ImageIO.bit_depth(img) == 16:
+            img.close()
+            return ImageIO.read_array(image_path)
+        return img
+
+    @staticmethod
+    def decode_bytes(data: bytes):
+        """
+        Same as open_image for an encoded file held in memory
+        :return: Image object (PIL) or numpy array
+        """
+        img = Image.open(io.BytesIO(data))
+        if ImageIO.bit_depth(img) == 16:
+            img.close()
+            image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_UNCHANGED)
+            if image is None:
+                raise OSError("Cannot decode image data")
+            return ImageIO.from_cv2_order(image)
+        return img
+
+    @staticmethod
+    def encode_bytes(image, image_format: str = "PNG") -> bytes:
+        """
+        Same as save_image, to bytes
+        :param image_format: PIL format name, e.g. "PNG", "JPEG", "TIFF"
+        """
+        if not isinstance(image, np.ndarray):
+            if image_format.upper() in ("JPEG", "JPG") and image.mode not in ("L", "RGB", "CMYK"):
+                image = image.convert("RGB")
+            buffer = io.BytesIO()
+            image.save(buffer, format=image_format)
+            return buffer.getvalue()
+
+        success, data = cv2.imencode(f".{image_format.lower()}", ImageIO.to_cv2_order(image))
+        if not success:
+            raise OSError(f"Cannot encode {image.dtype} image as {image_format}")
+        return data.tobytes()
+
+    @staticmethod
+    def save_image(image, image_path: str):
+        """
+        Encode image to file. Numpy arrays are written with their own dtype,
+        use PNG or TIFF to keep 16 bits per channel
+        :param image: Image object (PIL) or numpy array
+        """
+        if not isinstance(image, np.ndarray):
+            image.save(image_path)
+            return
+
+        image = ImageIO.to_cv2_order(image)
+        if not cv2.imwrite(str(image_path), image):
+            suffix = pathlib.Path(image_path).suffix
+            raise OSError(f"Cannot encode {image.dtype} image as {suffix}")
+
+    @staticmethod
+    def write_jpeg_orientation(source_path: str, image_path: str, tag: int):
+        """
+        Copy a JPEG file, only changing its EXIF orientation tag.
+        Compressed data is copied as is, so there is no re-encoding loss
+        :param tag: EXIF orientation value 1-8
+        """
+        with open(source_path, "rb") as file:
+            data = file.read()
+        if data[:2] != b"\xff\xd8":
+            raise ValueError(f"Not a JPEG file: {source_path}")
+
+        with Image.open(source_path) as img:
+            exif = img.getexif()
+        exif[0x0112] = tag
+        payload = exif.tobytes()
+        if len(payload) > 0xFFFF - 2:
+            raise ValueError("EXIF data too large for one APP1 segment")
+        app1 = b"\xff\xe1" + (len(payload) + 2).to_bytes(2, "big") + payload
+
+        # Walk the segments before the image data: keep APP0 (JFIF) first,
+        # replace an existing Exif APP1 or insert ours after APP0
+        position = 2
+        insert_at = 2
+        segments_end = None
+        while position + 4 <= len(data) and data[position] == 0xFF:
+            marker = data[position + 1]
+            length = int.from_bytes(data[position + 2 : position + 4], "big")
+            end = position + 2 + length
+            if marker == 0xE0:
+                insert_at = end
+            elif marker == 0xE1 and data[position + 4 : position + 10] == b"Exif\0\0":
+                segments_end = (position, end)
+                break
+            elif marker == 0xDA:
+                break
+            position = end
+
+        if segments_end:
+            data = data[: segments_end[0]] + app1 + data[segments_end[1] :]
+        else:
+            data = data[:insert_at] + app1 + data[insert_at:]
+        with open(image_path, "wb") as file:
+            file.write(data)
+
+    @staticmethod
+    def to_display(image) -> Image.Image:
+        """
+        Make an 8-bit PIL copy of image for display
+        :return: Image object (PIL)
+        """
+        if not isinstance(image, np.ndarray):
+            return image
+        if image.dtype == np.uint16:
+            image = (image >> 8).astype(np.uint8)
+        return Image.fromarray(image)
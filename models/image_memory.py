@@ -0,0 +1,291 @@
+""" Memory accounting of image buffers with spill to disk """
+import collections
+import itertools
+import os
+import shutil
+import tempfile
+import time
+import weakref
+
+import numpy as np
+from PIL import Image
+
+
+class _Buffer:
+    __slots__ = ("image", "path", "nbytes", "pinned", "used")
+
+    def __init__(self, image, nbytes: int, pinned: bool):
+        self.image = image
+        self.path = None
+        self.nbytes = nbytes
+        self.pinned = pinned
+        self.used = time.monotonic()
+
+
+class ImageMemory:
+    """
+    Class hold named image buffers (Image objects or numpy arrays) and
+    count the bytes they use. The same object stored under several names
+    is counted once.
+    With max_bytes set, the least recently used buffers that are not pinned
+    are written to disk when the total goes over the cap: 8-bit images as
+    fast compressed PNG, numpy arrays as .npy files. A spilled buffer is
+    read back when it is next used, numpy arrays as read only memory maps.
+    Buffers are shared copy on write: an object held by several names has
+    a share count above one and must be copied before it is changed
+    """
+
+    # Bytes per pixel PIL uses in memory, RGB is stored as 4 bytes
+    MODE_BYTES = {"1": 1, "L": 1, "P": 1, "I;16": 2, "I;16B": 2, "I;16L": 2}
+    PNG_MODES = ("1", "L", "LA", "P", "RGB", "RGBA", "I;16")
+    _counter = itertools.count()
+
+    def __init__(self, max_bytes: int = None, spill_dir: str = None, on_change=None):
+        """
+        :param max_bytes: hard cap of resident bytes, None for no cap
+        :param spill_dir: where spilled buffers go, a temporary directory by default
+        :param on_change: callable() run after buffers or totals change
+        """
+        self.max_bytes = max_bytes
+        self.spill_root = spill_dir
+        self.spill_dir = None
+        self.on_change = on_change
+        self.buffers = collections.OrderedDict()
+        self.spills = 0
+        self.reloads = 0
+
+    @staticmethod
+    def image_bytes(image) -> int:
+        if image is None:
+            return 0
+        if isinstance(image, np.ndarray):
+            # A memory map is backed by its file, not by RAM
+            return 0 if _is_mapped(image) else image.nbytes
+        width, height = image.size
+        return width * height * ImageMemory.MODE_BYTES.get(image.mode, 4)
+
+    """
+    Buffers
+    """
+
+    def put(self, name: str, image, pinned: bool = False):
+        """
+        Store image under name, None removes it
+        :param pinned: never spill this buffer (e.g. the image on screen)
+        """
+        old = self.buffers.pop(name, None)
+        if image is not None:
+            self.buffers[name] = _Buffer(image, self.image_bytes(image), pinned)
+        if old is not None:
+            self.release(old)
+        self.enforce()
+        self.changed()
+
+    def get(self, name: str, default=None):
+        """
+        Image stored under name, read back from disk when it was spilled
+        """
+        buffer = self.buffers.get(name)
+        if buffer is None:
+            return default
+        buffer.used = time.monotonic()
+        self.buffers.move_to_end(name)
+        if buffer.image is None:
+            self.reload(buffer)
+            image = buffer.image
+            self.enforce(keep=image)
+            self.changed()
+            return image
+        return buffer.image
+
+    def discard(self, name: str):
+        self.put(name, None)
+
+    def clear(self):
+        for name in list(self.buffers):
+            self.release(self.buffers.pop(name))
+        self.changed()
+
+    def share_count(self, image) -> int:
+        """
+        Names holding the image object
+        """
+        return sum(1 for buffer in self.buffers.values() if buffer.image is image)
+
+    def is_exclusive(self, name: str) -> bool:
+        """
+        True when the image under name may be changed in place: resident,
+        writable and held by no other name
+        """
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.image is None:
+            return False
+        image = buffer.image
+        if isinstance(image, np.ndarray) and not image.flags.writeable:
+            return False
+        return self.share_count(image) == 1
+
+    def is_spilled(self, name: str) -> bool:
+        buffer = self.buffers.get(name)
+        return buffer is not None and buffer.image is None
+
+    def release(self, buffer: _Buffer):
+        """
+        Delete the spill file of a removed buffer when no other name uses it
+        """
+        if buffer.path is None:
+            return
+        if any(other.path == buffer.path for other in self.buffers.values()):
+            return
+        if os.path.exists(buffer.path):
+            os.remove(buffer.path)
+
+    """
+    Accounting
+    """
+
+    def unique_buffers(self):
+        """
+        Resident buffers, one per distinct image object
+        """
+        seen = set()
+        for buffer in self.buffers.values():
+            if buffer.image is not None and id(buffer.image) not in seen:
+                seen.add(id(buffer.image))
+                yield buffer
+
+    def total_bytes(self) -> int:
+        return sum(buffer.nbytes for buffer in self.unique_buffers())
+
+    def spilled_bytes(self) -> int:
+        paths = {buffer.path for buffer in self.buffers.values() if buffer.image is None}
+        return sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+
+    def stats(self) -> dict:
+        return {
+            "buffers": len(self.buffers),
+            "shared": sum(
+                1 for buffer in self.unique_buffers() if self.share_count(buffer.image) > 1
+            ),
+            "resident_bytes": self.total_bytes(),
+            "spilled_bytes": self.spilled_bytes(),
+            "max_bytes": self.max_bytes,
+            "spills": self.spills,
+            "reloads": self.reloads,
+        }
+
+    def set_max_bytes(self, max_bytes: int = None):
+        self.max_bytes = max_bytes
+        self.enforce()
+        self.changed()
+
+    def changed(self):
+        if self.on_change is not None:
+            self.on_change()
+
+    """
+    Spilling
+    """
+
+    def enforce(self, keep=None):
+        """
+        Spill the least recently used unpinned buffers until the total fits
+        the cap. Buffers sharing their object with a pinned one stay
+        :param keep: image object that must stay in memory
+        """
+        if self.max_bytes is None:
+            return
+        total = self.total_bytes()
+        if total <= self.max_bytes:
+            return
+        pinned = {id(buffer.image) for buffer in self.buffers.values() if buffer.pinned}
+        pinned.add(id(keep))
+        for buffer in sorted(self.unique_buffers(), key=lambda item: item.used):
+            if total <= self.max_bytes:
+                break
+            if id(buffer.image) in pinned or buffer.nbytes == 0:
+                continue
+            total -= buffer.nbytes
+            self.spill(buffer.image)
+
+    def spill(self, image):
+        """
+        Write image to disk and drop it from every buffer holding it
+        """
+        holders = [buffer for buffer in self.buffers.values() if buffer.image is image]
+        path = holders[0].path
+        if path is None or not os.path.exists(path):
+            path = self.write(image)
+        for buffer in holders:
+            buffer.image = None
+            buffer.path = path
+        self.spills += 1
+
+    def write(self, image) -> str:
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(prefix="pyimgedit-spill-", dir=self.spill_root)
+            weakref.finalize(self, shutil.rmtree, self.spill_dir, True)
+        stem = os.path.join(self.spill_dir, str(next(self._counter)))
+        if isinstance(image, np.ndarray):
+            path = stem + ".npy"
+            np.save(path, image)
+        elif image.mode in self.PNG_MODES:
+            path = stem + ".png"
+            image.save(path, format="PNG", compress_level=1)
+        else:
+            path = stem + ".tiff"
+            image.save(path, format="TIFF", compression="tiff_deflate")
+        return path
+
+    def reload(self, buffer: _Buffer):
+        """
+        Read a spilled buffer back, every name sharing it gets the same object
+        """
+        if buffer.path.endswith(".npy"):
+            image = np.load(buffer.path, mmap_mode="r")
+        else:
+            image = Image.open(buffer.path)
+            image.load()
+        nbytes = self.image_bytes(image)
+        for other in self.buffers.values():
+            if other.path == buffer.path and other.image is None:
+                other.image = image
+                other.nbytes = nbytes
+        self.reloads += 1
+
+    def close(self):
+        self.clear()
+        if self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            self.spill_dir = None
+
+
+def _is_mapped(array: np.ndarray) -> bool:
+    base = array
+    while isinstance(base, np.ndarray):
+        if isinstance(base, np.memmap):
+            return True
+        base = base.base
+    return False
+
+
+class ManagedImage:
+    """
+    Descriptor keeping an attribute in the owner's ImageMemory, stored in
+    owner.image_memory under the attribute name
+    """
+
+    def __init__(self, pinned: bool = False):
+        self.pinned = pinned
+        self.name = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return instance.image_memory.get(self.name)
+
+    def __set__(self, instance, image):
+        instance.image_memory.put(self.name, image, self.pinned)
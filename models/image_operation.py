@@ -3,6 +3,10 @@ from PIL import Image, ImageFilter, ImageOps, ImageEnhance
 import numpy as np
 import cv2
 
+from models.affine_transform import AffineTransform
+from models.auto_enhance import AutoEnhance
+from models.lookup_table import LookupTable
+
 
 class ImageOperation:
     """
@@ -24,8 +28,36 @@ class ImageOperation:
 
     @staticmethod
     def get_image_array(img: Image):
+        if isinstance(img, np.ndarray):
+            return img
         return np.array(img)
 
+    @staticmethod
+    def from_image_array(image: np.ndarray, like):
+        """
+        Wrap result array the same way as the input image
+        :param image: numpy array
+        :param like: input Image object (PIL) or numpy array
+        :return: numpy array for numpy input, Image object (PIL) otherwise
+        """
+        if isinstance(like, np.ndarray):
+            return image
+        return Image.fromarray(image)
+
+    @staticmethod
+    def can_write(img, in_place: bool) -> bool:
+        """
+        True when the result may be written over img: the caller gave the
+        buffer away (in_place) and it is a writable contiguous numpy array.
+        Image objects (PIL) are never written in place
+        """
+        return (
+            in_place
+            and isinstance(img, np.ndarray)
+            and img.flags.writeable
+            and img.flags.c_contiguous
+        )
+
     @staticmethod
     def get_information(img: Image) -> dict:
         """
@@ -45,21 +77,53 @@ class ImageOperation:
         Resize image (Create low resolution image from original image)
         :param img: Image
         :param radius: how many times decrease the resolution
-        :return: Image object (PIL)
+        :return: Image object (PIL), or numpy array for numpy input
         """
+        if isinstance(img, np.ndarray):
+            height, width = img.shape[:2]
+            size = (max(1, width // radius), max(1, height // radius))
+            return cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+
         return img.resize(
-            img.width // radius,
-            img.height // radius,
+            (max(1, img.width // radius), max(1, img.height // radius)),
             resample=Image.Resampling.HAMMING,  # Better performance and quality
         )
 
+    # Transpose directions cv2.flip can run in place, with its flip code
+    FLIP_CODES = {
+        Image.Transpose.FLIP_LEFT_RIGHT: 1,
+        Image.Transpose.FLIP_TOP_BOTTOM: 0,
+        Image.Transpose.ROTATE_180: -1,
+    }
+
     @staticmethod
-    def transpose_image(img: Image, direction: Image.Transpose):
+    def transpose_image(img: Image, direction: Image.Transpose, in_place: bool = False):
         """
         Transpose image to direction
-        :return: new Image object (PIL)
+        :param in_place: img may be overwritten, flips then reuse its buffer
+        :return: new Image object (PIL), or numpy array for numpy input
         """
-        return img.transpose(direction)
+        if not isinstance(img, np.ndarray):
+            return img.transpose(direction)
+
+        if direction in ImageOperation.FLIP_CODES and ImageOperation.can_write(img, in_place):
+            return cv2.flip(img, ImageOperation.FLIP_CODES[direction], dst=img)
+
+        if direction == Image.Transpose.FLIP_LEFT_RIGHT:
+            image = img[:, ::-1]
+        elif direction == Image.Transpose.FLIP_TOP_BOTTOM:
+            image = img[::-1]
+        elif direction == Image.Transpose.ROTATE_90:
+            image = np.rot90(img, 1)
+        elif direction == Image.Transpose.ROTATE_180:
+            image = np.rot90(img, 2)
+        elif direction == Image.Transpose.ROTATE_270:
+            image = np.rot90(img, 3)
+        elif direction == Image.Transpose.TRANSPOSE:
+            image = img.swapaxes(0, 1)
+        else:
+            image = np.rot90(img, 2).swapaxes(0, 1)
+        return np.ascontiguousarray(image)
 
     @staticmethod
     def rotate_image(img: Image, degrees: int) -> Image:
@@ -67,10 +131,41 @@ class ImageOperation:
         Rotate image by given degrees
         :param img: Image
         :param degrees: int
-        :return: new Image object (PIL)
+        :return: new Image object (PIL), or numpy array for numpy input
         """
+        if isinstance(img, np.ndarray):
+            height, width = img.shape[:2]
+            return AffineTransform((width, height)).rotate(degrees).apply(img)
         return img.rotate(degrees, expand=True)
 
+    @staticmethod
+    def crop_image(img: Image, box: tuple):
+        """
+        Cut the (left, top, right, bottom) box out of image
+        :return: new Image object (PIL), or numpy array for numpy input
+        """
+        if not isinstance(img, np.ndarray):
+            return img.crop(tuple(box))
+        left, top, right, bottom = box
+        height, width = img.shape[:2]
+        if not (0 <= left < right <= width and 0 <= top < bottom <= height):
+            return AffineTransform((width, height)).crop(box).apply(img)
+        return np.ascontiguousarray(img[top:bottom, left:right])
+
+    @staticmethod
+    def affine_transform(img: Image, steps: list):
+        """
+        Run geometric steps (resize, rotate, transpose, crop) as a single
+        resampling (see AffineTransform)
+        :param steps: list of (operation name, params)
+        :return: new Image object (PIL), or numpy array for numpy input
+        """
+        if isinstance(img, np.ndarray):
+            size = (img.shape[1], img.shape[0])
+        else:
+            size = img.size
+        return AffineTransform.from_steps(size, steps).apply(img)
+
     @staticmethod
     def brightness_image(img: Image, factor: float) -> Image:
         """
@@ -161,11 +256,18 @@ class ImageOperation:
         return outline
 
     @staticmethod
-    def invert_image(img: Image) -> Image:
+    def invert_image(img: Image, in_place: bool = False) -> Image:
         """
         Return the invert version of image
-        :return: Image
+        :param in_place: img may be overwritten
+        :return: Image, or numpy array for numpy input
         """
+        if isinstance(img, np.ndarray):
+            if img.ndim == 3 and img.shape[2] == 4:
+                return np.invert(img[:, :, :3])
+            out = img if ImageOperation.can_write(img, in_place) else None
+            return np.invert(img, out=out)
+
         if img.mode == "RGBA":
             img = img.convert("RGB")
 
@@ -173,49 +275,85 @@ class ImageOperation:
 
     @staticmethod
     def gamma_correction(img: Image, gamma) -> Image:
-        normalization_const = 255.0 / np.float_power(255, gamma)
-
-        image = np.array(img)
-        # compute output = constant * in^gamma
-        output = np.uint8(normalization_const * np.float_power(image, gamma))
-
-        return Image.fromarray(output)
+        return ImageOperation.gamma_transform(img, gamma)
 
     @staticmethod
     def histogram_equalization(img: Image) -> Image:
         """
-        Histogram Equalization using Pillow Library
-        :param img: Image
-        :return: Image
+        Histogram Equalization, 16-bit images use a 65536 entries table
+        :param img: Image or numpy array
+        :return: Image, or numpy array for numpy input
         """
-        img = img.convert("L")
-        input_image = ImageOperation.get_image_array(img)
-        image = cv2.equalizeHist(input_image)
-        # return ImageOps.equalize(img)
-        return Image.fromarray(image)
+        if not isinstance(img, np.ndarray):
+            img = img.convert("L")
+            input_image = ImageOperation.get_image_array(img)
+            image = cv2.equalizeHist(input_image)
+            # return ImageOps.equalize(img)
+            return Image.fromarray(image)
+
+        image = img
+        if image.ndim == 3:
+            code = cv2.COLOR_RGBA2GRAY if image.shape[2] == 4 else cv2.COLOR_RGB2GRAY
+            image = cv2.cvtColor(image, code)
+        if image.dtype == np.uint8:
+            return cv2.equalizeHist(image)
+        return LookupTable.apply(image, LookupTable.equalization(image))
 
     @staticmethod
-    def log_transform(img: Image) -> Image:
+    def log_transform(img: Image, scale: float = 1.0, in_place: bool = False) -> Image:
         # Calculate the normalization const
         # ref: https://www.geeksforgeeks.org/log-transformation-of-an-image-using-python-and-opencv/
 
-        if img.mode == "RGBA":
+        if isinstance(img, np.ndarray):
+            if img.ndim == 3 and img.shape[2] == 4:
+                img = img[:, :, :3]
+        elif img.mode == "RGBA":
             img = img.convert("RGB")
 
-        image = np.array(img)
-        normalization_const = 255 / np.log(1 + np.max(image))
-        log_img = normalization_const * (np.log(image + 1))
-        # convert to int
-        log_img = np.array(log_img, dtype=np.uint8)
+        image = ImageOperation.get_image_array(img)
+        table = LookupTable.log(int(np.max(image)), image.dtype, scale)
+        out = image if ImageOperation.can_write(img, in_place) else None
+        log_img = LookupTable.apply(image, table, out)
 
-        return Image.fromarray(log_img)
+        return ImageOperation.from_image_array(log_img, img)
 
     @staticmethod
-    def gamma_transform(img: Image, gamma_value: float):
-        image = np.array(img)
-        normalization_const = 255.0 / np.float_power(255, gamma_value)
-        gamma_img = np.uint8(normalization_const * np.float_power(image, gamma_value))
+    def apply_lookup_table(img: Image, table, in_place: bool = False) -> Image:
+        """
+        Map every channel of image through table
+        :param table: one entry per value of the image dtype
+        :param in_place: img may be overwritten
+        :return: new Image object (PIL), or numpy array for numpy input
+        """
+        image = ImageOperation.get_image_array(img)
+        table = np.asarray(table).astype(image.dtype)
+        if len(table) != LookupTable.max_value(image.dtype) + 1:
+            raise ValueError(f"Table of {len(table)} entries for {image.dtype} image")
 
-        return Image.fromarray(gamma_img)
+        out = image if ImageOperation.can_write(img, in_place) else None
+        return ImageOperation.from_image_array(LookupTable.apply(image, table, out), img)
+
+    @staticmethod
+    def auto_enhance(
+        img: Image, sample_size: int = AutoEnhance.SAMPLE_SIZE, seed: int = 0, in_place: bool = False
+    ):
+        """
+        Levels, gamma and contrast picked from a sample of the pixels,
+        applied in one table pass (see AutoEnhance)
+        :param in_place: img may be overwritten
+        :return: new Image object (PIL), or numpy array for numpy input
+        """
+        analysis = AutoEnhance.analyze(img, sample_size, seed)
+        return AutoEnhance.apply(img, analysis, in_place)
+
+    @staticmethod
+    def gamma_transform(img: Image, gamma_value: float, in_place: bool = False):
+        # output = constant * in^gamma, computed once per value of the dtype
+        image = ImageOperation.get_image_array(img)
+        table = LookupTable.gamma(gamma_value, image.dtype)
+        out = image if ImageOperation.can_write(img, in_place) else None
+        gamma_img = LookupTable.apply(image, table, out)
+
+        return ImageOperation.from_image_array(gamma_img, img)
 
 
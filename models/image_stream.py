@@ -0,0 +1,211 @@
+""" Streaming recipe runs over many encoded images with bounded memory """
+import os
+import pathlib
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+
+from models.image_io import ImageIO
+from models.parallel import bounded_map, default_workers
+from models.recipe import Recipe
+
+
+class StreamResult:
+    """
+    Outcome of one source: output is the encoded bytes, or the path written
+    when the stream writes files. error is the exception raised by the
+    source when the stream does not raise errors, output is then None.
+    seconds holds the time spent per stage: decode, process, encode
+    """
+
+    __slots__ = ("index", "source", "output", "error", "seconds")
+
+    def __init__(self, index: int, source, output=None, error=None, seconds: dict = None):
+        """
+        :param source: input path, None for bytes so they are not kept alive
+        """
+        self.index = index
+        self.source = source
+        self.output = output
+        self.error = error
+        self.seconds = seconds or {}
+
+    def __repr__(self):
+        output = f"{len(self.output)} bytes" if isinstance(self.output, bytes) else self.output
+        return f"StreamResult({self.index}, {self.source!r} -> {output}, error={self.error!r})"
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+class ImageStream:
+    """
+    Class run a recipe on a stream of encoded images, given as file paths or
+    bytes, producing encoded bytes or files.
+    Every source goes through decode, process and encode on one worker
+    thread; with several sources in flight the stages of different sources
+    overlap (one decoding while another is processed or written), and cv2 /
+    PIL release the GIL for all of them. Sources are pulled lazily and at
+    most max_in_flight are decoded, processed or waiting to be yielded, so
+    memory stays bounded whatever the number of sources
+    """
+
+    # Output suffix of a format, the others use the lowercase format name
+    SUFFIXES = {"JPEG": ".jpg", "TIFF": ".tif"}
+
+    def __init__(
+        self,
+        recipe,
+        workers: int = None,
+        max_in_flight: int = None,
+        output=None,
+        image_format: str = None,
+        raise_errors: bool = True,
+    ):
+        """
+        :param recipe: Recipe, list of steps or JSON text
+        :param output: None to yield encoded bytes, a directory to write
+            files into (named by source index, then source file name), or
+            callable(index, source) -> output path
+        :param image_format: PIL format name of the outputs, by default the
+            output path suffix, else the source format, else PNG
+        :param raise_errors: a failing source stops the stream, otherwise
+            its StreamResult holds the error
+        """
+        if isinstance(recipe, str):
+            recipe = Recipe.from_json(recipe)
+        elif not isinstance(recipe, Recipe):
+            recipe = Recipe(recipe)
+        self.recipe = recipe
+        self.workers = workers or default_workers()
+        self.max_in_flight = max_in_flight or 2 * self.workers
+        self.output = output
+        self.image_format = image_format
+        self.raise_errors = raise_errors
+        self.extensions = Image.registered_extensions()
+
+    @staticmethod
+    def is_path(source) -> bool:
+        return isinstance(source, (str, os.PathLike))
+
+    def decode(self, source) -> tuple:
+        """
+        :param source: file path or encoded bytes
+        :return: (Image object (PIL) or numpy array, format name or None)
+        """
+        if self.is_path(source):
+            image = ImageIO.open_image(source)
+            image_format = self.extensions.get(pathlib.Path(source).suffix.lower())
+        else:
+            image = ImageIO.decode_bytes(bytes(source))
+            image_format = None
+        if not isinstance(image, np.ndarray):
+            image_format = image_format or image.format
+            # A truncated source fails here rather than inside the recipe
+            image.load()
+        return image, image_format
+
+    def suffix(self, image_format: str) -> str:
+        return self.SUFFIXES.get(image_format, f".{image_format.lower()}")
+
+    def output_path(self, index: int, source, image_format: str):
+        """
+        :return: pathlib.Path the result of source is written to, None for
+            bytes. The index prefix keeps sources with the same file name
+            (from different folders, or given twice) apart
+        """
+        if self.output is None:
+            return None
+        if callable(self.output):
+            return pathlib.Path(self.output(index, source))
+        if self.is_path(source):
+            name = f"{index:06d}-{pathlib.Path(source).name}"
+            if self.image_format:
+                name = pathlib.Path(name).with_suffix(self.suffix(image_format)).name
+        else:
+            name = f"{index:06d}{self.suffix(image_format)}"
+        return pathlib.Path(self.output) / name
+
+    @staticmethod
+    def write(data: bytes, path: pathlib.Path):
+        """
+        Write to a hidden file next to path then rename it, readers never
+        see a partial file
+        """
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(temp_path, "wb") as file:
+            file.write(data)
+        os.replace(temp_path, path)
+
+    def run(self, index: int, source) -> StreamResult:
+        seconds = {}
+        start = time.perf_counter()
+        image, source_format = self.decode(source)
+        seconds["decode"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        # The decoded image is ours, steps may write over it
+        image = self.recipe.apply(image, in_place=True)
+        seconds["process"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        image_format = self.image_format or source_format or "PNG"
+        path = self.output_path(index, source, image_format)
+        if path is not None and not self.image_format:
+            image_format = self.extensions.get(path.suffix.lower(), image_format)
+        output = ImageIO.encode_bytes(image, image_format)
+        del image
+        if path is not None:
+            self.write(output, path)
+            output = path
+        seconds["encode"] = time.perf_counter() - start
+        return StreamResult(index, source if self.is_path(source) else None, output, None, seconds)
+
+    def run_item(self, item: tuple) -> StreamResult:
+        index, source = item
+        try:
+            return self.run(index, source)
+        except Exception as error:
+            if self.raise_errors:
+                raise
+            return StreamResult(index, source if self.is_path(source) else None, error=error)
+
+    def iter(self, sources, ordered: bool = True):
+        """
+        :param sources: iterable of file paths or bytes, consumed lazily
+        :param ordered: yield in source order, otherwise as completed
+        :return: generator of StreamResult
+        """
+        return bounded_map(
+            self.run_item,
+            enumerate(sources),
+            workers=self.workers,
+            max_in_flight=self.max_in_flight,
+            ordered=ordered,
+        )
+
+
+def process_iter(
+    sources,
+    recipe,
+    workers: int = None,
+    max_in_flight: int = None,
+    ordered: bool = True,
+    output=None,
+    image_format: str = None,
+    raise_errors: bool = True,
+):
+    """
+    Run recipe on every source, e.g.
+    for result in process_iter(paths, recipe, output="out/"): print(result.output)
+    :param sources: iterable of file paths or encoded bytes, consumed lazily
+    :param max_in_flight: sources held in memory at once, default 2 * workers
+    :param ordered: yield in source order, otherwise as completed
+    :return: generator of StreamResult, see ImageStream for the other params
+    """
+    stream = ImageStream(recipe, workers, max_in_flight, output, image_format, raise_errors)
+    return stream.iter(sources, ordered)
@@ -0,0 +1,630 @@
+""" Stack of image layers with opacity, masks and blend modes """
+import math
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from models.parallel import bounded_map, default_workers
+
+
+class Layer:
+    """
+    One layer of a LayerStack: color pixels of the canvas dtype and
+    channels, at offset (left, top) on the canvas. Coverage is
+    alpha x mask x opacity, alpha and mask are None when full.
+    Change layers through LayerStack so the tiles they cover are redrawn
+    """
+
+    __slots__ = ("name", "color", "alpha", "mask", "opacity", "blend", "offset", "visible")
+
+    def __init__(self, name: str, color: np.ndarray, alpha: np.ndarray = None):
+        self.name = name
+        self.color = color
+        self.alpha = alpha
+        self.mask = None
+        self.opacity = 1.0
+        self.blend = LayerStack.NORMAL
+        self.offset = (0, 0)
+        self.visible = True
+
+    def __repr__(self):
+        return (
+            f"Layer({self.name!r}, {self.blend}, opacity={self.opacity:g},"
+            f" box={self.box}, mask={self.mask is not None})"
+        )
+
+    @property
+    def box(self) -> tuple:
+        """
+        (left, top, right, bottom) covered on the canvas
+        """
+        height, width = self.color.shape[:2]
+        left, top = self.offset
+        return left, top, left + width, top + height
+
+
+class LayerStack:
+    """
+    Class composite layers, bottom first, on a canvas starting black.
+    Each layer is blended with the pixels below it then mixed in by its
+    coverage: out = below + (blend(below, layer) - below) * coverage.
+    A canvas with alpha (LA, RGBA) keeps straight colors and an alpha
+    channel: a layer is mixed "over" the pixels below by their alpha, so
+    transparent parts stay transparent and pixels no layer covers keep
+    their exact values.
+    Pixels are integers all along: x * y / max is computed in the double
+    width type (uint16 for 8-bit canvases, uint32 for 16-bit ones) with
+    round(t / 255) = (t + 128 + ((t + 128) >> 8)) >> 8, exact for t up to
+    255 * 255 (same with 65535 and 16 bits).
+    The canvas is cut into tiles: a change marks the tiles of the layer
+    box dirty and render() only recomposites those. The composite of the
+    layers below the last changed layer and the blend of that layer are kept
+    per tile, so dragging the opacity of one layer only mixes it again (and
+    composites the layers above it). They cost up to twice the canvas in
+    the wide type while kept
+    """
+
+    NORMAL = "normal"
+    MULTIPLY = "multiply"
+    SCREEN = "screen"
+    OVERLAY = "overlay"
+    BLEND_MODES = (NORMAL, MULTIPLY, SCREEN, OVERLAY)
+
+    MODES = ("L", "LA", "RGB", "RGBA")
+    # PIL modes read as they are, the others are converted to RGB(A)
+    PIL_MODES = ("L", "LA", "RGB", "RGBA", "I;16")
+    TILE_SIZE = 256
+
+    def __init__(
+        self,
+        size: tuple,
+        mode: str = "RGB",
+        dtype=np.uint8,
+        tile_size: int = TILE_SIZE,
+        workers: int = None,
+    ):
+        """
+        :param size: (width, height) of the canvas
+        :param mode: canvas mode, L, LA, RGB or RGBA
+        :param dtype: np.uint8 or np.uint16
+        :param workers: threads compositing tiles, numpy releases the GIL
+        """
+        if mode not in self.MODES:
+            raise ValueError(f"Unsupported canvas mode: {mode}")
+        self.dtype = np.dtype(dtype)
+        if self.dtype not in (np.uint8, np.uint16):
+            raise TypeError(f"Unsupported canvas dtype: {self.dtype}")
+        self.width, self.height = size
+        self.mode = mode
+        self.channels = 1 if mode in ("L", "LA") else 3
+        self.has_alpha = mode.endswith("A")
+        self.tile_size = tile_size
+        self.workers = workers or default_workers()
+
+        bits = 8 * self.dtype.itemsize
+        self.max_value = (1 << bits) - 1
+        self.bits = bits
+        self.wide = np.uint16 if bits == 8 else np.uint32
+
+        shape = (self.height, self.width) + ((self.channels,) if self.channels > 1 else ())
+        self.canvas = np.zeros(shape, self.dtype)
+        self.alpha = np.zeros((self.height, self.width), self.dtype) if self.has_alpha else None
+        self.layers = []
+        # Tiles (column, row) to recomposite and lowest layer changed since
+        self.dirty = set()
+        self.lowest = None
+        # Per tile, in the wide type: composite of layers[:below_index] and
+        # blend_layer of layers[below_index], kept while only that layer changes
+        self.below = {}
+        self.blended = {}
+        self.below_index = None
+        self.restacked = False
+
+    def __len__(self):
+        return len(self.layers)
+
+    def __iter__(self):
+        return iter(self.layers)
+
+    def __getitem__(self, index: int) -> Layer:
+        return self.layers[index]
+
+    @classmethod
+    def from_image(cls, image, name: str = "Background", **kwargs) -> "LayerStack":
+        """
+        Stack of the size, mode and dtype of image, with image as first layer.
+        The canvas has alpha when image has, so its transparency is kept
+        """
+        array = cls.to_array(image)
+        height, width = array.shape[:2]
+        channels = 1 if array.ndim == 2 else array.shape[2]
+        mode = {1: "L", 2: "LA", 3: "RGB", 4: "RGBA"}[channels]
+        dtype = np.uint16 if array.dtype == np.uint16 else np.uint8
+        stack = cls((width, height), mode, dtype, **kwargs)
+        stack.add_layer(array, name)
+        return stack
+
+    """
+    Pixel conversion
+    """
+
+    def to_canvas_dtype(self, array: np.ndarray) -> np.ndarray:
+        if array.dtype == self.dtype:
+            return array
+        if array.dtype == np.uint8:
+            return array.astype(self.dtype) * 257
+        if array.dtype == np.uint16:
+            return (array >> 8).astype(self.dtype)
+        raise TypeError(f"Unsupported layer dtype: {array.dtype}")
+
+    @classmethod
+    def to_array(cls, image) -> np.ndarray:
+        """
+        Pixels of image, palette and other PIL modes as RGB(A)
+        """
+        if isinstance(image, np.ndarray):
+            return image
+        if image.mode not in cls.PIL_MODES:
+            transparent = "A" in image.getbands() or "transparency" in image.info
+            image = image.convert("RGBA" if transparent else "RGB")
+        return np.asarray(image)
+
+    def split(self, image) -> tuple:
+        """
+        Layer pixels in the canvas dtype and channels
+        :param image: Image object (PIL) or numpy array, with or without alpha
+        :return: (color array, alpha array or None)
+        """
+        image = self.to_canvas_dtype(self.to_array(image))
+        alpha = None
+        if image.ndim == 3 and image.shape[2] in (2, 4):
+            alpha = np.ascontiguousarray(image[..., -1])
+            image = image[..., :-1]
+            if alpha.min() == self.max_value:
+                alpha = None
+        if image.ndim == 3 and image.shape[2] == 1:
+            image = image[..., 0]
+
+        channels = 1 if image.ndim == 2 else image.shape[2]
+        if channels == 1 and self.channels == 3:
+            image = np.repeat(image[..., None], 3, axis=2)
+        elif channels == 3 and self.channels == 1:
+            image = cv2.cvtColor(np.ascontiguousarray(image), cv2.COLOR_RGB2GRAY)
+        return np.ascontiguousarray(image), alpha
+
+    def divide(self, total: np.ndarray) -> np.ndarray:
+        """
+        round(total / max_value) for total up to max_value ** 2, in place
+        """
+        total += 1 << (self.bits - 1)
+        total += total >> self.bits
+        total >>= self.bits
+        return total
+
+    def multiply(self, first: np.ndarray, second) -> np.ndarray:
+        """
+        first * second / max_value, rounded, in the wide type
+        """
+        return self.divide(first * second)
+
+    def blend(self, below: np.ndarray, color: np.ndarray, blend: str) -> np.ndarray:
+        """
+        Blend result of color over below, both in the wide type
+        """
+        if blend == self.NORMAL:
+            return color
+        if blend == self.MULTIPLY:
+            return self.multiply(below, color)
+        if blend == self.SCREEN:
+            return below + color - self.multiply(below, color)
+        if blend == self.OVERLAY:
+            top = self.max_value
+            dark = self.multiply(below, color) * 2
+            light = top - self.multiply(top - below, top - color) * 2
+            return np.where(below <= top // 2, dark, light)
+        raise ValueError(f"Unknown blend mode: {blend}")
+
+    """
+    Layers
+    """
+
+    def check_index(self, index: int) -> int:
+        if not -len(self.layers) <= index < len(self.layers):
+            raise IndexError(f"No layer {index}, the stack has {len(self.layers)}")
+        return index % len(self.layers)
+
+    def add_layer(
+        self,
+        image,
+        name: str = None,
+        opacity: float = 1.0,
+        blend: str = NORMAL,
+        mask: np.ndarray = None,
+        offset: tuple = (0, 0),
+        index: int = None,
+    ) -> Layer:
+        """
+        :param image: Image object (PIL) or numpy array, alpha is kept
+        :param mask: uint8 or canvas dtype array of the image size, 0 hides
+        :param offset: (left, top) of the image on the canvas
+        :param index: position from the bottom, on top by default
+        """
+        color, alpha = self.split(image)
+        layer = Layer(name or f"Layer {len(self.layers)}", color, alpha)
+        layer.offset = tuple(int(value) for value in offset)
+        self.set_layer_mask(layer, mask)
+        self.set_layer_opacity(layer, opacity)
+        self.set_layer_blend(layer, blend)
+        index = len(self.layers) if index is None else min(max(index, 0), len(self.layers))
+        self.layers.insert(index, layer)
+        self.restack(layer.box)
+        return layer
+
+    def remove_layer(self, index: int) -> Layer:
+        layer = self.layers.pop(self.check_index(index))
+        self.restack(layer.box)
+        return layer
+
+    def move_layer(self, index: int, new_index: int):
+        layer = self.layers.pop(self.check_index(index))
+        self.layers.insert(min(max(new_index, 0), len(self.layers)), layer)
+        self.restack(layer.box)
+
+    def set_layer_opacity(self, layer: Layer, opacity: float):
+        if not 0.0 <= opacity <= 1.0:
+            raise ValueError(f"Opacity {opacity} outside 0-1")
+        layer.opacity = float(opacity)
+
+    def set_layer_blend(self, layer: Layer, blend: str):
+        if blend not in self.BLEND_MODES:
+            raise ValueError(f"Unknown blend mode: {blend}")
+        layer.blend = blend
+
+    def set_layer_mask(self, layer: Layer, mask: np.ndarray):
+        if mask is not None:
+            mask = np.asarray(mask)
+            if mask.shape != layer.color.shape[:2]:
+                raise ValueError(f"Mask {mask.shape} for a {layer.color.shape[:2]} layer")
+            mask = np.ascontiguousarray(self.to_canvas_dtype(mask))
+        layer.mask = mask
+
+    def set_opacity(self, index: int, opacity: float):
+        index = self.check_index(index)
+        layer = self.layers[index]
+        if layer.opacity != opacity:
+            self.set_layer_opacity(layer, opacity)
+            self.invalidate(index, layer.box, opacity_only=True)
+
+    def set_blend(self, index: int, blend: str):
+        index = self.check_index(index)
+        layer = self.layers[index]
+        if layer.blend != blend:
+            self.set_layer_blend(layer, blend)
+            self.invalidate(index, layer.box)
+
+    def set_mask(self, index: int, mask: np.ndarray, box: tuple = None):
+        """
+        :param box: part of the mask that changed, in layer pixels, None for all
+        """
+        index = self.check_index(index)
+        layer = self.layers[index]
+        self.set_layer_mask(layer, mask)
+        self.invalidate(index, self.canvas_box(layer, box))
+
+    def set_visible(self, index: int, visible: bool):
+        index = self.check_index(index)
+        layer = self.layers[index]
+        if layer.visible != visible:
+            layer.visible = visible
+            self.invalidate(index, layer.box, opacity_only=True)
+
+    def set_offset(self, index: int, offset: tuple):
+        index = self.check_index(index)
+        layer = self.layers[index]
+        before = layer.box
+        layer.offset = tuple(int(value) for value in offset)
+        self.invalidate(index, before)
+        self.invalidate(index, layer.box)
+
+    def set_image(self, index: int, image, box: tuple = None):
+        """
+        Replace the pixels of a layer, e.g. after an edit
+        :param box: part that changed, in layer pixels, None for all
+        """
+        index = self.check_index(index)
+        layer = self.layers[index]
+        before = layer.box
+        layer.color, layer.alpha = self.split(image)
+        if layer.mask is not None and layer.mask.shape != layer.color.shape[:2]:
+            layer.mask = None
+        if layer.box != before:
+            box = None
+            self.invalidate(index, before)
+        self.invalidate(index, self.canvas_box(layer, box))
+
+    @staticmethod
+    def canvas_box(layer: Layer, box: tuple = None) -> tuple:
+        if box is None:
+            return layer.box
+        left, top = layer.offset
+        return box[0] + left, box[1] + top, box[2] + left, box[3] + top
+
+    """
+    Dirty tiles
+    """
+
+    def tiles(self, box: tuple) -> list:
+        """
+        Tiles intersecting box
+        :return: list of (column, row)
+        """
+        size = self.tile_size
+        left, top = max(0, box[0]), max(0, box[1])
+        right, bottom = min(self.width, box[2]), min(self.height, box[3])
+        if right <= left or bottom <= top:
+            return []
+        return [
+            (column, row)
+            for row in range(top // size, math.ceil(bottom / size))
+            for column in range(left // size, math.ceil(right / size))
+        ]
+
+    def tile_box(self, tile: tuple) -> tuple:
+        column, row = tile
+        left, top = column * self.tile_size, row * self.tile_size
+        right, bottom = left + self.tile_size, top + self.tile_size
+        return left, top, min(right, self.width), min(bottom, self.height)
+
+    def invalidate(self, index: int, box: tuple, opacity_only: bool = False):
+        """
+        Recomposite box at the next render, layer index changed there
+        :param opacity_only: only the opacity or visibility changed, the
+            cached blend of the layer is still valid
+        """
+        tiles = self.tiles(box)
+        self.dirty.update(tiles)
+        self.lowest = index if self.lowest is None else min(self.lowest, index)
+        if self.below_index is None or index > self.below_index:
+            return
+        for tile in tiles:
+            if index < self.below_index:
+                self.below.pop(tile, None)
+            if index < self.below_index or not opacity_only:
+                self.blended.pop(tile, None)
+
+    def restack(self, box: tuple):
+        """
+        The layer order changed: cached composites of lower layers are dropped
+        """
+        self.dirty.update(self.tiles(box))
+        self.lowest = 0
+        self.restacked = True
+        self.below.clear()
+        self.blended.clear()
+        self.below_index = None
+
+    """
+    Compositing
+    """
+
+    def blend_layer(self, pixels: np.ndarray, box: tuple, layer: Layer):
+        """
+        Blend of layer over pixels, the wide type composite of box, before
+        opacity is applied
+        :return: ((top, bottom, left, right) in pixels, blended color,
+            coverage without opacity or None when full), None when layer
+            is outside box. On alpha canvases the color has an opaque alpha
+            channel, so it mixes into opaque pixels in one pass
+        """
+        parts = self.layer_area(box, layer)
+        if parts is None:
+            return None
+        area, rows, columns = parts
+        target = pixels[area[0] : area[1], area[2] : area[3]]
+        color = layer.color[rows, columns].astype(self.wide)
+        if self.has_alpha:
+            target = target[..., :-1]
+            color = color.reshape(target.shape)
+        color = self.blend(target, color, layer.blend)
+        if self.has_alpha:
+            opaque = np.full(target.shape[:2] + (1,), self.max_value, self.wide)
+            color = np.concatenate([color, opaque], axis=-1)
+        return area, color, self.coverage(layer, rows, columns)
+
+    def layer_area(self, box: tuple, layer: Layer):
+        """
+        :return: ((top, bottom, left, right) in box, rows, columns in layer),
+            None when layer is outside box
+        """
+        layer_box = layer.box
+        left, top = max(box[0], layer_box[0]), max(box[1], layer_box[1])
+        right, bottom = min(box[2], layer_box[2]), min(box[3], layer_box[3])
+        if right <= left or bottom <= top:
+            return None
+        return (
+            (top - box[1], bottom - box[1], left - box[0], right - box[0]),
+            slice(top - layer_box[1], bottom - layer_box[1]),
+            slice(left - layer_box[0], right - layer_box[0]),
+        )
+
+    def coverage(self, layer: Layer, rows: slice, columns: slice):
+        """
+        alpha x mask of a layer part in the wide type, None when full
+        """
+        coverage = None
+        for part in (layer.alpha, layer.mask):
+            if part is not None:
+                part = part[rows, columns].astype(self.wide)
+                coverage = part if coverage is None else self.multiply(coverage, part)
+        return coverage
+
+    def mix(self, pixels: np.ndarray, blended: tuple, layer: Layer):
+        """
+        Mix a blend_layer result into pixels by its coverage x opacity, in place
+        """
+        if blended is None or not layer.visible or layer.opacity == 0:
+            return
+        (top, bottom, left, right), color, coverage = blended
+        target = pixels[top:bottom, left:right]
+        opacity = self.wide(round(layer.opacity * self.max_value))
+        if coverage is not None:
+            if opacity < self.max_value:
+                coverage = self.multiply(coverage, opacity)
+        elif opacity < self.max_value:
+            coverage = opacity
+        if not self.has_alpha:
+            self.mix_colors(target, color, coverage)
+        elif coverage is None:
+            # An opaque layer hides what is below, alpha included
+            target[...] = color
+        elif (target[..., -1] == self.max_value).all():
+            # Over an opaque area the alpha stays max, no division by it
+            self.mix_colors(target, color, coverage)
+        else:
+            self.mix_alpha(target, color[..., :-1], coverage)
+
+    def mix_colors(self, target: np.ndarray, color: np.ndarray, coverage):
+        """
+        target * (1 - coverage) + color * coverage, in place
+        """
+        if coverage is None:
+            target[...] = color
+            return
+        if np.ndim(coverage) and target.ndim == 3:
+            coverage = coverage[..., None]
+        # below * (max - coverage) + color * coverage stays within max ** 2
+        total = target * (self.max_value - coverage)
+        total += color * coverage
+        target[...] = self.divide(total)
+
+    def mix_alpha(self, target: np.ndarray, color: np.ndarray, coverage):
+        """
+        Straight alpha "over", target holds colors then alpha.
+        Below weighs alpha_below * (1 - coverage), the alpha is the sum of
+        the weights, so every sum stays within max ** 2
+        """
+        weight = self.multiply(target[..., -1], self.max_value - coverage)
+        alpha = weight + coverage
+        cover = coverage[..., None] if np.ndim(coverage) else coverage
+        total = color * cover
+        total += target[..., :-1] * weight[..., None]
+        total += (alpha // 2)[..., None]
+        total //= np.maximum(alpha, 1)[..., None]
+        # Fully transparent pixels keep the color of the layer, e.g. the
+        # hidden colors of a transparent background
+        target[..., :-1] = np.where(alpha[..., None] > 0, total, color)
+        target[..., -1] = alpha
+
+    def composite(self, box: tuple, layers, pixels: np.ndarray = None) -> np.ndarray:
+        """
+        :param pixels: wide type pixels below layers, black by default
+        :return: wide type composite of box
+        """
+        if pixels is None:
+            shape = (box[3] - box[1], box[2] - box[0])
+            if self.has_alpha:
+                shape += (self.channels + 1,)
+            elif self.channels > 1:
+                shape += (self.channels,)
+            pixels = np.zeros(shape, self.wide)
+        for layer in layers:
+            if layer.visible and layer.opacity > 0:
+                self.mix(pixels, self.blend_layer(pixels, box, layer), layer)
+        return pixels
+
+    def render_tile(self, tile: tuple, cache: bool):
+        """
+        :param cache: keep the composite below layers[below_index] and the
+            blend of that layer, for the next changes of the same layer
+        """
+        box = self.tile_box(tile)
+        start = self.below_index
+        pixels = self.below.get(tile)
+        if pixels is None:
+            pixels = self.composite(box, self.layers[:start])
+            if cache:
+                self.below[tile] = pixels
+        if cache:
+            pixels = pixels.copy()
+
+        layers = self.layers[start:]
+        if cache and layers:
+            blended = self.blended.get(tile)
+            if blended is None:
+                blended = self.blended[tile] = self.blend_layer(pixels, box, layers[0])
+            self.mix(pixels, blended, layers[0])
+            layers = layers[1:]
+        pixels = self.composite(box, layers, pixels)
+        if self.has_alpha:
+            # Narrowed first, cv2 splits the channels of a contiguous array fast
+            pixels = pixels.astype(self.dtype)
+            self.alpha[box[1] : box[3], box[0] : box[2]] = pixels[..., -1]
+            if self.channels == 3:
+                pixels = cv2.cvtColor(pixels, cv2.COLOR_RGBA2RGB)
+            else:
+                pixels = pixels[..., 0]
+        self.canvas[box[1] : box[3], box[0] : box[2]] = pixels
+
+    def render(self) -> tuple:
+        """
+        Recomposite the dirty tiles
+        :return: (canvas numpy array, changed box or None when nothing changed).
+            The canvas is updated in place, copy it to keep a version. It
+            holds the colors only, the alpha is in self.alpha
+        """
+        if not self.dirty:
+            return self.canvas, None
+        if self.lowest != self.below_index:
+            self.below.clear()
+            self.blended.clear()
+            self.below_index = self.lowest
+        # Only a change of one layer is likely to be repeated (a slider drag)
+        cache = not self.restacked
+        tiles = list(self.dirty)
+        for _ in bounded_map(
+            lambda tile: self.render_tile(tile, cache), tiles, self.workers, ordered=False
+        ):
+            pass
+        boxes = [self.tile_box(tile) for tile in tiles]
+        self.dirty.clear()
+        self.lowest = None
+        self.restacked = False
+        box = (
+            min(box[0] for box in boxes),
+            min(box[1] for box in boxes),
+            max(box[2] for box in boxes),
+            max(box[3] for box in boxes),
+        )
+        return self.canvas, box
+
+    def display_pixels(self, box: tuple = None) -> np.ndarray:
+        """
+        8-bit copy of box of the last render, for display: gray or RGB, RGBA
+        on alpha canvases. Only box is converted, so a preview updated
+        after each render costs the size of the changed tiles
+        :param box: (left, top, right, bottom), None for the whole canvas
+        """
+        left, top, right, bottom = box or (0, 0, self.width, self.height)
+        pixels = self.canvas[top:bottom, left:right]
+        if self.dtype == np.uint16:
+            pixels = (pixels >> 8).astype(np.uint8)
+        if not self.has_alpha:
+            return np.array(pixels)
+        alpha = self.alpha[top:bottom, left:right]
+        if self.dtype == np.uint16:
+            alpha = (alpha >> 8).astype(np.uint8)
+        if self.channels == 1:
+            return np.dstack([pixels, pixels, pixels, alpha])
+        return np.dstack([pixels, alpha])
+
+    def flatten(self):
+        """
+        Composite of every layer, a new image
+        :return: Image object (PIL) for 8-bit canvases, numpy array for 16-bit
+        """
+        canvas, _ = self.render()
+        canvas = np.dstack([canvas, self.alpha]) if self.has_alpha else canvas.copy()
+        if self.dtype == np.uint16:
+            return canvas
+        return Image.fromarray(canvas, self.mode)
@@ -0,0 +1,184 @@
+""" Lookup tables for point operations """
+import cv2
+import numpy as np
+
+
+class LookupTable:
+    """
+    Class build and apply lookup tables for point operations.
+    A table holds one entry for every value of the image dtype:
+    256 entries for uint8 and 65536 entries for uint16 images
+    """
+
+    SUPPORTED_DTYPES = (np.uint8, np.uint16)
+    # Pixels per strip when a table is applied in place
+    STRIP_PIXELS = 1 << 16
+
+    @staticmethod
+    def check_dtype(dtype) -> np.dtype:
+        """
+        Validate the dtype of an image
+        :param dtype: numpy dtype
+        :return: numpy dtype
+        """
+        dtype = np.dtype(dtype)
+        if dtype not in LookupTable.SUPPORTED_DTYPES:
+            raise TypeError(f"Unsupported image dtype: {dtype}")
+        return dtype
+
+    @staticmethod
+    def max_value(dtype) -> int:
+        """
+        Get the largest value of dtype (255 for uint8, 65535 for uint16)
+        """
+        return int(np.iinfo(LookupTable.check_dtype(dtype)).max)
+
+    @staticmethod
+    def identity(dtype=np.uint8) -> np.ndarray:
+        """
+        Table that maps every value to itself
+        :return: numpy array
+        """
+        return np.arange(LookupTable.max_value(dtype) + 1, dtype=dtype)
+
+    @staticmethod
+    def from_function(func, dtype=np.uint8) -> np.ndarray:
+        """
+        Build a table by evaluating func on every value of dtype.
+        Results are clipped and truncated like np.uint8(...) does
+        :param func: callable that receive a float64 array of values
+        :param dtype: np.uint8 or np.uint16
+        :return: numpy array
+        """
+        max_value = LookupTable.max_value(dtype)
+        values = np.arange(max_value + 1, dtype=np.float64)
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+            table = func(values)
+        table = np.nan_to_num(table, nan=0.0, posinf=max_value, neginf=0.0)
+        return np.clip(table, 0, max_value).astype(dtype)
+
+    @staticmethod
+    def gamma(gamma_value: float, dtype=np.uint8) -> np.ndarray:
+        """
+        output = max * (input / max) ^ gamma
+        """
+        max_value = LookupTable.max_value(dtype)
+        normalization_const = max_value / np.float_power(max_value, gamma_value)
+        return LookupTable.from_function(
+            lambda x: normalization_const * np.float_power(x, gamma_value), dtype
+        )
+
+    @staticmethod
+    def log(max_input: int, dtype=np.uint8, scale: float = 1.0) -> np.ndarray:
+        """
+        output = scale * c * log(1 + input), c map max_input to the largest value
+        :param max_input: largest value found in the image
+        """
+        max_value = LookupTable.max_value(dtype)
+        normalization_const = scale * max_value / np.log(1 + max_input)
+        return LookupTable.from_function(
+            lambda x: normalization_const * np.log(x + 1), dtype
+        )
+
+    @staticmethod
+    def brightness(factor: float, dtype=np.uint8) -> np.ndarray:
+        """
+        output = input * factor, in float32 like ImageEnhance.Brightness
+        """
+        max_value = LookupTable.max_value(dtype)
+        values = np.arange(max_value + 1, dtype=np.float32) * np.float32(factor)
+        return np.clip(values, 0, max_value).astype(dtype)
+
+    @staticmethod
+    def contrast(factor: float, mean: int, dtype=np.uint8) -> np.ndarray:
+        """
+        output = mean + factor * (input - mean), in float32 like
+        ImageEnhance.Contrast
+        :param mean: rounded mean of the gray image
+        """
+        max_value = LookupTable.max_value(dtype)
+        mean = np.float32(mean)
+        values = mean + np.float32(factor) * (np.arange(max_value + 1, dtype=np.float32) - mean)
+        return np.clip(values, 0, max_value).astype(dtype)
+
+    @staticmethod
+    def invert(dtype=np.uint8) -> np.ndarray:
+        """
+        output = max - input
+        """
+        return LookupTable.identity(dtype)[::-1].copy()
+
+    @staticmethod
+    def compose(first: np.ndarray, second: np.ndarray) -> np.ndarray:
+        """
+        Table doing first then second
+        """
+        return second[first]
+
+    @staticmethod
+    def is_identity(table: np.ndarray) -> bool:
+        return np.array_equal(table, np.arange(len(table)))
+
+    @staticmethod
+    def histogram(image: np.ndarray, bins: int = None) -> np.ndarray:
+        """
+        Count pixel values. 16-bit images are counted in `bins` equal bins
+        by dropping low bits, so no float copy of the image is made
+        :param image: uint8 or uint16 numpy array
+        :param bins: power of two, default to one bin per value
+        :return: int64 numpy array of length bins
+        """
+        levels = LookupTable.max_value(image.dtype) + 1
+        bins = bins or levels
+        if bins > levels or levels % bins:
+            raise ValueError(f"bins must be a power of two <= {levels}")
+
+        shift = int(np.log2(levels // bins))
+        values = image.ravel()
+        if shift:
+            values = values >> shift
+        return np.bincount(values, minlength=bins)
+
+    @staticmethod
+    def equalization(image: np.ndarray) -> np.ndarray:
+        """
+        Build histogram equalization table for a single channel image,
+        same mapping as cv2.equalizeHist but for any supported dtype
+        :return: numpy array
+        """
+        max_value = LookupTable.max_value(image.dtype)
+        cdf = np.cumsum(LookupTable.histogram(image))
+        cdf_min = cdf[np.flatnonzero(cdf)[0]]
+        total = cdf[-1]
+        if total == cdf_min:
+            return LookupTable.identity(image.dtype)
+
+        scale = max_value / (total - cdf_min)
+        table = np.rint((cdf - cdf_min) * scale)
+        return np.clip(table, 0, max_value).astype(image.dtype)
+
+    @staticmethod
+    def apply(image: np.ndarray, table: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+        """
+        Map every pixel of image through table in a single pass
+        :param image: uint8 or uint16 numpy array
+        :param table: 1-D table, or (levels, channels) table for gray image
+        :param out: array of the image shape and table dtype written with
+            the result, may be image itself. Only used with a 1-D table
+        :return: numpy array
+        """
+        LookupTable.check_dtype(image.dtype)
+        if table.ndim != 1:
+            out = None
+        if image.dtype == np.uint8 and table.dtype == np.uint8 and table.ndim == 1:
+            return cv2.LUT(image, table, dst=out)
+        if out is None:
+            return np.take(table, image, axis=0)
+
+        # numpy converts the indices to intp, strips keep that copy small
+        rows = max(1, LookupTable.STRIP_PIXELS // max(1, image[0].size))
+        for top in range(0, len(image), rows):
+            np.take(
+                table, image[top : top + rows], axis=0, out=out[top : top + rows], mode="clip"
+            )
+        return out
@@ -0,0 +1,294 @@
+""" Description of every Recipe operation: shape, supported images and cost """
+import json
+import os
+import pathlib
+import time
+
+import numpy as np
+from PIL import Image
+
+from models.recipe import Recipe
+from models.recipe_optimizer import RecipeOptimizer
+from models.region_edit import RegionEdit
+
+
+class OperationSpec:
+    """
+    What the planner and the GUI know about one operation.
+    kind is one of OperationRegistry.KINDS:
+    - point: each output pixel depends on the same input pixel only
+    - neighbourhood: on the input pixels within radius(params)
+    - global: on statistics of the whole image
+    - geometric: the pixels move, the size may change
+    """
+
+    __slots__ = (
+        "name",
+        "func",
+        "kind",
+        "radius",
+        "dtypes",
+        "modes",
+        "cost",
+        "params",
+        "label",
+        "group",
+    )
+
+    def __init__(
+        self,
+        name: str,
+        func,
+        kind: str,
+        radius=None,
+        dtypes: tuple = (),
+        modes: tuple = (),
+        cost: float = RecipeOptimizer.DEFAULT_COST,
+        params: dict = None,
+        label: str = None,
+        group: str = None,
+    ):
+        """
+        :param radius: callable(params) -> pixels, for neighbourhood operations
+        :param dtypes: numpy dtype names accepted, () when only PIL images are
+        :param modes: image modes accepted, numpy arrays count as L, RGB or RGBA
+        :param cost: relative cost per pixel, see RecipeOptimizer.COSTS
+        :param params: typical params, used to measure the cost
+        :param label: name shown in the GUI
+        :param group: GUI group the operation is listed in, None for none
+        """
+        self.name = name
+        self.func = func
+        self.kind = kind
+        self.radius = radius
+        self.dtypes = dtypes
+        self.modes = modes
+        self.cost = cost
+        self.params = params or {}
+        self.label = label or name.replace("_", " ").capitalize()
+        self.group = group
+
+    def __repr__(self):
+        return f"OperationSpec({self.name!r}, kind={self.kind!r}, cost={self.cost})"
+
+    def halo(self, params: dict):
+        """
+        :return: pixels read around an output pixel, None when it needs the whole image
+        """
+        if self.kind == OperationRegistry.POINT:
+            return 0
+        if self.kind == OperationRegistry.NEIGHBOURHOOD:
+            return self.radius(params)
+        return None
+
+    @staticmethod
+    def image_mode(image) -> str:
+        """
+        Mode the operation sees, PIL images are converted to RegionEdit.PIL_MODES first
+        """
+        if not isinstance(image, np.ndarray):
+            return RegionEdit.native_mode(image)
+        channels = 1 if image.ndim == 2 else image.shape[2]
+        return {1: "L", 3: "RGB", 4: "RGBA"}.get(channels, "")
+
+    def supports(self, image) -> bool:
+        if isinstance(image, np.ndarray) and image.dtype.name not in self.dtypes:
+            return False
+        return self.image_mode(image) in self.modes
+
+    def check(self, image):
+        """
+        :raise ValueError: when the operation does not support image
+        """
+        if not self.supports(image):
+            kind = image.dtype.name if isinstance(image, np.ndarray) else "PIL"
+            raise ValueError(
+                f"{self.label} does not support {kind} {self.image_mode(image) or 'images'}"
+            )
+
+
+class OperationRegistry:
+    """
+    Class hold an OperationSpec for every Recipe operation, built from the
+    tables the other modules already keep (RegionEdit halos, optimizer
+    costs), and an optional measured cost per pixel for this machine
+    """
+
+    POINT = "point"
+    NEIGHBOURHOOD = "neighbourhood"
+    GLOBAL = "global"
+    GEOMETRIC = "geometric"
+    KINDS = (POINT, NEIGHBOURHOOD, GLOBAL, GEOMETRIC)
+
+    # Accepted images, checked against the operations. Filters are made for
+    # 8-bit color images, several crash in OpenCV on other inputs
+    ANY_DEPTH = ("uint8", "uint16")
+    ALL_MODES = ("L", "RGB", "RGBA")
+    PIL_ONLY = (
+        "brightness_image",
+        "color_image",
+        "sharpen_image",
+        "contrast_image",
+        "blur_image",
+        "dilate_image",
+        "erode_image",
+        "convert_to_sketch_image",
+    )
+    FILTERS = {
+        "pink_dream": "Pink Dream",
+        "cyperpunk_2077": "Cyperpunk 2077",
+        "snowy": "Snowy",
+        "pastel": "Pastel",
+        "firestorm": "Firestorm",
+        "ice": "Ice",
+        "darkness": "Darkness",
+        "gray_nostalgia": "Gray Nostalgia",
+        "sweet_dream": "Sweet Dream",
+        "cartoon": "Cartoon",
+    }
+    FILTER_MODES = {
+        "snowy": ("RGB", "RGBA"),
+        "darkness": ("RGB", "RGBA"),
+        "gray_nostalgia": ALL_MODES,
+        "cartoon": ("RGB",),
+    }
+    GROUPS = {"auto_enhance": "enhance", **{name: "filter" for name in FILTERS}}
+
+    # Params used to measure operations that need some
+    CALIBRATION_PARAMS = {
+        "resize_image": {"radius": 2},
+        "transpose_image": {"direction": Image.Transpose.ROTATE_90},
+        "rotate_image": {"degrees": 30},
+        "crop_image": {"box": (0, 0, 256, 256)},
+        "affine_transform": {"steps": [("rotate_image", {"degrees": 30})]},
+        "brightness_image": {"factor": 1.2},
+        "color_image": {"factor": 1.2},
+        "sharpen_image": {"factor": 1.5},
+        "contrast_image": {"factor": 1.2},
+        "blur_image": {"radius": 2},
+        "dilate_image": {"cycle": 2},
+        "erode_image": {"cycle": 2},
+        "gamma_transform": {"gamma_value": 0.8},
+        "apply_lookup_table": {"table": list(range(256))},
+        "colormap_filter": {"spec": "ice"},
+    }
+    # Relative cost unit in nanoseconds per pixel, when nothing was measured
+    NS_PER_UNIT = 3.0
+    COSTS_PATH = pathlib.Path.home() / ".cache" / "pyimgedit" / "operation_costs.json"
+
+    def __init__(self, costs_path=None):
+        """
+        :param costs_path: JSON file of measured costs, loaded when it exists
+        """
+        self.specs = {name: self.describe(name) for name in Recipe.OPERATIONS}
+        self.costs_path = pathlib.Path(costs_path or self.COSTS_PATH)
+        # name: measured nanoseconds per pixel
+        self.measured = {}
+        self.load_costs()
+
+    def __getitem__(self, name: str) -> OperationSpec:
+        return self.specs[name]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.specs
+
+    def __iter__(self):
+        return iter(self.specs.values())
+
+    @staticmethod
+    def kind(name: str) -> str:
+        if name in RegionEdit.GEOMETRIC:
+            return OperationRegistry.GEOMETRIC
+        if name not in RegionEdit.HALOS:
+            return OperationRegistry.GLOBAL
+        try:
+            halo = RegionEdit.HALOS[name]({})
+        except KeyError:
+            # The halo depends on the params
+            return OperationRegistry.NEIGHBOURHOOD
+        return OperationRegistry.POINT if halo == 0 else OperationRegistry.NEIGHBOURHOOD
+
+    def describe(self, name: str) -> OperationSpec:
+        kind = self.kind(name)
+        if name in self.FILTERS or name == "colormap_filter":
+            dtypes, modes = ("uint8",), self.FILTER_MODES.get(name, ("L", "RGB"))
+        elif name in self.PIL_ONLY:
+            dtypes, modes = (), self.ALL_MODES
+        else:
+            dtypes, modes = self.ANY_DEPTH, self.ALL_MODES
+        return OperationSpec(
+            name,
+            Recipe.OPERATIONS[name],
+            kind,
+            radius=RegionEdit.HALOS[name] if kind == self.NEIGHBOURHOOD else None,
+            dtypes=dtypes,
+            modes=modes,
+            cost=RecipeOptimizer.COSTS.get(name, RecipeOptimizer.DEFAULT_COST),
+            params=self.CALIBRATION_PARAMS.get(name),
+            label=self.FILTERS.get(name),
+            group=self.GROUPS.get(name),
+        )
+
+    def group(self, group: str) -> list:
+        """
+        :return: OperationSpec of the group, in registration order
+        """
+        return [spec for spec in self.specs.values() if spec.group == group]
+
+    """
+    Cost model
+    """
+
+    def cost_ns(self, name: str) -> float:
+        """
+        Nanoseconds per pixel: measured on this machine, or estimated from
+        the relative cost
+        """
+        if name in self.measured:
+            return self.measured[name]
+        return self.specs[name].cost * self.NS_PER_UNIT
+
+    def estimate_ms(self, name: str, pixels: int) -> float:
+        return self.cost_ns(name) * pixels / 1e6
+
+    @staticmethod
+    def calibration_image(size: tuple) -> Image.Image:
+        width, height = size
+        y, x = np.mgrid[0:height, 0:width]
+        pixels = np.stack([x * 255 // width, y * 255 // height, (x ^ y) & 255], axis=2)
+        return Image.fromarray(pixels.astype(np.uint8))
+
+    def calibrate(self, names=None, size: tuple = (512, 512), repeat: int = 3) -> dict:
+        """
+        Time operations on a synthetic image, one thread, best of repeat
+        :param names: operations measured, all by default
+        :return: dict name: nanoseconds per pixel, also kept in self.measured
+        """
+        image = self.calibration_image(size)
+        pixels = size[0] * size[1]
+        measured = {}
+        for name in names or self.specs:
+            spec = self.specs[name]
+            best = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                Recipe.run_step(image, name, spec.params)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            measured[name] = 1e9 * best / pixels
+        self.measured.update(measured)
+        return measured
+
+    def load_costs(self):
+        try:
+            with open(self.costs_path, encoding="utf-8") as file:
+                costs = json.load(file)
+        except (OSError, ValueError):
+            return
+        self.measured = {name: cost for name, cost in costs.items() if name in self.specs}
+
+    def save_costs(self):
+        self.costs_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = self.costs_path.with_name(self.costs_path.name + ".tmp")
+        temp_path.write_text(json.dumps(self.measured, indent=2, sort_keys=True), encoding="utf-8")
+        os.replace(temp_path, self.costs_path)
@@ -0,0 +1,165 @@
+""" Flips and quarter turns as elements of the dihedral group D4 """
+import numpy as np
+from PIL import Image
+
+
+class Orientation:
+    """
+    Class hold one of the 8 orientations of an image.
+    The element means: flip left-right if `flip`, then rotate `rotation`
+    quarter turns counter-clockwise. Any chain of flips and 90 degree
+    rotations folds to a single element, so it costs at most one transpose
+    """
+
+    # Image.Transpose -> (rotation, flip)
+    TRANSPOSE_ELEMENTS = {
+        Image.Transpose.FLIP_LEFT_RIGHT: (0, True),
+        Image.Transpose.FLIP_TOP_BOTTOM: (2, True),
+        Image.Transpose.ROTATE_90: (1, False),
+        Image.Transpose.ROTATE_180: (2, False),
+        Image.Transpose.ROTATE_270: (3, False),
+        Image.Transpose.TRANSPOSE: (1, True),
+        Image.Transpose.TRANSVERSE: (3, True),
+    }
+
+    # EXIF orientation tag value -> transpose that displays the stored pixels
+    EXIF_TRANSPOSE = {
+        2: Image.Transpose.FLIP_LEFT_RIGHT,
+        3: Image.Transpose.ROTATE_180,
+        4: Image.Transpose.FLIP_TOP_BOTTOM,
+        5: Image.Transpose.TRANSPOSE,
+        6: Image.Transpose.ROTATE_270,
+        7: Image.Transpose.TRANSVERSE,
+        8: Image.Transpose.ROTATE_90,
+    }
+
+    def __init__(self, rotation: int = 0, flip: bool = False):
+        self.rotation = rotation % 4
+        self.flip = bool(flip)
+
+    def __eq__(self, other):
+        if not isinstance(other, Orientation):
+            return NotImplemented
+        return (self.rotation, self.flip) == (other.rotation, other.flip)
+
+    def __hash__(self):
+        return hash((self.rotation, self.flip))
+
+    def __repr__(self):
+        return f"Orientation(rotation={self.rotation}, flip={self.flip})"
+
+    @classmethod
+    def from_transpose(cls, direction: Image.Transpose) -> "Orientation":
+        return cls(*cls.TRANSPOSE_ELEMENTS[Image.Transpose(direction)])
+
+    @classmethod
+    def from_degrees(cls, degrees: int) -> "Orientation":
+        """
+        Counter-clockwise rotation, degrees must be a multiple of 90
+        """
+        if degrees % 90:
+            raise ValueError(f"{degrees} is not a multiple of 90 degrees")
+        return cls(degrees // 90)
+
+    @classmethod
+    def from_exif(cls, tag: int) -> "Orientation":
+        if tag not in cls.EXIF_TRANSPOSE:
+            return cls()
+        return cls.from_transpose(cls.EXIF_TRANSPOSE[tag])
+
+    def to_exif(self) -> int:
+        """
+        EXIF orientation tag value (1-8) asking viewers to do this orientation
+        """
+        direction = self.to_transpose()
+        for tag, tag_direction in self.EXIF_TRANSPOSE.items():
+            if tag_direction == direction:
+                return tag
+        return 1
+
+    def is_identity(self) -> bool:
+        return self.rotation == 0 and not self.flip
+
+    def swaps_axes(self) -> bool:
+        """
+        True when width and height are exchanged
+        """
+        return self.rotation % 2 == 1
+
+    def then(self, other: "Orientation") -> "Orientation":
+        """
+        Orientation equal to applying self first, then other
+        """
+        # A flip reverses the direction of the rotations applied before it
+        rotation = self.rotation if not other.flip else -self.rotation
+        return Orientation(other.rotation + rotation, self.flip != other.flip)
+
+    def inverse(self) -> "Orientation":
+        if self.flip:
+            return Orientation(self.rotation, True)
+        return Orientation(-self.rotation, False)
+
+    def to_transpose(self):
+        """
+        Single Image.Transpose doing this orientation
+        :return: Image.Transpose, None for identity
+        """
+        for direction, element in self.TRANSPOSE_ELEMENTS.items():
+            if element == (self.rotation, self.flip):
+                return direction
+        return None
+
+    def apply(self, image):
+        """
+        Transpose pixels of image
+        :param image: Image object (PIL) or numpy array
+        :return: new Image object (PIL) or numpy array
+        """
+        direction = self.to_transpose()
+        if direction is None:
+            return image.copy()
+        if isinstance(image, np.ndarray):
+            if self.flip:
+                image = image[:, ::-1]
+            return np.ascontiguousarray(np.rot90(image, self.rotation))
+        return image.transpose(direction)
+
+    def matrix(self) -> tuple:
+        """
+        2x2 matrix (m11, m12, m21, m22) mapping (x, y) with y pointing down,
+        in the row vector convention used by QTransform
+        """
+        matrix = (-1, 0, 0, 1) if self.flip else (1, 0, 0, 1)
+        for _ in range(self.rotation):
+            # Quarter turn counter-clockwise on screen: (x, y) -> (y, -x)
+            m11, m12, m21, m22 = matrix
+            matrix = (m12, -m11, m22, -m21)
+        return matrix
+
+    def map_box(self, box: tuple, size: tuple) -> tuple:
+        """
+        Where box of an image of size ends up after applying this orientation
+        :param box: (left, top, right, bottom)
+        :return: (left, top, right, bottom)
+        """
+        m11, m12, m21, m22 = self.matrix()
+        width, height = size
+
+        def point(x, y):
+            return m11 * x + m21 * y, m12 * x + m22 * y
+
+        corners = [point(x, y) for x in (0, width) for y in (0, height)]
+        origin_x = min(x for x, _ in corners)
+        origin_y = min(y for _, y in corners)
+        mapped = [point(x, y) for x in (box[0], box[2]) for y in (box[1], box[3])]
+        xs = [x - origin_x for x, _ in mapped]
+        ys = [y - origin_y for _, y in mapped]
+        return min(xs), min(ys), max(xs), max(ys)
+
+    def size(self, size: tuple) -> tuple:
+        """
+        (width, height) after applying this orientation to size
+        """
+        if self.swaps_axes():
+            return size[1], size[0]
+        return size
@@ -0,0 +1,55 @@
+""" Bounded parallel helpers """
+import collections
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+def default_workers() -> int:
+    """
+    Number of worker threads used when the caller does not choose
+    """
+    return max(1, (os.cpu_count() or 1))
+
+
+def bounded_map(func, items, workers: int = None, max_in_flight: int = None, ordered=True):
+    """
+    Apply func to every item on a thread pool, keeping at most max_in_flight
+    items submitted so memory stays bounded whatever the number of items.
+    cv2 and most PIL operations release the GIL, so threads run in parallel
+    :param func: callable(item)
+    :param items: iterable, consumed lazily
+    :param workers: number of threads
+    :param max_in_flight: items submitted but not yet yielded, default 2 * workers
+    :param ordered: yield results in input order, otherwise as completed
+    :return: generator of results
+    """
+    workers = workers or default_workers()
+    max_in_flight = max(1, max_in_flight or 2 * workers)
+    items = iter(items)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque()
+        try:
+            for item in items:
+                pending.append(executor.submit(func, item))
+                while len(pending) >= max_in_flight:
+                    yield from _drain(pending, ordered)
+            while pending:
+                yield from _drain(pending, ordered)
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def _drain(pending: collections.deque, ordered: bool):
+    """
+    Yield the next available result(s) and remove them from pending
+    """
+    if ordered:
+        yield pending.popleft().result()
+        return
+
+    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+    for future in done:
+        pending.remove(future)
+        yield future.result()
@@ -0,0 +1,90 @@
+""" Preview one point operation over a range of parameter values """
+import numpy as np
+from PIL import ImageStat
+
+from models.lookup_table import LookupTable
+from models.thumbnail_pyramid import ThumbnailPyramid
+
+
+class ParameterSweep:
+    """
+    Class render variants of a point operation on a small proxy of the
+    image. The tables of every value are stacked in a (K, 256) array and
+    applied together with one fancy indexing pass, tables[:, proxy],
+    giving a (K, H, W, C) stack of previews. Statistics the operation
+    needs (maximum, mean) come from the full image, so the picked value
+    gives the same look once applied at full resolution
+    """
+
+    # name: (parameter, default values, label)
+    SWEEPS = {
+        "gamma_transform": (
+            "gamma_value",
+            (0.25, 0.35, 0.5, 0.7, 1.0, 1.4, 2.0, 2.8, 4.0),
+            "Gamma",
+        ),
+        "log_transform": ("scale", (0.6, 0.7, 0.8, 0.9, 1.0, 1.1, 1.2, 1.35, 1.5), "Log scale"),
+        "brightness_image": ("factor", (0.4, 0.6, 0.8, 0.9, 1.0, 1.1, 1.25, 1.5, 2.0), "Brightness"),
+        "contrast_image": ("factor", (0.4, 0.6, 0.8, 0.9, 1.0, 1.1, 1.25, 1.5, 2.0), "Contrast"),
+    }
+
+    PROXY_SIZE = 256
+
+    def __init__(self, image, name: str, values=None, proxy_size: int = PROXY_SIZE):
+        """
+        :param image: 8-bit Image object (PIL), L or RGB
+        :param name: operation name of SWEEPS
+        :param values: parameter values, SWEEPS defaults when None
+        """
+        if name not in self.SWEEPS:
+            raise ValueError(f"No sweep for operation: {name}")
+        if image.mode not in ("L", "RGB"):
+            image = image.convert("RGB")
+        self.name = name
+        self.parameter, default_values, self.label = self.SWEEPS[name]
+        self.values = list(default_values if values is None else values)
+        self.image = image
+        self.statistics = {}
+        self.proxy = np.asarray(
+            ThumbnailPyramid.resize(image, ThumbnailPyramid.fit_size(image.size, proxy_size))
+        )
+
+    def table(self, value: float) -> np.ndarray:
+        if self.name == "gamma_transform":
+            return LookupTable.gamma(value, np.uint8)
+        if self.name == "log_transform":
+            return LookupTable.log(self.image_max(), np.uint8, value)
+        if self.name == "brightness_image":
+            return LookupTable.brightness(value, np.uint8)
+        return LookupTable.contrast(value, self.image_mean(), np.uint8)
+
+    def image_max(self) -> int:
+        if "max" not in self.statistics:
+            self.statistics["max"] = int(np.max(self.image.getextrema()))
+        return self.statistics["max"]
+
+    def image_mean(self) -> int:
+        if "mean" not in self.statistics:
+            # Same rounding as ImageEnhance.Contrast
+            mean = ImageStat.Stat(self.image.convert("L")).mean[0]
+            self.statistics["mean"] = int(mean + 0.5)
+        return self.statistics["mean"]
+
+    def tables(self) -> np.ndarray:
+        """
+        :return: (K, 256) uint8 stack, one table per value
+        """
+        return np.stack([self.table(value) for value in self.values])
+
+    def render(self) -> np.ndarray:
+        """
+        Every variant of the proxy in one pass
+        :return: numpy array (K, H, W[, C])
+        """
+        return self.tables()[:, self.proxy]
+
+    def params(self, value: float) -> dict:
+        """
+        Recipe params committing value
+        """
+        return {self.parameter: value}
@@ -0,0 +1,580 @@
+""" Local HTTP service running recipes on a warm worker pool """
+import argparse
+import collections
+import http.client
+import json
+import math
+import os
+import queue
+import socket
+import socketserver
+import stat
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, urlparse
+
+import numpy as np
+
+from models.batch_operation import BatchOperation
+from models.colormap_filter import ColormapFilter
+from models.image_io import ImageIO
+from models.parallel import default_workers
+from models.recipe import Recipe
+
+
+class ServiceBusy(Exception):
+    """
+    The request queue is full, retry later (HTTP 429)
+    """
+
+
+class ServiceMetrics:
+    """
+    Counters and latency samples of a ProcessingService, thread safe
+    """
+
+    SAMPLES = 1024
+    WINDOW = 60.0
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.accepted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self.batches = 0
+        self.batched_jobs = 0
+        self.latencies = collections.deque(maxlen=self.SAMPLES)
+        self.finished = collections.deque()
+        self._lock = threading.Lock()
+
+    def record_accepted(self):
+        with self._lock:
+            self.accepted += 1
+
+    def record_rejected(self):
+        with self._lock:
+            self.rejected += 1
+
+    def record_batch(self, size: int):
+        with self._lock:
+            self.batches += 1
+            self.batched_jobs += size
+
+    def record_finished(self, latency: float, success: bool):
+        now = time.monotonic()
+        with self._lock:
+            if success:
+                self.completed += 1
+            else:
+                self.failed += 1
+            self.latencies.append(latency)
+            self.finished.append(now)
+            while self.finished and self.finished[0] < now - self.WINDOW:
+                self.finished.popleft()
+
+    @staticmethod
+    def percentile(values, percent: float) -> float:
+        """
+        Nearest rank percentile, 0 for no values
+        """
+        if not values:
+            return 0.0
+        values = sorted(values)
+        rank = max(1, math.ceil(percent / 100 * len(values)))
+        return values[rank - 1]
+
+    def snapshot(self, queue_depth: int = 0, in_flight: int = 0) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            latencies = list(self.latencies)
+            recent = sum(1 for finished in self.finished if finished >= now - self.WINDOW)
+            window = min(self.WINDOW, now - self.started) or 1e-9
+            return {
+                "queue_depth": queue_depth,
+                "in_flight": in_flight,
+                "accepted": self.accepted,
+                "rejected": self.rejected,
+                "completed": self.completed,
+                "failed": self.failed,
+                "batches": self.batches,
+                "mean_batch_size": self.batched_jobs / self.batches if self.batches else 0.0,
+                "latency_ms": {
+                    f"p{percent}": 1000 * self.percentile(latencies, percent)
+                    for percent in (50, 95, 99)
+                },
+                "throughput_per_s": recent / window,
+                "uptime_s": now - self.started,
+            }
+
+
+class _Job:
+    __slots__ = ("data", "recipe", "image_format", "future", "submitted")
+
+    def __init__(self, data: bytes, recipe: Recipe, image_format: str):
+        self.data = data
+        self.recipe = recipe
+        self.image_format = image_format
+        self.future = Future()
+        self.submitted = time.monotonic()
+
+
+class ProcessingService:
+    """
+    Class run recipes on encoded images with a long lived thread pool.
+    Requests wait in a bounded queue; when it is full submit raises
+    ServiceBusy instead of queueing more work. A dispatcher thread takes
+    requests off the queue only when a worker is idle, so a lone request
+    starts at once. Requests that queued up while every worker was busy
+    are shared among the idle workers, a worker taking up to batch_size of
+    them: those with the same recipe and image size run as one stack
+    (BatchOperation) when every step of the recipe can
+    """
+
+    RECIPE_CACHE = 128
+
+    def __init__(
+        self,
+        workers: int = None,
+        queue_size: int = 64,
+        batch_size: int = 8,
+        timeout: float = 60.0,
+    ):
+        self.workers = workers or default_workers()
+        self.batch_size = max(1, batch_size)
+        self.timeout = timeout
+        self.queue = queue.Queue(maxsize=max(1, queue_size))
+        self.metrics = ServiceMetrics()
+        self.slots = threading.Semaphore(self.workers)
+        self.in_flight = 0
+        self.busy = 0
+        self.recipes = collections.OrderedDict()
+        self.executor = None
+        self.dispatcher = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        if self.executor is not None:
+            return
+        self._stop.clear()
+        self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix="pyimgedit-worker")
+        self.warm()
+        self.dispatcher = threading.Thread(
+            target=self._dispatch, name="pyimgedit-dispatcher", daemon=True
+        )
+        self.dispatcher.start()
+
+    def warm(self):
+        """
+        Start every worker thread and build the colormap tables now,
+        so the first requests do not pay for it
+        """
+        for name in ColormapFilter.FILTERS:
+            ColormapFilter.table(name)
+        barrier = threading.Barrier(self.workers)
+        waits = [self.executor.submit(barrier.wait, 5.0) for _ in range(self.workers)]
+        for wait in waits:
+            wait.result()
+
+    def stop(self):
+        """
+        Stop dispatching, queued requests fail with RuntimeError
+        """
+        if self.executor is None:
+            return
+        self._stop.set()
+        self.dispatcher.join()
+        self.executor.shutdown(wait=True)
+        self.executor = None
+        while True:
+            try:
+                job = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            job.future.set_exception(RuntimeError("Service stopped"))
+
+    def parse_recipe(self, recipe) -> Recipe:
+        """
+        :param recipe: Recipe, list of steps or JSON text; parsed JSON is cached
+        """
+        if isinstance(recipe, Recipe):
+            return recipe
+        if not isinstance(recipe, str):
+            return Recipe(recipe)
+        with self._lock:
+            parsed = self.recipes.get(recipe)
+            if parsed is not None:
+                self.recipes.move_to_end(recipe)
+                return parsed
+        parsed = Recipe.from_json(recipe)
+        with self._lock:
+            self.recipes[recipe] = parsed
+            while len(self.recipes) > self.RECIPE_CACHE:
+                self.recipes.popitem(last=False)
+        return parsed
+
+    def submit(self, data: bytes, recipe, image_format: str = "PNG") -> Future:
+        """
+        Queue one request
+        :param data: encoded image
+        :param recipe: Recipe, list of steps or JSON text
+        :return: Future of the encoded result
+        """
+        if self.executor is None:
+            raise RuntimeError("Service is not started")
+        job = _Job(data, self.parse_recipe(recipe), image_format)
+        try:
+            self.queue.put_nowait(job)
+        except queue.Full:
+            self.metrics.record_rejected()
+            raise ServiceBusy(f"Queue full ({self.queue.maxsize} requests)") from None
+        self.metrics.record_accepted()
+        return job.future
+
+    def process(self, data: bytes, recipe, image_format: str = "PNG") -> bytes:
+        return self.submit(data, recipe, image_format).result(self.timeout)
+
+    @staticmethod
+    def run(data: bytes, recipe: Recipe, image_format: str) -> bytes:
+        image = recipe.apply(ImageIO.decode_bytes(data), in_place=True)
+        return ImageIO.encode_bytes(image, image_format)
+
+    @staticmethod
+    def can_stack(image, recipe: Recipe) -> bool:
+        """
+        Whether image may run in a BatchOperation stack: 8-bit L, RGB or
+        RGBA with a batched implementation for every step
+        """
+        if isinstance(image, np.ndarray) or image.mode not in ("L", "RGB", "RGBA"):
+            return False
+        # can_batch only looks at the channels of the batch
+        channels = len(image.getbands())
+        probe = np.empty((1, 1, 1) + ((channels,) if channels > 1 else ()), np.uint8)
+        return all(BatchOperation.can_batch(probe, name) for name, _ in recipe)
+
+    def run_jobs(self, jobs: list) -> list:
+        """
+        Run jobs sharing a recipe, images of the same size and mode as one
+        stack, the others one by one
+        :return: list of encoded results or exceptions, in jobs order
+        """
+        recipe = jobs[0].recipe
+        if len(jobs) == 1:
+            try:
+                return [self.run(jobs[0].data, recipe, jobs[0].image_format)]
+            except Exception as error:
+                return [error]
+        results = [None] * len(jobs)
+        stacks = {}
+        for index, job in enumerate(jobs):
+            try:
+                image = ImageIO.decode_bytes(job.data)
+                if self.can_stack(image, recipe):
+                    stacks.setdefault((image.size, image.mode), []).append((index, image))
+                else:
+                    image = recipe.apply(image, in_place=True)
+                    results[index] = ImageIO.encode_bytes(image, job.image_format)
+            except Exception as error:
+                results[index] = error
+        for items in stacks.values():
+            try:
+                if len(items) == 1:
+                    images = [recipe.apply(items[0][1], in_place=True)]
+                else:
+                    batch = np.stack([np.asarray(image) for _, image in items])
+                    # Back to PIL, encoded like the results of recipe.apply
+                    images = BatchOperation.unstack(
+                        BatchOperation.apply_recipe(batch, recipe, in_place=True)
+                    )
+            except Exception as error:
+                images = [error] * len(items)
+            for (index, _), image in zip(items, images):
+                if isinstance(image, Exception):
+                    results[index] = image
+                    continue
+                try:
+                    results[index] = ImageIO.encode_bytes(image, jobs[index].image_format)
+                except Exception as error:
+                    results[index] = error
+        return results
+
+    def _dispatch(self):
+        while not self._stop.is_set():
+            # Requests stay in the bounded queue until a worker is idle
+            if not self.slots.acquire(timeout=0.1):
+                continue
+            try:
+                batch = [self.queue.get(timeout=0.1)]
+            except queue.Empty:
+                self.slots.release()
+                continue
+            with self._lock:
+                idle = self.workers - self.busy
+                self.busy += 1
+            # Several requests per worker only when more wait than there
+            # are idle workers to take them
+            size = min(self.batch_size, math.ceil((1 + self.queue.qsize()) / max(idle, 1)))
+            while len(batch) < size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            with self._lock:
+                self.in_flight += len(batch)
+            self.executor.submit(self._run_batch, batch)
+
+    def _run_batch(self, batch: list):
+        self.metrics.record_batch(len(batch))
+        try:
+            groups = collections.OrderedDict()
+            for job in batch:
+                if job.future.set_running_or_notify_cancel():
+                    groups.setdefault(job.recipe.digest(), []).append(job)
+                else:
+                    self.finish(job, False)
+            for jobs in groups.values():
+                for job, result in zip(jobs, self.run_jobs(jobs)):
+                    if isinstance(result, Exception):
+                        job.future.set_exception(result)
+                    else:
+                        job.future.set_result(result)
+                    self.finish(job, not isinstance(result, Exception))
+        finally:
+            with self._lock:
+                self.busy -= 1
+            self.slots.release()
+
+    def finish(self, job: _Job, success: bool):
+        self.metrics.record_finished(time.monotonic() - job.submitted, success)
+        with self._lock:
+            self.in_flight -= 1
+
+    def get_metrics(self) -> dict:
+        with self._lock:
+            in_flight = self.in_flight
+        return self.metrics.snapshot(self.queue.qsize(), in_flight)
+
+
+class ServiceRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET  /health            -> 200 "ok"
+    GET  /metrics           -> JSON metrics
+    POST /process?format=PNG with the image file as body and the recipe
+         JSON in the X-Recipe header (or ?recipe=) -> encoded result,
+         429 when the queue is full
+    """
+
+    protocol_version = "HTTP/1.1"
+    server_version = "PyImgEdit"
+
+    CONTENT_TYPES = {"PNG": "image/png", "JPEG": "image/jpeg", "TIFF": "image/tiff"}
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/health":
+            self.send_body(200, b"ok", "text/plain")
+        elif path == "/metrics":
+            metrics = self.server.service.get_metrics()
+            self.send_body(200, json.dumps(metrics).encode("utf-8"), "application/json")
+        else:
+            self.send_body(404, b"Not found", "text/plain")
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        data = self.rfile.read(length)
+        if url.path != "/process":
+            self.send_body(404, b"Not found", "text/plain")
+            return
+
+        query = parse_qs(url.query)
+        recipe = self.headers.get("X-Recipe") or query.get("recipe", ["[]"])[0]
+        image_format = query.get("format", ["PNG"])[0].upper()
+        service = self.server.service
+        try:
+            future = service.submit(data, recipe, image_format)
+        except ServiceBusy as error:
+            self.send_body(429, str(error).encode("utf-8"), "text/plain", {"Retry-After": "1"})
+            return
+        except (ValueError, KeyError, TypeError) as error:
+            self.send_body(400, f"Bad recipe: {error}".encode("utf-8"), "text/plain")
+            return
+
+        try:
+            result = future.result(service.timeout)
+        except TimeoutError:
+            self.send_body(504, b"Timed out", "text/plain")
+        except OSError as error:
+            self.send_body(400, f"Bad image: {error}".encode("utf-8"), "text/plain")
+        except Exception as error:
+            self.send_body(500, f"{type(error).__name__}: {error}".encode("utf-8"), "text/plain")
+        else:
+            content_type = self.CONTENT_TYPES.get(image_format, "application/octet-stream")
+            self.send_body(200, result, content_type)
+
+    def send_body(self, status: int, body: bytes, content_type: str, headers: dict = None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class ServiceHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address: tuple, service: ProcessingService, verbose: bool = False):
+        self.service = service
+        self.verbose = verbose
+        super().__init__(address, ServiceRequestHandler)
+
+
+if hasattr(socket, "AF_UNIX"):
+
+    class ServiceUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+        request_queue_size = 128
+
+        def __init__(self, path: str, service: ProcessingService, verbose: bool = False):
+            self.service = service
+            self.verbose = verbose
+            # A socket left by a server that did not exit cleanly
+            if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+                os.unlink(path)
+            super().__init__(path, ServiceRequestHandler)
+
+        def server_close(self):
+            super().server_close()
+            if os.path.exists(self.server_address):
+                os.unlink(self.server_address)
+
+
+def create_server(
+    service: ProcessingService,
+    host: str = "127.0.0.1",
+    port: int = 8765,
+    socket_path: str = None,
+    verbose: bool = False,
+):
+    """
+    :param port: 0 picks a free port, see server.server_address
+    :param socket_path: listen on this Unix socket instead of TCP
+    :return: socketserver, call serve_forever()
+    """
+    if socket_path is None:
+        return ServiceHTTPServer((host, port), service, verbose)
+    if not hasattr(socket, "AF_UNIX"):
+        raise OSError("Unix sockets are not supported on this platform")
+    return ServiceUnixServer(socket_path, service, verbose)
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path: str, timeout: float):
+        super().__init__("localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+class ServiceClient:
+    """
+    Minimal client of the service
+    :param address: (host, port) or Unix socket path
+    """
+
+    def __init__(self, address, timeout: float = 60.0):
+        self.address = address
+        self.timeout = timeout
+
+    def connection(self) -> http.client.HTTPConnection:
+        if isinstance(self.address, str):
+            return _UnixHTTPConnection(self.address, self.timeout)
+        host, port = self.address[:2]
+        return http.client.HTTPConnection(host, port, timeout=self.timeout)
+
+    def request(self, method: str, path: str, body: bytes = None, headers: dict = None) -> tuple:
+        """
+        :return: (status, body)
+        """
+        connection = self.connection()
+        try:
+            connection.request(method, path, body=body, headers=headers or {})
+            response = connection.getresponse()
+            return response.status, response.read()
+        finally:
+            connection.close()
+
+    def process(self, data: bytes, recipe, image_format: str = "PNG") -> bytes:
+        """
+        :param recipe: Recipe, list of steps or JSON text
+        :raise ServiceBusy: on HTTP 429
+        """
+        if isinstance(recipe, Recipe):
+            recipe = recipe.to_json()
+        elif not isinstance(recipe, str):
+            recipe = json.dumps(recipe)
+        status, body = self.request(
+            "POST", f"/process?format={quote(image_format)}", data, {"X-Recipe": recipe}
+        )
+        if status == 429:
+            raise ServiceBusy(body.decode("utf-8", "replace"))
+        if status != 200:
+            raise OSError(f"HTTP {status}: {body.decode('utf-8', 'replace')}")
+        return body
+
+    def metrics(self) -> dict:
+        status, body = self.request("GET", "/metrics")
+        if status != 200:
+            raise OSError(f"HTTP {status}")
+        return json.loads(body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run recipes on images sent over HTTP")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--socket", help="listen on a Unix socket instead of TCP")
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--queue-size", type=int, default=64)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    service = ProcessingService(args.workers, args.queue_size, args.batch_size)
+    with service:
+        server = create_server(service, args.host, args.port, args.socket, args.verbose)
+        print(f"Listening on {args.socket or '%s:%d' % server.server_address[:2]}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+""" Recipe of ImageOperation / EffectFilter steps """
+import hashlib
+import json
+
+import numpy as np
+from PIL import Image
+
+from models.effect_filter import EffectFilter
+from models.image_operation import ImageOperation
+
+
+class Recipe:
+    """
+    Class hold an ordered list of steps, each step is (operation name, params).
+    A recipe is written in JSON as a list of {"op": name, **params} objects
+    or plain operation names, e.g.
+    [{"op": "gamma_transform", "gamma_value": 0.8}, "invert_image"]
+    """
+
+    OPERATIONS = {
+        "resize_image": ImageOperation.resize_image,
+        "transpose_image": ImageOperation.transpose_image,
+        "rotate_image": ImageOperation.rotate_image,
+        "crop_image": ImageOperation.crop_image,
+        "affine_transform": ImageOperation.affine_transform,
+        "brightness_image": ImageOperation.brightness_image,
+        "color_image": ImageOperation.color_image,
+        "sharpen_image": ImageOperation.sharpen_image,
+        "contrast_image": ImageOperation.contrast_image,
+        "blur_image": ImageOperation.blur_image,
+        "dilate_image": ImageOperation.dilate_image,
+        "erode_image": ImageOperation.erode_image,
+        "convert_to_sketch_image": ImageOperation.convert_to_sketch_image,
+        "invert_image": ImageOperation.invert_image,
+        "histogram_equalization": ImageOperation.histogram_equalization,
+        "log_transform": ImageOperation.log_transform,
+        "gamma_transform": ImageOperation.gamma_transform,
+        "apply_lookup_table": ImageOperation.apply_lookup_table,
+        "auto_enhance": ImageOperation.auto_enhance,
+        "pink_dream": EffectFilter.pink_dream,
+        "cyperpunk_2077": EffectFilter.cyperpunk_2077,
+        "snowy": EffectFilter.snowy,
+        "pastel": EffectFilter.pastel,
+        "firestorm": EffectFilter.firestorm,
+        "ice": EffectFilter.ice,
+        "darkness": EffectFilter.darkness,
+        "gray_nostalgia": EffectFilter.gray_nostalgia,
+        "sweet_dream": EffectFilter.sweet_dream,
+        "cartoon": EffectFilter.cartoon,
+        "colormap_filter": EffectFilter.colormap_filter,
+    }
+
+    # Operations taking in_place=True: they may write over a numpy input
+    IN_PLACE = (
+        "transpose_image",
+        "invert_image",
+        "log_transform",
+        "gamma_transform",
+        "apply_lookup_table",
+        "auto_enhance",
+    )
+
+    def __init__(self, steps=()):
+        self.steps = [self.parse_step(step) for step in steps]
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __iter__(self):
+        return iter(self.steps)
+
+    def __repr__(self):
+        return f"Recipe({self.to_list()!r})"
+
+    @staticmethod
+    def parse_step(step) -> tuple:
+        """
+        Normalize a step to (name, params)
+        :param step: name, (name, params) or {"op": name, **params}
+        :return: tuple
+        """
+        if isinstance(step, str):
+            name, params = step, {}
+        elif isinstance(step, dict):
+            params = dict(step)
+            name = params.pop("op")
+        else:
+            name, params = step
+            params = dict(params)
+
+        if name not in Recipe.OPERATIONS:
+            raise ValueError(f"Unknown operation: {name}")
+        if name == "transpose_image":
+            params["direction"] = Recipe.parse_direction(params["direction"])
+        if name == "affine_transform":
+            params["steps"] = [Recipe.parse_step(step) for step in params["steps"]]
+        return name, params
+
+    @staticmethod
+    def parse_direction(direction) -> Image.Transpose:
+        """
+        Accept Image.Transpose, its value or its name (e.g. "FLIP_LEFT_RIGHT")
+        """
+        if isinstance(direction, str):
+            return Image.Transpose[direction]
+        return Image.Transpose(direction)
+
+    @classmethod
+    def from_json(cls, text: str) -> "Recipe":
+        return cls(json.loads(text))
+
+    @classmethod
+    def load(cls, recipe_path) -> "Recipe":
+        with open(recipe_path, encoding="utf-8") as file:
+            return cls.from_json(file.read())
+
+    @staticmethod
+    def step_to_dict(name: str, params: dict) -> dict:
+        params = dict(params)
+        if "direction" in params:
+            params["direction"] = params["direction"].name
+        if isinstance(params.get("table"), np.ndarray):
+            params["table"] = params["table"].tolist()
+        if "box" in params:
+            params["box"] = list(params["box"])
+        if name == "affine_transform":
+            params["steps"] = [Recipe.step_to_dict(*step) for step in params["steps"]]
+        return {"op": name, **params}
+
+    def to_list(self) -> list:
+        return [self.step_to_dict(name, params) for name, params in self.steps]
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_list(), sort_keys=True)
+
+    def digest(self) -> str:
+        """
+        Stable hash of the steps, same recipe give same digest
+        """
+        return hashlib.sha256(self.to_json().encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def run_step(image, name: str, params: dict, in_place: bool = False):
+        """
+        Run one step. EffectFilter results are wrapped back to PIL Image
+        when the input was an Image
+        :param in_place: image is not used by anyone else, operations of
+            IN_PLACE may write their result over it
+        :return: Image object (PIL) or numpy array
+        """
+        if in_place and name in Recipe.IN_PLACE:
+            params = dict(params, in_place=True)
+        result = Recipe.OPERATIONS[name](image, **params)
+        if isinstance(result, np.ndarray) and not isinstance(image, np.ndarray):
+            result = Image.fromarray(result)
+        return result
+
+    @staticmethod
+    def shares_buffer(image, other) -> bool:
+        if image is other:
+            return True
+        return (
+            isinstance(image, np.ndarray)
+            and isinstance(other, np.ndarray)
+            and np.may_share_memory(image, other)
+        )
+
+    def apply(self, image, in_place: bool = False):
+        """
+        Run every step on image. Copy on write: the first step copies the
+        input unless in_place, later steps write over the buffers made by
+        the recipe itself where the operation allows it
+        :param image: Image object (PIL) or numpy array
+        :param in_place: the caller gives image away, it may be overwritten
+        :return: Image object (PIL) or numpy array
+        """
+        source = image
+        owned = in_place
+        for name, params in self.steps:
+            image = self.run_step(image, name, params, owned)
+            owned = owned or not self.shares_buffer(image, source)
+        return image
@@ -0,0 +1,350 @@
+""" Rewrite recipes to do less work before running them """
+import math
+
+import numpy as np
+
+from models.affine_transform import AffineTransform
+from models.lookup_table import LookupTable
+from models.orientation import Orientation
+from models.recipe import Recipe
+
+
+class _Node:
+    """
+    One step of the recipe being optimized.
+    kind is "point" (table), "orient" (orientation) or "step" (anything else)
+    """
+
+    def __init__(self, kind: str, steps: list, table=None, orientation=None):
+        self.kind = kind
+        self.steps = steps
+        self.table = table
+        self.orientation = orientation
+
+
+class RecipeOptimizer:
+    """
+    Class compile a recipe with algebraic rewrite rules:
+    - point operations in a row are composed into one lookup table,
+      inverse pairs (e.g. invert twice) compose to identity and disappear
+    - flips and 90 degree rotations in a row fold into one transpose
+    - point operations commute with transposes, so they are grouped across them
+    - point operations move across resampling (resize, rotate) to the side
+      with fewer pixels. This is approximate for interpolated pixels and can
+      be disabled with approximate=False
+    - geometric steps in a row (resize, rotate, flips, crops) fuse into one
+      affine_transform, resampled once. It interpolates differently from
+      the separate steps, so with approximate=False only exact pixel moves
+      (flips, quarter turns, crops) are fused
+    """
+
+    # Relative cost per pixel of each operation, a point lookup is 1
+    COSTS = {
+        "apply_lookup_table": 1.0,
+        "invert_image": 1.0,
+        "gamma_transform": 1.0,
+        "auto_enhance": 1.5,
+        "brightness_image": 2.0,
+        "log_transform": 2.0,
+        "transpose_image": 1.5,
+        "resize_image": 6.0,
+        "rotate_image": 8.0,
+        "crop_image": 0.5,
+        "affine_transform": 8.0,
+        "color_image": 4.0,
+        "contrast_image": 4.0,
+        "sharpen_image": 10.0,
+        "blur_image": 12.0,
+        "dilate_image": 9.0,
+        "erode_image": 9.0,
+        "convert_to_sketch_image": 20.0,
+        "histogram_equalization": 3.0,
+        "pink_dream": 120.0,
+        "cyperpunk_2077": 40.0,
+        "snowy": 15.0,
+        "pastel": 8.0,
+        "firestorm": 3.0,
+        "ice": 2.0,
+        "darkness": 16.0,
+        "gray_nostalgia": 5.0,
+        "sweet_dream": 40.0,
+        "cartoon": 90.0,
+    }
+    DEFAULT_COST = 10.0
+
+    RESAMPLING = ("resize_image", "rotate_image", "affine_transform")
+    # Steps fused by fuse_geometry, besides orient nodes
+    GEOMETRIC = ("resize_image", "rotate_image", "crop_image", "affine_transform")
+
+    def __init__(self, size=(1920, 1080), mode="RGB", dtype=np.uint8, approximate=True):
+        """
+        :param size: (width, height) of the input image, used by the cost model
+        :param mode: input mode, alpha channels are kept out of point op fusion
+        :param dtype: np.uint8 or np.uint16, dtype of the lookup tables
+        :param approximate: allow moving point ops across resampling
+        """
+        self.size = tuple(size)
+        self.mode = mode
+        self.dtype = np.dtype(dtype)
+        self.approximate = approximate
+        self.rewrites = []
+
+    """
+    Step classification
+    """
+
+    def point_table(self, name: str, params: dict):
+        """
+        Lookup table of a step that only depends on the pixel value
+        :return: numpy array, None if the step is not a point operation
+        """
+        if name == "apply_lookup_table":
+            return np.asarray(params["table"]).astype(self.dtype)
+        if name == "gamma_transform":
+            return LookupTable.gamma(params["gamma_value"], self.dtype)
+        # invert and brightness treat alpha differently from color channels
+        if self.mode not in ("L", "RGB"):
+            return None
+        if name == "invert_image":
+            return LookupTable.invert(self.dtype)
+        if name == "brightness_image" and self.dtype == np.uint8:
+            return LookupTable.brightness(params["factor"], self.dtype)
+        return None
+
+    @staticmethod
+    def step_orientation(name: str, params: dict):
+        """
+        :return: Orientation of a flip or quarter turn step, None otherwise
+        """
+        if name == "transpose_image":
+            return Orientation.from_transpose(params["direction"])
+        if name == "rotate_image" and params["degrees"] % 90 == 0:
+            return Orientation.from_degrees(params["degrees"])
+        return None
+
+    def to_node(self, step: tuple) -> _Node:
+        name, params = step
+        table = self.point_table(name, params)
+        if table is not None:
+            return _Node("point", [step], table=table)
+        orientation = self.step_orientation(name, params)
+        if orientation is not None:
+            return _Node("orient", [step], orientation=orientation)
+        return _Node("step", [step])
+
+    """
+    Cost model
+    """
+
+    @staticmethod
+    def output_size(step: tuple, size: tuple) -> tuple:
+        name, params = step
+        if name in AffineTransform.STEPS:
+            return AffineTransform(size).step(name, params).size
+        return size
+
+    def estimate_cost(self, steps) -> float:
+        """
+        Sum of cost per pixel x pixels processed, in million pixel units
+        """
+        size = self.size
+        total = 0.0
+        for step in steps:
+            cost = self.COSTS.get(step[0], self.DEFAULT_COST)
+            pixels = size[0] * size[1]
+            if step[0] == "affine_transform":
+                # A warp only reads the pixels its output is made of
+                left, top, right, bottom = AffineTransform(size).step(*step).source_box()
+                pixels = (right - left) * (bottom - top)
+            total += cost * pixels / 1e6
+            size = self.output_size(step, size)
+        return total
+
+    def node_sizes(self, nodes: list) -> list:
+        """
+        Input size of every node
+        """
+        sizes = []
+        size = self.size
+        for node in nodes:
+            sizes.append(size)
+            for step in node.steps:
+                size = self.output_size(step, size)
+        return sizes
+
+    """
+    Rewrite rules
+    """
+
+    def can_cross(self, point: _Node, node: _Node) -> bool:
+        """
+        True when point may swap places with node
+        """
+        if node.kind == "orient":
+            return True
+        if node.kind != "step" or not self.approximate:
+            return False
+        name, _ = node.steps[0]
+        if name not in self.RESAMPLING:
+            return False
+        # rotate and warps fill the uncovered pixels with black, it must stay black
+        return name == "resize_image" or point.table[0] == 0
+
+    def reorder(self, nodes: list) -> bool:
+        """
+        Move point nodes across orientations (grouping them) and across
+        resampling to the side with fewer pixels
+        :return: True if something moved
+        """
+        sizes = self.node_sizes(nodes)
+        for index in range(len(nodes) - 1):
+            first, second = nodes[index], nodes[index + 1]
+            if first.kind == "point" and second.kind != "point":
+                point, other, forward = first, second, True
+            elif second.kind == "point" and first.kind != "point":
+                point, other, forward = second, first, False
+            else:
+                continue
+            if not self.can_cross(point, other):
+                continue
+
+            if other.kind == "orient":
+                # Canonical order is point before orient, pixel count is equal
+                if not forward:
+                    nodes[index], nodes[index + 1] = second, first
+                    self.rewrites.append("moved point op ahead of transpose")
+                    return True
+                continue
+
+            in_size = sizes[index]
+            out_size = self.output_size(other.steps[0], in_size)
+            in_pixels = in_size[0] * in_size[1]
+            out_pixels = out_size[0] * out_size[1]
+            if forward and out_pixels < in_pixels:
+                nodes[index], nodes[index + 1] = second, first
+                self.rewrites.append(f"moved point op after {other.steps[0][0]}")
+                return True
+            if not forward and in_pixels < out_pixels:
+                nodes[index], nodes[index + 1] = second, first
+                self.rewrites.append(f"moved point op ahead of {other.steps[0][0]}")
+                return True
+        return False
+
+    def merge(self, nodes: list) -> bool:
+        """
+        Compose neighbour point nodes and neighbour orient nodes
+        :return: True if something merged
+        """
+        for index in range(len(nodes) - 1):
+            first, second = nodes[index], nodes[index + 1]
+            if first.kind != second.kind or first.kind == "step":
+                continue
+            steps = first.steps + second.steps
+            if first.kind == "point":
+                table = LookupTable.compose(first.table, second.table)
+                nodes[index : index + 2] = [_Node("point", steps, table=table)]
+                self.rewrites.append(f"composed {len(steps)} point ops into one table")
+            else:
+                orientation = first.orientation.then(second.orientation)
+                nodes[index : index + 2] = [
+                    _Node("orient", steps, orientation=orientation)
+                ]
+                self.rewrites.append(f"folded {len(steps)} flips/rotations")
+            return True
+        return False
+
+    def drop_identities(self, nodes: list) -> bool:
+        for index, node in enumerate(nodes):
+            if (node.kind == "point" and LookupTable.is_identity(node.table)) or (
+                node.kind == "orient" and node.orientation.is_identity()
+            ):
+                del nodes[index]
+                names = ", ".join(step[0] for step in node.steps)
+                self.rewrites.append(f"cancelled {names}")
+                return True
+        return False
+
+    def is_geometric(self, node: _Node) -> bool:
+        return node.kind == "orient" or (
+            node.kind == "step" and node.steps[0][0] in self.GEOMETRIC
+        )
+
+    def fuse_geometry(self, nodes: list) -> bool:
+        """
+        Replace geometric nodes in a row by one affine_transform
+        :return: True if something fused
+        """
+        for index in range(len(nodes) - 1):
+            end = index
+            while end < len(nodes) and self.is_geometric(nodes[end]):
+                end += 1
+            if end - index < 2:
+                continue
+            steps = []
+            for node in nodes[index:end]:
+                for name, params in node.steps:
+                    steps.extend(params["steps"] if name == "affine_transform" else [(name, params)])
+            resamples = any(
+                name in self.RESAMPLING and self.step_orientation(name, params) is None
+                for name, params in steps
+            )
+            if resamples and not self.approximate:
+                continue
+            nodes[index:end] = [_Node("step", [("affine_transform", {"steps": steps})])]
+            self.rewrites.append(f"fused {len(steps)} geometric steps into one resampling")
+            return True
+        return False
+
+    @staticmethod
+    def to_steps(node: _Node) -> list:
+        if node.kind == "step" or len(node.steps) == 1:
+            return node.steps
+        if node.kind == "point":
+            return [("apply_lookup_table", {"table": node.table})]
+        return [("transpose_image", {"direction": node.orientation.to_transpose()})]
+
+    def optimize(self, recipe: Recipe) -> Recipe:
+        """
+        Rewrite recipe, the applied rules are in self.rewrites
+        :return: new Recipe
+        """
+        self.rewrites = []
+        nodes = [self.to_node(step) for step in recipe]
+        # Every rule shrinks the list or moves a point op one way, so this ends
+        while (
+            self.drop_identities(nodes)
+            or self.merge(nodes)
+            or self.reorder(nodes)
+            or self.fuse_geometry(nodes)
+        ):
+            pass
+
+        steps = []
+        for node in nodes:
+            steps.extend(self.to_steps(node))
+        return Recipe(steps)
+
+    def report(self, recipe: Recipe, optimized: Recipe) -> dict:
+        """
+        Estimated cost before and after optimization
+        """
+        before = self.estimate_cost(recipe)
+        after = self.estimate_cost(optimized)
+        return {
+            "steps_before": len(recipe),
+            "steps_after": len(optimized),
+            "cost_before": before,
+            "cost_after": after,
+            "speedup": before / after if after else math.inf,
+            "rewrites": list(self.rewrites),
+        }
+
+
+def format_report(report: dict) -> str:
+    lines = [
+        f"steps: {report['steps_before']} -> {report['steps_after']}",
+        f"estimated cost: {report['cost_before']:.1f} -> {report['cost_after']:.1f}"
+        f" ({report['speedup']:.2f}x)",
+    ]
+    lines.extend(f"  - {rewrite}" for rewrite in report["rewrites"])
+    return "\n".join(lines)
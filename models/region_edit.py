@@ -0,0 +1,281 @@
+""" Edit only a selected region of an image """
+import math
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from models.orientation import Orientation
+from models.recipe import Recipe
+
+
+class Region:
+    """
+    Class hold a selection: a bounding box (left, top, right, bottom) in
+    image pixels and an optional uint8 mask of the box size, 0 outside the
+    selection and 255 inside (values between blend softly)
+    """
+
+    def __init__(self, box: tuple, mask: np.ndarray = None):
+        self.box = tuple(int(value) for value in box)
+        self.mask = mask
+
+    def __repr__(self):
+        return f"Region(box={self.box}, mask={self.mask is not None})"
+
+    @property
+    def width(self) -> int:
+        return self.box[2] - self.box[0]
+
+    @property
+    def height(self) -> int:
+        return self.box[3] - self.box[1]
+
+    @classmethod
+    def from_rect(cls, rect: tuple, size: tuple):
+        """
+        :param rect: two corners (x0, y0, x1, y1) in any order
+        :param size: (width, height) of the image
+        :return: Region, None when the rectangle is outside the image
+        """
+        left, right = sorted((rect[0], rect[2]))
+        top, bottom = sorted((rect[1], rect[3]))
+        box = (
+            max(0, math.floor(left)),
+            max(0, math.floor(top)),
+            min(size[0], math.ceil(right)),
+            min(size[1], math.ceil(bottom)),
+        )
+        if box[2] <= box[0] or box[3] <= box[1]:
+            return None
+        return cls(box)
+
+    @classmethod
+    def from_mask(cls, mask: np.ndarray):
+        """
+        :param mask: uint8 mask of the whole image
+        :return: Region cropped to the mask bounding box, None for an empty mask
+        """
+        left, top, width, height = cv2.boundingRect(mask)
+        if width == 0 or height == 0:
+            return None
+        box = (left, top, left + width, top + height)
+        return cls(box, np.ascontiguousarray(mask[top : top + height, left : left + width]))
+
+    @classmethod
+    def from_polygon(cls, points, size: tuple):
+        """
+        Lasso selection, the mask is only as large as the polygon bounding box
+        :param points: [(x, y), ...] in image pixels
+        """
+        points = np.asarray(points, dtype=np.float64)
+        if len(points) < 3:
+            return None
+        region = cls.from_rect(
+            (points[:, 0].min(), points[:, 1].min(), points[:, 0].max(), points[:, 1].max()), size
+        )
+        if region is None:
+            return None
+        mask = np.zeros((region.height, region.width), np.uint8)
+        shifted = np.round(points - region.box[:2]).astype(np.int32)
+        cv2.fillPoly(mask, [shifted], 255, lineType=cv2.LINE_AA)
+        return cls(region.box, mask)
+
+    def expanded(self, halo: int, size: tuple) -> tuple:
+        """
+        Bounding box grown by halo pixels, clipped to the image
+        """
+        left, top, right, bottom = self.box
+        return (
+            max(0, left - halo),
+            max(0, top - halo),
+            min(size[0], right + halo),
+            min(size[1], bottom + halo),
+        )
+
+    def oriented(self, orientation: Orientation, size: tuple) -> "Region":
+        """
+        Same selection after the image of size is flipped / rotated
+        """
+        box = orientation.map_box(self.box, size)
+        mask = None if self.mask is None else orientation.apply(self.mask)
+        return Region(box, mask)
+
+    def outlines(self) -> list:
+        """
+        Outline polygons in image pixels, for display
+        :return: list of [(x, y), ...]
+        """
+        left, top, right, bottom = self.box
+        if self.mask is None:
+            return [[(left, top), (right, top), (right, bottom), (left, bottom)]]
+        contours, _ = cv2.findContours(
+            (self.mask >= 128).astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE
+        )
+        return [[(left + x, top + y) for x, y in contour[:, 0]] for contour in contours]
+
+
+class RegionEdit:
+    """
+    Class run a Recipe operation inside a Region only.
+    The operation sees the selection bounding box plus a halo wide enough
+    for its neighbourhood, so pixels inside the box come out as if the
+    whole image was processed; the result is blended back through the mask.
+    Operations using statistics of the whole image (histogram, maximum,
+    mean) still run on the whole image before blending
+    """
+
+    # name: halo in pixels from the operation params
+    HALOS = {
+        "brightness_image": lambda params: 0,
+        "color_image": lambda params: 0,
+        "invert_image": lambda params: 0,
+        "gamma_transform": lambda params: 0,
+        "apply_lookup_table": lambda params: 0,
+        "sharpen_image": lambda params: 1,
+        "blur_image": lambda params: math.ceil(3 * params["radius"]) + 1,
+        "dilate_image": lambda params: params["cycle"],
+        "erode_image": lambda params: params["cycle"],
+        "convert_to_sketch_image": lambda params: 2,
+        "snowy": lambda params: 12,
+        "darkness": lambda params: 12,
+        "pastel": lambda params: 2,
+        "firestorm": lambda params: 0,
+        "ice": lambda params: 0,
+        "gray_nostalgia": lambda params: 1,
+        "cartoon": lambda params: 8,
+    }
+
+    GLOBAL = (
+        "histogram_equalization",
+        "log_transform",
+        "contrast_image",
+        "colormap_filter",
+        "auto_enhance",
+        # Recursive edge preserving filters (edgePreservingFilter,
+        # stylization) read the whole image, a halo only approximates them
+        "pink_dream",
+        "cyperpunk_2077",
+        "sweet_dream",
+    )
+    GEOMETRIC = (
+        "resize_image",
+        "rotate_image",
+        "transpose_image",
+        "crop_image",
+        "affine_transform",
+    )
+    PIL_MODES = ("L", "RGB", "RGBA")
+
+    @staticmethod
+    def native_mode(image: Image.Image) -> str:
+        """
+        Mode a PIL image is converted to before running operations:
+        itself for PIL_MODES, else RGBA when it has transparency, else RGB
+        """
+        if image.mode in RegionEdit.PIL_MODES:
+            return image.mode
+        if "A" in image.getbands() or "transparency" in image.info:
+            return "RGBA"
+        return "RGB"
+
+    @staticmethod
+    def to_native(image):
+        """
+        :param image: Image object (PIL) or numpy array, arrays are returned as is
+        :return: image in one of PIL_MODES
+        """
+        if isinstance(image, np.ndarray) or image.mode in RegionEdit.PIL_MODES:
+            return image
+        return image.convert(RegionEdit.native_mode(image))
+
+    @staticmethod
+    def halo(name: str, params: dict):
+        """
+        :return: pixels around the selection the operation reads, None when
+            it needs the whole image
+        """
+        if name in RegionEdit.GEOMETRIC:
+            raise ValueError(f"{name} changes the image geometry, it cannot run in a selection")
+        if name in RegionEdit.HALOS:
+            return RegionEdit.HALOS[name](params)
+        return None
+
+    @staticmethod
+    def blend(original: np.ndarray, edited: np.ndarray, mask: np.ndarray = None) -> np.ndarray:
+        """
+        original * (1 - mask) + edited * mask with mask in 0-255, rounded
+        """
+        if mask is None:
+            return edited
+        if original.ndim == 3:
+            mask = mask[:, :, None]
+        wide = np.uint64 if original.dtype == np.uint16 else np.uint32
+        mask = mask.astype(wide)
+        blended = (edited.astype(wide) * mask + original.astype(wide) * (255 - mask) + 127) // 255
+        return blended.astype(original.dtype)
+
+    @staticmethod
+    def match_channels(result: np.ndarray, original: np.ndarray) -> np.ndarray:
+        """
+        Give an operation result the channels of the image, e.g. a gray
+        filter result in a RGB image; alpha is kept from the original
+        """
+        if result.ndim == original.ndim and result.shape[2:] == original.shape[2:]:
+            return result
+        channels = 1 if original.ndim == 2 else original.shape[2]
+        if result.ndim == 3 and channels == 1:
+            code = cv2.COLOR_RGBA2GRAY if result.shape[2] == 4 else cv2.COLOR_RGB2GRAY
+            return cv2.cvtColor(result, code)
+        color = result[:, :, :3] if result.ndim == 3 else np.repeat(result[:, :, None], 3, axis=2)
+        if channels == 4:
+            color = np.concatenate([color, original[:, :, 3:]], axis=2)
+        return np.ascontiguousarray(color)
+
+    @staticmethod
+    def apply(
+        image,
+        region: Region,
+        name: str,
+        params: dict = None,
+        in_place: bool = False,
+        run_step=Recipe.run_step,
+    ) -> tuple:
+        """
+        Run operation name inside region
+        :param image: Image object (PIL) or numpy array
+        :param in_place: a numpy image may be overwritten instead of copied
+        :param run_step: callable(image, name, params) running the operation
+        :return: (new image of the same type and mode, changed box)
+        """
+        params = params or {}
+        is_array = isinstance(image, np.ndarray)
+        image = RegionEdit.to_native(image)
+        size = (image.shape[1], image.shape[0]) if is_array else image.size
+
+        halo = RegionEdit.halo(name, params)
+        outer = (0, 0) + size if halo is None else region.expanded(halo, size)
+        if is_array:
+            crop = image[outer[1] : outer[3], outer[0] : outer[2]]
+        else:
+            crop = image.crop(outer)
+        result = np.asarray(run_step(crop, name, params))
+
+        left, top, right, bottom = region.box
+        inner = (
+            slice(top - outer[1], bottom - outer[1]),
+            slice(left - outer[0], right - outer[0]),
+        )
+        pixels = np.asarray(image)
+        original = pixels[top:bottom, left:right]
+        edited = RegionEdit.match_channels(result[inner], original)
+        blended = RegionEdit.blend(original, edited.astype(original.dtype), region.mask)
+
+        if is_array:
+            writable = in_place and image.flags.writeable
+            output = image if writable else image.copy()
+            output[top:bottom, left:right] = blended
+        else:
+            output = image.copy()
+            output.paste(Image.fromarray(blended, image.mode), (left, top))
+        return output, region.box
@@ -0,0 +1,134 @@
+""" Several thumbnail sizes from one decode """
+import argparse
+import pathlib
+
+import cv2
+import numpy as np
+from PIL import Image
+
+
+class ThumbnailPyramid:
+    """
+    Class make thumbnails of several sizes in one job.
+    JPEG files are decoded with draft mode at the smallest 1/2, 1/4 or 1/8
+    scale still larger than the biggest thumbnail. Every thumbnail is then
+    resized from the next larger one instead of from the full image, so
+    the work follows the size of the largest output, not the number of
+    sizes times the source size. Resizing uses an antialiasing filter
+    """
+
+    RESAMPLE = Image.Resampling.LANCZOS
+    # Image.resize first shrinks by an integer factor (box filter) while the
+    # image is larger than REDUCING_GAP x the target, then finishes with RESAMPLE
+    REDUCING_GAP = 3.0
+
+    @staticmethod
+    def fit_size(size: tuple, target) -> tuple:
+        """
+        Largest size keeping the aspect ratio that fits target, never larger
+        than size
+        :param target: longest side (int) or (width, height) box
+        """
+        width, height = size
+        if isinstance(target, int):
+            target = (target, target)
+        scale = min(target[0] / width, target[1] / height, 1.0)
+        return max(1, round(width * scale)), max(1, round(height * scale))
+
+    @staticmethod
+    def image_size(image) -> tuple:
+        if isinstance(image, np.ndarray):
+            return image.shape[1], image.shape[0]
+        return image.size
+
+    @staticmethod
+    def resize(image, size: tuple):
+        if ThumbnailPyramid.image_size(image) == size:
+            return image
+        if isinstance(image, np.ndarray):
+            return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+        return image.resize(
+            size, ThumbnailPyramid.RESAMPLE, reducing_gap=ThumbnailPyramid.REDUCING_GAP
+        )
+
+    @staticmethod
+    def plan(size: tuple, targets) -> list:
+        """
+        :return: list of (target, output size), largest output first
+        """
+        sizes = [(target, ThumbnailPyramid.fit_size(size, target)) for target in targets]
+        return sorted(sizes, key=lambda item: item[1][0] * item[1][1], reverse=True)
+
+    @staticmethod
+    def generate(image, targets) -> dict:
+        """
+        :param image: Image object (PIL) or numpy array. A PIL image that is
+            not loaded yet (just opened) is decoded with draft mode
+        :param targets: longest sides or (width, height) boxes
+        :return: dict of target to thumbnail
+        """
+        targets = list(targets)
+        if not targets:
+            return {}
+        plan = ThumbnailPyramid.plan(ThumbnailPyramid.image_size(image), targets)
+
+        if not isinstance(image, np.ndarray) and image.format == "JPEG":
+            # Only has effect before the image is loaded
+            image.draft(None, plan[0][1])
+
+        thumbnails = {}
+        source = image
+        for target, size in plan:
+            source = ThumbnailPyramid.resize(source, size)
+            thumbnails[target] = source
+        return thumbnails
+
+    @staticmethod
+    def from_file(image_path, targets) -> dict:
+        with Image.open(image_path) as img:
+            thumbnails = ThumbnailPyramid.generate(img, targets)
+            # A thumbnail of the source size is the source itself
+            return {
+                target: thumbnail.copy() if thumbnail is img else thumbnail
+                for target, thumbnail in thumbnails.items()
+            }
+
+    @staticmethod
+    def save(image_path, targets, output_dir, pattern: str = "{stem}_{size}{suffix}", **params) -> list:
+        """
+        Write the thumbnails of an image file
+        :param pattern: file name, {stem} {suffix} of the source and {size} "WxH"
+        :param params: passed to Image.save, e.g. quality=85
+        :return: list of written paths
+        """
+        image_path = pathlib.Path(image_path)
+        output_dir = pathlib.Path(output_dir)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        paths = []
+        for thumbnail in ThumbnailPyramid.from_file(image_path, targets).values():
+            name = pattern.format(
+                stem=image_path.stem,
+                suffix=image_path.suffix,
+                size="%dx%d" % thumbnail.size,
+            )
+            path = output_dir / name
+            thumbnail.save(path, **params)
+            paths.append(path)
+        return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write several thumbnail sizes of images")
+    parser.add_argument("images", nargs="+")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[2048, 1024, 512, 256, 128, 64])
+    parser.add_argument("--output", default="thumbnails")
+    parser.add_argument("--quality", type=int, default=85)
+    args = parser.parse_args()
+
+    for image_path in args.images:
+        for path in ThumbnailPyramid.save(image_path, args.sizes, args.output, quality=args.quality):
+            print(path)
+
+
+if __name__ == "__main__":
+    main()
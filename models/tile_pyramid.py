@@ -0,0 +1,185 @@
+""" Multi-resolution tile pyramid for viewing large images """
+import collections
+import math
+
+import cv2
+import numpy as np
+
+
+class TilePyramid:
+    """
+    Class cut an image into square tiles at several resolutions.
+    Level 0 is the full resolution, every next level halves both sides.
+    Tiles are made on demand: a level 0 tile is read from the image, a
+    higher level tile is downsampled from its 4 children. Made tiles are
+    kept in a LRU cache and dropped when the region they cover is edited
+    """
+
+    TILE_SIZE = 256
+    CACHE_TILES = 1024
+
+    def __init__(self, image, tile_size: int = TILE_SIZE, cache_tiles: int = CACHE_TILES):
+        """
+        :param image: 8-bit Image object (PIL) or numpy array
+        """
+        self.tile_size = tile_size
+        self.cache_tiles = cache_tiles
+        self.cache = collections.OrderedDict()
+        self.image = None
+        self.width = self.height = 0
+        self.levels = 1
+        self.set_image(image)
+
+    def set_image(self, image):
+        """
+        Replace the whole image, every tile is dropped
+        """
+        self.image = image
+        if isinstance(image, np.ndarray):
+            self.height, self.width = image.shape[:2]
+        else:
+            self.width, self.height = image.size
+        longest = max(self.width, self.height, 1)
+        self.levels = max(1, math.ceil(math.log2(longest / self.tile_size)) + 1)
+        self.cache.clear()
+
+    def update(self, image, box: tuple = None):
+        """
+        Replace the image after an edit that only changed box
+        :param box: (left, top, right, bottom) at full resolution, None for all
+        """
+        if box is None or self.image_size(image) != (self.width, self.height):
+            self.set_image(image)
+            return
+        self.image = image
+        self.invalidate(box)
+
+    @staticmethod
+    def image_size(image) -> tuple:
+        if isinstance(image, np.ndarray):
+            return image.shape[1], image.shape[0]
+        return image.size
+
+    def level_size(self, level: int) -> tuple:
+        """
+        (width, height) of the image at level
+        """
+        scale = 2**level
+        return max(1, math.ceil(self.width / scale)), max(1, math.ceil(self.height / scale))
+
+    def grid_size(self, level: int) -> tuple:
+        """
+        (columns, rows) of tiles at level
+        """
+        width, height = self.level_size(level)
+        return math.ceil(width / self.tile_size), math.ceil(height / self.tile_size)
+
+    def level_for_scale(self, scale: float) -> int:
+        """
+        Coarsest level that still has at least one pixel per screen pixel
+        :param scale: screen pixels per full resolution pixel
+        """
+        if scale <= 0:
+            return self.levels - 1
+        level = int(math.floor(math.log2(1 / scale))) if scale < 1 else 0
+        return min(max(level, 0), self.levels - 1)
+
+    def visible_tiles(self, level: int, rect: tuple) -> list:
+        """
+        Tiles of level that intersect rect
+        :param rect: (left, top, right, bottom) at full resolution
+        :return: list of (column, row)
+        """
+        span = self.tile_size * 2**level
+        columns, rows = self.grid_size(level)
+        first_column = max(0, int(rect[0] // span))
+        first_row = max(0, int(rect[1] // span))
+        last_column = min(columns - 1, int(math.ceil(rect[2] / span)) - 1)
+        last_row = min(rows - 1, int(math.ceil(rect[3] / span)) - 1)
+        return [
+            (column, row)
+            for row in range(first_row, last_row + 1)
+            for column in range(first_column, last_column + 1)
+        ]
+
+    def tile_box(self, level: int, column: int, row: int) -> tuple:
+        """
+        (left, top, right, bottom) of a tile in the pixels of its level
+        """
+        width, height = self.level_size(level)
+        left, top = column * self.tile_size, row * self.tile_size
+        return left, top, min(left + self.tile_size, width), min(top + self.tile_size, height)
+
+    def read_region(self, box: tuple) -> np.ndarray:
+        """
+        Full resolution pixels of box, PIL images are cropped without
+        converting the whole image
+        """
+        left, top, right, bottom = box
+        if isinstance(self.image, np.ndarray):
+            return np.ascontiguousarray(self.image[top:bottom, left:right])
+        return np.asarray(self.image.crop(box))
+
+    def tile(self, level: int, column: int, row: int) -> np.ndarray:
+        """
+        Pixels of one tile, made on demand
+        :return: numpy array of at most tile_size x tile_size pixels
+        """
+        key = (level, column, row)
+        tile = self.cache.get(key)
+        if tile is not None:
+            self.cache.move_to_end(key)
+            return tile
+
+        box = self.tile_box(level, column, row)
+        if level == 0:
+            tile = self.read_region(box)
+        else:
+            tile = self.downsample_children(level, column, row, box)
+
+        self.cache[key] = tile
+        while len(self.cache) > self.cache_tiles:
+            self.cache.popitem(last=False)
+        return tile
+
+    def downsample_children(self, level: int, column: int, row: int, box: tuple) -> np.ndarray:
+        """
+        Build a tile by halving the 2x2 block of child tiles below it
+        """
+        child_columns, child_rows = self.grid_size(level - 1)
+        mosaic_rows = []
+        for child_row in (2 * row, 2 * row + 1):
+            if child_row >= child_rows:
+                continue
+            children = [
+                self.tile(level - 1, child_column, child_row)
+                for child_column in (2 * column, 2 * column + 1)
+                if child_column < child_columns
+            ]
+            mosaic_rows.append(np.concatenate(children, axis=1))
+        mosaic = np.concatenate(mosaic_rows, axis=0)
+        size = (box[2] - box[0], box[3] - box[1])
+        return cv2.resize(mosaic, size, interpolation=cv2.INTER_AREA)
+
+    def invalidate(self, box: tuple):
+        """
+        Drop cached tiles covering box at every level
+        :param box: (left, top, right, bottom) at full resolution
+        """
+        for key in list(self.cache):
+            level, column, row = key
+            span = self.tile_size * 2**level
+            left, top = column * span, row * span
+            if left < box[2] and left + span > box[0] and top < box[3] and top + span > box[1]:
+                del self.cache[key]
+
+    @staticmethod
+    def as_display_image(image):
+        """
+        Image usable as pyramid source: 8-bit L, RGB or RGBA
+        """
+        if isinstance(image, np.ndarray):
+            return image
+        if image.mode not in ("L", "RGB", "RGBA"):
+            return image.convert("RGBA" if "A" in image.getbands() else "RGB")
+        return image
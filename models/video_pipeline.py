@@ -0,0 +1,246 @@
+""" Pipelined video effect rendering """
+import argparse
+import queue
+import threading
+import time
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from models.parallel import default_workers
+from models.recipe import Recipe
+
+# Marks the end of a stream in the queues
+_END = None
+
+
+class StageStats:
+    """
+    Busy time of one pipeline stage, shared by its workers
+    """
+
+    def __init__(self, name: str, workers: int = 1):
+        self.name = name
+        self.workers = workers
+        self.busy = 0.0
+        self.items = 0
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float):
+        with self._lock:
+            self.busy += seconds
+            self.items += 1
+
+    def utilization(self, wall_time: float) -> float:
+        """
+        Fraction of the wall time the stage workers spent working
+        """
+        if wall_time <= 0:
+            return 0.0
+        return self.busy / (wall_time * self.workers)
+
+
+class VideoRenderer:
+    """
+    Class render a recipe over every frame of a video file.
+    Decoding, filtering and encoding run as separate stages connected by
+    bounded queues; filtering uses several workers and frames are put back
+    in order before encoding. Frames are converted to RGB before the recipe
+    so effects look the same as in the editor
+    """
+
+    def __init__(
+        self,
+        recipe: Recipe,
+        workers: int = None,
+        queue_size: int = None,
+        fourcc: str = "mp4v",
+    ):
+        self.recipe = recipe
+        self.workers = workers or default_workers()
+        self.queue_size = queue_size or 2 * self.workers
+        self.fourcc = fourcc
+        self.report = {}
+
+    def filter_frame(self, frame: np.ndarray) -> np.ndarray:
+        """
+        Apply the recipe to one BGR frame
+        :return: BGR numpy array
+        """
+        image = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+        result = np.asarray(self.recipe.apply(image, in_place=True))
+        if result.ndim == 2:
+            return cv2.cvtColor(result, cv2.COLOR_GRAY2BGR)
+        if result.shape[2] == 4:
+            return cv2.cvtColor(result, cv2.COLOR_RGBA2BGR)
+        return cv2.cvtColor(result, cv2.COLOR_RGB2BGR)
+
+    def render(self, input_path, output_path) -> dict:
+        """
+        Render input_path to output_path
+        :return: report dict with frames, fps and per stage utilization
+        """
+        capture = cv2.VideoCapture(str(input_path))
+        if not capture.isOpened():
+            raise OSError(f"Cannot open video: {input_path}")
+        fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+
+        decoded = queue.Queue(maxsize=self.queue_size)
+        filtered = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+        errors = []
+        stats = {
+            "decode": StageStats("decode"),
+            "filter": StageStats("filter", self.workers),
+            "encode": StageStats("encode"),
+        }
+
+        def put(target: queue.Queue, item) -> bool:
+            while not stop.is_set():
+                try:
+                    target.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def get(source: queue.Queue):
+            while not stop.is_set():
+                try:
+                    return source.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+            return _END
+
+        def decode():
+            index = 0
+            try:
+                while not stop.is_set():
+                    start = time.perf_counter()
+                    ok, frame = capture.read()
+                    if not ok:
+                        break
+                    stats["decode"].add(time.perf_counter() - start)
+                    if not put(decoded, (index, frame)):
+                        break
+                    index += 1
+            except Exception as error:
+                errors.append(error)
+                stop.set()
+            finally:
+                capture.release()
+                for _ in range(self.workers):
+                    put(decoded, _END)
+
+        def work():
+            try:
+                while True:
+                    item = get(decoded)
+                    if item is _END:
+                        break
+                    index, frame = item
+                    start = time.perf_counter()
+                    frame = self.filter_frame(frame)
+                    stats["filter"].add(time.perf_counter() - start)
+                    if not put(filtered, (index, frame)):
+                        break
+            except Exception as error:
+                errors.append(error)
+                stop.set()
+            finally:
+                put(filtered, _END)
+
+        def encode():
+            writer = None
+            waiting = {}
+            next_index = 0
+            finished = 0
+            try:
+                while finished < self.workers:
+                    item = get(filtered)
+                    if item is _END:
+                        finished += 1
+                        continue
+                    waiting[item[0]] = item[1]
+                    # Reorder: write every frame that is now in sequence
+                    while next_index in waiting:
+                        frame = waiting.pop(next_index)
+                        start = time.perf_counter()
+                        if writer is None:
+                            height, width = frame.shape[:2]
+                            writer = cv2.VideoWriter(
+                                str(output_path),
+                                cv2.VideoWriter_fourcc(*self.fourcc),
+                                fps,
+                                (width, height),
+                            )
+                            if not writer.isOpened():
+                                raise OSError(f"Cannot write video: {output_path}")
+                        writer.write(frame)
+                        stats["encode"].add(time.perf_counter() - start)
+                        next_index += 1
+            except Exception as error:
+                errors.append(error)
+                stop.set()
+            finally:
+                if writer is not None:
+                    writer.release()
+
+        threads = [threading.Thread(target=decode, name="decode")]
+        threads += [
+            threading.Thread(target=work, name=f"filter-{i}") for i in range(self.workers)
+        ]
+        threads.append(threading.Thread(target=encode, name="encode"))
+
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall_time = time.perf_counter() - start
+
+        if errors:
+            raise errors[0]
+
+        frames = stats["encode"].items
+        self.report = {
+            "frames": frames,
+            "seconds": wall_time,
+            "fps": frames / wall_time if wall_time else 0.0,
+            "workers": self.workers,
+            "utilization": {
+                name: stage.utilization(wall_time) for name, stage in stats.items()
+            },
+        }
+        return self.report
+
+
+def format_report(report: dict) -> str:
+    lines = [
+        f"{report['frames']} frames in {report['seconds']:.2f}s "
+        f"({report['fps']:.1f} fps, {report['workers']} filter workers)"
+    ]
+    for name, utilization in report["utilization"].items():
+        lines.append(f"  {name:<7} {utilization:6.1%} busy")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply a recipe to a video file")
+    parser.add_argument("input")
+    parser.add_argument("output")
+    parser.add_argument("recipe", help="recipe JSON file")
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--queue-size", type=int)
+    parser.add_argument("--fourcc", default="mp4v")
+    args = parser.parse_args()
+
+    renderer = VideoRenderer(
+        Recipe.load(args.recipe), args.workers, args.queue_size, args.fourcc
+    )
+    print(format_report(renderer.render(args.input, args.output)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+from PyQt5.QtCore import QThread, pyqtSignal
+
+from models.cancellable import CancelToken, OperationCancelled
+
+
+class OperationThread(QThread):
+    """
+    Thread running one operation off the GUI thread, the way the
+    ExecutionPlanner picks. Exactly one of finished_with, cancelled or
+    failed is emitted when it ends
+    """
+
+    # fraction done, seconds left (-1 while unknown)
+    progress = pyqtSignal(float, float)
+    # result, changed box or None for the whole image
+    finished_with = pyqtSignal(object, object)
+    cancelled = pyqtSignal()
+    failed = pyqtSignal(str)
+
+    def __init__(self, planner, image, region, name: str, params: dict, parent=None):
+        super().__init__(parent)
+        self.planner = planner
+        self.image = image
+        self.region = region
+        self.name = name
+        self.params = params
+        self.token = CancelToken()
+
+    def cancel(self):
+        self.token.cancel()
+
+    def report(self, fraction: float, remaining):
+        self.progress.emit(fraction, -1.0 if remaining is None else remaining)
+
+    def run(self):
+        try:
+            result, box = self.planner.apply(
+                self.image, self.region, self.name, self.params, self.token, self.report
+            )
+        except OperationCancelled:
+            self.cancelled.emit()
+        except Exception as error:
+            self.failed.emit(str(error))
+        else:
+            self.finished_with.emit(result, box)
+        finally:
+            # The thread must not keep the source pixels alive
+            self.image = None
@@ -0,0 +1,65 @@
+from PyQt5.QtCore import QSize, Qt
+from PyQt5.QtGui import QIcon
+from PyQt5.QtWidgets import (
+    QDialog,
+    QDoubleSpinBox,
+    QGridLayout,
+    QHBoxLayout,
+    QLabel,
+    QPushButton,
+    QToolButton,
+    QVBoxLayout,
+)
+
+from tile_view import array_to_pixmap
+
+
+class SweepDialog(QDialog):
+    """
+    Dialog showing a ParameterSweep as a grid of previews. Clicking a
+    preview picks its value; a custom value can be typed instead
+    """
+
+    COLUMNS = 3
+
+    def __init__(self, sweep, parent=None):
+        super().__init__(parent)
+        self.sweep = sweep
+        self.value = None
+        self.setWindowTitle(f"{sweep.label} preview")
+
+        layout = QVBoxLayout(self)
+        grid = QGridLayout()
+        variants = sweep.render()
+        height, width = variants.shape[1:3]
+        self.buttons = []
+        for index, (value, variant) in enumerate(zip(sweep.values, variants)):
+            button = QToolButton(self)
+            button.setIcon(QIcon(array_to_pixmap(variant)))
+            button.setIconSize(QSize(width, height))
+            button.setText(f"{sweep.label} {value:g}")
+            button.setToolButtonStyle(Qt.ToolButtonTextUnderIcon)
+            button.clicked.connect(lambda checked, value=value: self.pick(value))
+            grid.addWidget(button, index // self.COLUMNS, index % self.COLUMNS)
+            self.buttons.append(button)
+        layout.addLayout(grid)
+
+        row = QHBoxLayout()
+        row.addWidget(QLabel("Custom value:", self))
+        self.spin_box = QDoubleSpinBox(self)
+        self.spin_box.setDecimals(2)
+        self.spin_box.setSingleStep(0.05)
+        self.spin_box.setRange(0.01, 10.0)
+        self.spin_box.setValue(1.0)
+        row.addWidget(self.spin_box)
+        apply_button = QPushButton("Apply", self)
+        apply_button.clicked.connect(lambda: self.pick(self.spin_box.value()))
+        row.addWidget(apply_button)
+        cancel_button = QPushButton("Cancel", self)
+        cancel_button.clicked.connect(self.reject)
+        row.addWidget(cancel_button)
+        layout.addLayout(row)
+
+    def pick(self, value: float):
+        self.value = value
+        self.accept()
@@ -0,0 +1,246 @@
+from PyQt5.QtCore import QEvent, QObject, QPointF, QRectF, Qt, pyqtSignal
+from PyQt5.QtGui import QImage, QPainterPath, QPen, QPixmap, QPolygonF, QTransform
+from PyQt5.QtWidgets import QGraphicsScene, QGraphicsView
+
+from models.tile_pyramid import TilePyramid
+
+QIMAGE_FORMATS = {
+    1: QImage.Format_Grayscale8,
+    3: QImage.Format_RGB888,
+    4: QImage.Format_RGBA8888,
+}
+
+
+def array_to_pixmap(array) -> QPixmap:
+    """
+    Copy a uint8 gray, RGB or RGBA numpy array to a QPixmap
+    """
+    height, width = array.shape[:2]
+    channels = 1 if array.ndim == 2 else array.shape[2]
+    image = QImage(
+        array.tobytes(), width, height, width * channels, QIMAGE_FORMATS[channels]
+    )
+    # QPixmap.fromImage copies, so array may be freed afterwards
+    return QPixmap.fromImage(image)
+
+
+class TiledImageView(QObject):
+    """
+    Drive a QGraphicsView as a zoomable viewer of a TilePyramid.
+    Scene coordinates are full resolution pixels. Only the tiles visible at
+    the current zoom are turned into pixmaps, so zooming to 100% or panning
+    a very large image never converts the whole image at once.
+    Shift + drag draws a rectangle selection, Ctrl + drag a lasso; the
+    drawn shape is sent by selection_drawn as ("rect" | "lasso", points)
+    """
+
+    selection_drawn = pyqtSignal(str, list)
+
+    ZOOM_STEP = 1.25
+    MAX_ZOOM = 32.0
+
+    def __init__(self, view: QGraphicsView):
+        super().__init__(view)
+        self.view = view
+        self.scene = QGraphicsScene(self)
+        self.pyramid = None
+        self.items = {}
+        self.level = None
+        self.zoom = 1.0
+        self.orientation = QTransform()
+        self.drawing = None
+        self.drawn_points = []
+        self.selection_item = None
+
+        view.setScene(self.scene)
+        view.setDragMode(QGraphicsView.ScrollHandDrag)
+        view.setTransformationAnchor(QGraphicsView.AnchorUnderMouse)
+        view.viewport().installEventFilter(self)
+        view.horizontalScrollBar().valueChanged.connect(self.refresh)
+        view.verticalScrollBar().valueChanged.connect(self.refresh)
+
+    def set_image(self, image, box: tuple = None):
+        """
+        Show image. When box is given and the size did not change only the
+        tiles covering box are rebuilt
+        :param box: (left, top, right, bottom) of the edited region
+        """
+        image = TilePyramid.as_display_image(image)
+        keep_view = self.pyramid is not None and (
+            TilePyramid.image_size(image) == (self.pyramid.width, self.pyramid.height)
+        )
+        if self.pyramid is None:
+            self.pyramid = TilePyramid(image)
+        else:
+            self.pyramid.update(image, box)
+
+        if box is None or not keep_view:
+            self.clear_items()
+        else:
+            self.clear_items(box)
+        self.scene.setSceneRect(QRectF(0, 0, self.pyramid.width, self.pyramid.height))
+        if keep_view:
+            self.refresh()
+        else:
+            self.fit()
+
+    def set_orientation(self, matrix: tuple):
+        """
+        Show the image flipped / rotated without touching its pixels, the
+        view is fitted again only when the orientation changed
+        :param matrix: (m11, m12, m21, m22) from Orientation.matrix()
+        """
+        orientation = QTransform(*matrix, 0, 0)
+        if orientation == self.orientation:
+            return
+        self.orientation = orientation
+        self.fit()
+
+    def clear_items(self, box: tuple = None):
+        for key in list(self.items):
+            level, column, row = key
+            if box is not None:
+                span = self.pyramid.tile_size * 2**level
+                left, top = column * span, row * span
+                if not (
+                    left < box[2] and left + span > box[0] and top < box[3] and top + span > box[1]
+                ):
+                    continue
+            self.scene.removeItem(self.items.pop(key))
+
+    def fit(self):
+        """
+        Zoom so the whole image fits in the view
+        """
+        if self.pyramid is None:
+            return
+        viewport = self.view.viewport().rect()
+        bounds = self.orientation.mapRect(self.scene.sceneRect())
+        if bounds.width() <= 0 or bounds.height() <= 0:
+            return
+        self.zoom = min(
+            viewport.width() / bounds.width(), viewport.height() / bounds.height()
+        )
+        self.apply_zoom()
+        self.view.centerOn(self.scene.sceneRect().center())
+
+    def zoom_actual_size(self):
+        """
+        Zoom to 100%: one image pixel per screen pixel
+        """
+        self.zoom = 1.0
+        self.apply_zoom()
+
+    def zoom_by(self, factor: float):
+        self.zoom = min(max(self.zoom * factor, 1e-3), self.MAX_ZOOM)
+        self.apply_zoom()
+
+    def apply_zoom(self):
+        self.view.setTransform(self.orientation * QTransform.fromScale(self.zoom, self.zoom))
+        self.refresh()
+
+    def visible_rect(self) -> tuple:
+        rect = self.view.mapToScene(self.view.viewport().rect()).boundingRect()
+        return rect.left(), rect.top(), rect.right(), rect.bottom()
+
+    def refresh(self, *args):
+        """
+        Add the tiles visible at the current zoom, remove the others
+        """
+        if self.pyramid is None:
+            return
+        level = self.pyramid.level_for_scale(self.zoom)
+        visible = {
+            (level, column, row)
+            for column, row in self.pyramid.visible_tiles(level, self.visible_rect())
+        }
+        for key in list(self.items):
+            if key not in visible:
+                self.scene.removeItem(self.items.pop(key))
+        for key in visible - set(self.items):
+            self.items[key] = self.add_tile(*key)
+        self.level = level
+
+    def add_tile(self, level: int, column: int, row: int):
+        tile = self.pyramid.tile(level, column, row)
+        item = self.scene.addPixmap(array_to_pixmap(tile))
+        scale = 2**level
+        span = self.pyramid.tile_size * scale
+        item.setPos(column * span, row * span)
+        item.setScale(scale)
+        item.setTransformationMode(Qt.SmoothTransformation)
+        return item
+
+    def show_selection(self, outlines: list):
+        """
+        Draw selection outlines
+        :param outlines: list of [(x, y), ...] in image pixels
+        """
+        path = QPainterPath()
+        for outline in outlines:
+            path.addPolygon(QPolygonF([QPointF(x, y) for x, y in outline]))
+            path.closeSubpath()
+        if self.selection_item is None:
+            pen = QPen(Qt.white, 0, Qt.DashLine)
+            pen.setCosmetic(True)
+            self.selection_item = self.scene.addPath(path, pen)
+            self.selection_item.setZValue(1)
+        else:
+            self.selection_item.setPath(path)
+
+    def clear_selection(self):
+        if self.selection_item is not None:
+            self.scene.removeItem(self.selection_item)
+            self.selection_item = None
+
+    def draw_event(self, event) -> bool:
+        """
+        Track a selection being drawn
+        :return: True when the event was used
+        """
+        if event.type() == QEvent.MouseButtonPress and event.button() == Qt.LeftButton:
+            if event.modifiers() & Qt.ShiftModifier:
+                self.drawing = "rect"
+            elif event.modifiers() & Qt.ControlModifier:
+                self.drawing = "lasso"
+            else:
+                return False
+            point = self.view.mapToScene(event.pos())
+            self.drawn_points = [(point.x(), point.y())]
+            return True
+        if self.drawing is None:
+            return False
+
+        point = self.view.mapToScene(event.pos())
+        if self.drawing == "rect":
+            x0, y0 = self.drawn_points[0]
+            self.drawn_points = [(x0, y0), (point.x(), point.y())]
+            outline = [(x0, y0), (point.x(), y0), (point.x(), point.y()), (x0, point.y())]
+        else:
+            self.drawn_points.append((point.x(), point.y()))
+            outline = self.drawn_points
+        self.show_selection([outline])
+
+        if event.type() == QEvent.MouseButtonRelease:
+            kind, self.drawing = self.drawing, None
+            self.selection_drawn.emit(kind, self.drawn_points)
+        return True
+
+    def eventFilter(self, obj, event):
+        if event.type() in (
+            QEvent.MouseButtonPress,
+            QEvent.MouseMove,
+            QEvent.MouseButtonRelease,
+        ) and self.draw_event(event):
+            return True
+        if event.type() == QEvent.Wheel:
+            steps = event.angleDelta().y() / 120
+            if steps:
+                self.zoom_by(self.ZOOM_STEP**steps)
+            return True
+        if event.type() == QEvent.Resize and self.pyramid is not None:
+            self.refresh()
+        return False
+
+    def tile_count(self) -> int:
+        return len(self.items)
@@ -0,0 +1,255 @@
+""" Scripted interaction benchmark of the editor window, runs headless """
+import argparse
+import json
+import os
+import pathlib
+import platform
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import numpy as np
+from PIL import Image
+from PyQt5 import QtWidgets
+from PyQt5.QtCore import QT_VERSION_STR, QEventLoop
+
+import image_editor_gui
+import models
+from models.processing_service import ServiceMetrics
+
+
+class UiBenchmark:
+    """
+    Class drive a real ImageEditor like a user would and time every
+    interaction from the event (slider value, click, page change) to the
+    painted viewport, i.e. display_image returned and the view repainted.
+    Filters run on their OperationThread, so the time includes the wait
+    for the thread and the signal back to the GUI thread.
+    Images are opened without the decode cache, every open decodes
+    """
+
+    SIZES = ((640, 480), (1920, 1080), (4000, 3000))
+    SLIDERS = ("blur_slider", "bright_slider", "color_slider", "contrast_slider", "sharpen_slider")
+    PERCENTS = (50, 95, 99)
+
+    def __init__(self, app: QtWidgets.QApplication, fixture_dir, repeat: int = 3):
+        """
+        :param fixture_dir: directory the fixture images are written to
+        :param repeat: times every interaction is repeated
+        """
+        self.app = app
+        self.fixture_dir = pathlib.Path(fixture_dir)
+        self.repeat = repeat
+        self.editor = image_editor_gui.ImageEditor()
+        self.editor.decode_cache = None
+        self.editor.resize(1280, 800)
+        self.editor.show()
+        self.results = {}
+        self.pending_path = None
+        # open_image asks for a path, the benchmark answers for the user
+        image_editor_gui.QFileDialog.getOpenFileName = lambda *args: (self.pending_path, "")
+
+    @staticmethod
+    def fixture(size: tuple, seed: int = 0) -> Image.Image:
+        """
+        Deterministic photo like image: smooth gradients, edges and noise
+        """
+        width, height = size
+        rng = np.random.default_rng(seed)
+        y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+        red = 255 * x / width
+        green = 255 * y / height
+        blue = 128 + 127 * np.sin(x / 37.0) * np.cos(y / 53.0)
+        pixels = np.stack([red, green, blue], axis=2)
+        pixels[height // 3 : height // 2, width // 4 : width // 2] = (230, 40, 60)
+        pixels += rng.normal(0, 8, pixels.shape)
+        return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+
+    def fixture_path(self, size: tuple) -> pathlib.Path:
+        path = self.fixture_dir / f"fixture_{size[0]}x{size[1]}.jpg"
+        if not path.exists():
+            self.fixture(size).save(path, quality=92)
+        return path
+
+    """
+    Measuring
+    """
+
+    def settle(self):
+        self.app.processEvents(QEventLoop.AllEvents)
+
+    def paint(self):
+        self.settle()
+        self.editor.graphicsView.viewport().repaint()
+
+    def measure(self, trigger, done=None) -> float:
+        """
+        :param trigger: callable sending the event
+        :param done: callable, True once the interaction finished (asynchronous ones)
+        :return: milliseconds until the view is painted
+        """
+        start = time.perf_counter()
+        trigger()
+        if done is not None:
+            while not done():
+                self.app.processEvents(QEventLoop.AllEvents, 5)
+        self.paint()
+        return 1000 * (time.perf_counter() - start)
+
+    def record(self, scenario: str, size: tuple, times: list):
+        percentile = ServiceMetrics.percentile
+        row = {"samples": len(times)}
+        for percent in self.PERCENTS:
+            row[f"p{percent}_ms"] = percentile(times, percent)
+        row["max_ms"] = max(times)
+        self.results[f"{scenario}@{size[0]}x{size[1]}"] = row
+
+    """
+    Scenarios
+    """
+
+    def open_image(self, path: pathlib.Path) -> list:
+        self.pending_path = str(path)
+        return [self.measure(self.editor.open_image) for _ in range(self.repeat)]
+
+    def slider_sweep(self, name: str) -> list:
+        """
+        Drag the slider over its whole range and back, one sample per value
+        """
+        slider = getattr(self.editor, name)
+        start = slider.value()
+        values = list(range(slider.minimum(), slider.maximum() + 1))
+        times = []
+        for _ in range(self.repeat):
+            for value in values + values[::-1]:
+                times.append(self.measure(lambda: slider.setValue(value)))
+        slider.setValue(start)
+        self.editor.undo_action()
+        self.paint()
+        return times
+
+    def page_switch(self) -> list:
+        stacked = self.editor.stackedWidget
+        times = []
+        for _ in range(self.repeat):
+            for index in list(range(1, stacked.count())) + [0]:
+                times.append(self.measure(lambda: stacked.setCurrentIndex(index)))
+        return times
+
+    def filter_click(self, name: str) -> list:
+        editor = self.editor
+        times = []
+        for _ in range(self.repeat):
+            times.append(
+                self.measure(
+                    editor.filter_buttons[name].click,
+                    lambda: editor.operation_thread is None,
+                )
+            )
+            editor.undo_action()
+            self.paint()
+        return times
+
+    def run(self, sizes=SIZES, filters=None) -> dict:
+        """
+        :param filters: filter names clicked, all by default
+        :return: results keyed by "scenario@WIDTHxHEIGHT"
+        """
+        filters = filters or list(self.editor.filter_buttons)
+        for size in sizes:
+            self.record("open", size, self.open_image(self.fixture_path(size)))
+            for name in self.SLIDERS:
+                self.record(name, size, self.slider_sweep(name))
+            self.record("page_switch", size, self.page_switch())
+            for name in filters:
+                self.record(f"filter_{name}", size, self.filter_click(name))
+        return self.results
+
+    def report(self) -> dict:
+        return {
+            "benchmark": "ui",
+            "version": models.__version__,
+            "environment": {
+                "python": platform.python_version(),
+                "qt": QT_VERSION_STR,
+                "platform": os.environ.get("QT_QPA_PLATFORM", ""),
+                "machine": platform.machine(),
+                "cpus": os.cpu_count(),
+            },
+            "repeat": self.repeat,
+            "results": self.results,
+        }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """
+    :param tolerance: allowed relative p95 increase, e.g. 0.2 for 20 %
+    :return: list of (key, baseline p95, p95, ratio, regressed) for the keys in both
+    """
+    rows = []
+    for key, row in results.items():
+        if key not in baseline:
+            continue
+        before, after = baseline[key]["p95_ms"], row["p95_ms"]
+        ratio = after / before if before else float("inf")
+        rows.append((key, before, after, ratio, ratio > 1 + tolerance))
+    return rows
+
+
+def format_report(results: dict, comparison: list = None) -> str:
+    lines = [f"{'interaction':<34} {'n':>5} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}"]
+    for key, row in results.items():
+        lines.append(
+            f"{key:<34} {row['samples']:>5} {row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f}"
+            f" {row['p99_ms']:>9.1f}"
+        )
+    if comparison:
+        lines.append("")
+        lines.append(f"{'interaction':<34} {'base p95':>9} {'p95':>9} {'ratio':>7}")
+        for key, before, after, ratio, regressed in comparison:
+            flag = "  REGRESSION" if regressed else ""
+            lines.append(f"{key:<34} {before:>9.1f} {after:>9.1f} {ratio:>6.2f}x{flag}")
+    return "\n".join(lines)
+
+
+def parse_size(text: str) -> tuple:
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time editor interactions headless")
+    parser.add_argument(
+        "--sizes", nargs="+", type=parse_size, help="fixture sizes, e.g. 1920x1080"
+    )
+    parser.add_argument("--filters", nargs="+", help="filters clicked, all by default")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="JSON file the results are written to")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare with")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2, help="allowed p95 increase over the baseline"
+    )
+    args = parser.parse_args()
+
+    app = QtWidgets.QApplication(sys.argv[:1])
+    with tempfile.TemporaryDirectory() as fixture_dir:
+        benchmark = UiBenchmark(app, fixture_dir, args.repeat)
+        benchmark.run(args.sizes or UiBenchmark.SIZES, args.filters)
+        report = benchmark.report()
+        benchmark.editor.close()
+
+    if args.output:
+        pathlib.Path(args.output).write_text(json.dumps(report, indent=2), encoding="utf-8")
+    comparison = None
+    if args.baseline:
+        baseline = json.loads(pathlib.Path(args.baseline).read_text(encoding="utf-8"))
+        comparison = compare(report["results"], baseline["results"], args.tolerance)
+    print(format_report(report["results"], comparison))
+    if comparison and any(row[4] for row in comparison):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()